@@ -10,13 +10,24 @@ import pprint
 
 from pox.core import core
 from pox.lib.addresses import EthAddr
+from pox.lib.revent import Event, EventMixin
 from pox.lib.util import dpid_to_str
 import pox.lib.packet as pkt
 import pox.openflow.libopenflow_01 as of
 
-class BaselineController(object):
+class HostTableChanged(Event):
+  """Raised when we learn the port or IP-address of a MAC-address."""
+  def __init__(self, mac, port=None, ip=None):
+    Event.__init__(self)
+    self.mac = mac
+    self.port = port
+    self.ip = ip
+
+class BaselineController(EventMixin):
   """An L2 learning switch to be used with benchmarking."""
 
+  _eventMixin_events = set([HostTableChanged])
+
   def __init__(self,
                connection,
                priority=1,
@@ -172,6 +183,7 @@ class BaselineController(object):
       if self.log_learn_full:
         self.log.debug("Learned that {} is on port {} ({} entries)".
             format(mac, port, len(self.macports)))
+      self.raiseEvent(HostTableChanged, mac, port=port)
 
   def learn_ip(self, mac, ip):
     """Learns which IP-address a MAC-address is bound to."""
@@ -182,6 +194,7 @@ class BaselineController(object):
       self.macip[mac] = ip
       self.log.debug("Learned that MAC {} has IP address {}".format(
         mac, ip))
+      self.raiseEvent(HostTableChanged, mac, ip=ip)
 
   def add_forward_flow(self, from_mac, to_mac, forward_to_port):
     """Install flow table entry
@@ -6,6 +6,7 @@ Contains a Paxos OpenFlow controller.
 See the thesis for details.
 """
 
+import collections
 import os
 import random
 import threading
@@ -21,7 +22,18 @@ import pox.lib.packet as pkt
 import pox.openflow.libopenflow_01 as of
 
 from baseline import BaselineController
-from paxos.message import PaxosMessage
+from paxos.limits import (CATCHUP_HISTORY, CATCHUP_MAX_DELAY,
+                          CATCHUP_MESSAGES, CLIENT_FRAGMENTS, GC_CHUNK,
+                          RESEND_SLOTS, SLOT_WINDOW, UINT16_MAX, UINT32_MAX)
+from paxos.message import (CAP_BATCH, CAP_ZLIB, ENABLE_ZLIB, ETHERTYPE_FORMAT,
+                           MAX_ACCEPT_VALUE, MAX_BATCH_BYTES,
+                           MAX_BATCHED_VALUE, MAX_CATCHUP_COUNT, MAX_PAYLOAD,
+                           MAX_RANGE_COUNT, PROMISE_NACK, PaxosMessage,
+                           ZLIB_THRESHOLD, as_bytes)
+from paxos.rewrite import FrameTemplate
+from paxos.wal import (DURABILITY_FSYNC, DURABILITY_LEVELS, RECORD_ACCEPT,
+                       RECORD_DELIVERED, AcceptorLog, read_records,
+                       read_snapshot, write_snapshot)
 
 
 def ethtype_to_str(etype):
@@ -31,34 +43,242 @@ def ethtype_to_str(etype):
   else:
     return _ethtype_to_str(etype)
 
+def learn_ranges(seqnos, max_count=MAX_RANGE_COUNT):
+  """Splits the sorted list seqnos into (base, count, bitmap) tuples for
+  LEARN_RANGE messages, each spanning at most max_count slots.  The bitmap
+  is None when the range has no holes."""
+  ranges = []
+  i = 0
+  while i < len(seqnos):
+    base = seqnos[i]
+    bitmap = 0
+    j = i
+    while j < len(seqnos) and seqnos[j] - base < max_count:
+      bitmap |= 1 << (seqnos[j] - base)
+      j += 1
+    count = seqnos[j-1] - base + 1
+    if count == j - i:
+      bitmap = None
+    ranges.append((base, count, bitmap))
+    i = j
+  return ranges
+
+def catchup_messages(n, entries, max_messages=CATCHUP_MESSAGES):
+  """Packs delivered (seqno, value)s from round n into CATCHUP messages,
+  as many values as fit in each, and splits values too large for one into
+  CATCHUP_FRAGs.  Stops before going over max_messages, except that the
+  first value is always sent in full.
+
+  Returns:
+    List of (Paxos type, payload) tuples.
+  """
+  empty = PaxosMessage.accept_batch_size([])
+  messages = []
+  batch = []
+  size = empty
+  for seqno, value in entries:
+    entry_size = PaxosMessage.accept_batch_size([value]) - empty
+    if len(batch) > 0 and size + entry_size > MAX_PAYLOAD:
+      messages.append((PaxosMessage.CATCHUP,
+                       PaxosMessage.pack_accept_batch(n, batch)))
+      batch = []
+      size = empty
+
+    if empty + entry_size <= MAX_PAYLOAD:
+      if len(messages) >= max_messages:
+        break
+      batch.append((seqno, value))
+      size += entry_size
+      continue
+
+    fragments = PaxosMessage.pack_accept_fragments(n, seqno, value)
+    if len(messages) > 0 and len(messages) + len(fragments) > max_messages:
+      break
+    messages.extend((PaxosMessage.CATCHUP_FRAG, fragment)
+                    for fragment in fragments)
+
+  if len(batch) > 0:
+    messages.append((PaxosMessage.CATCHUP,
+                     PaxosMessage.pack_accept_batch(n, batch)))
+  return messages
+
+# Destination classes of Paxos frames
+DST_SELF = 0      # Addressed to us
+DST_BROADCAST = 1 # Ethernet broadcast
+DST_WAN = 2       # Neither, but it came in on a WAN port
+DST_OTHER = 3     # Someone else's
+
+ETHER_HEADER_SIZE = 14
+ETHER_BROADCAST_RAW = "\xff"*6
+
+class PacketClassifier(object):
+  """Maps raw Paxos frames straight to their handlers by ethertype and
+  destination class, without parsing them with the packet library."""
+  def __init__(self, mac, handlers, is_wan_port):
+    """Builds the classifier.
+
+    Arguments:
+      mac -- Our MAC address in raw wire-format.
+      handlers -- Dict of Paxos ethertype to handler.
+      is_wan_port -- Function telling if a port is on the WAN-side.
+    """
+    self.mac = mac
+    self.is_wan_port = is_wan_port
+
+    # We react on messages from the WAN, to us or broadcasts.  JOINs are
+    # handled no matter who they're for.
+    self.table = {}
+    for paxos_type, handler in handlers.items():
+      for dst_class in (DST_SELF, DST_BROADCAST, DST_WAN):
+        self.table[(paxos_type, dst_class)] = handler
+    self.table[(PaxosMessage.JOIN, DST_OTHER)] = handlers[PaxosMessage.JOIN]
+
+  def classify(self, port, data):
+    """Returns (ethertype, destination class, handler) for a raw Ethernet
+    frame that came in on port.  The handler is None for frames we don't
+    handle."""
+    paxos_type = ETHERTYPE_FORMAT.unpack_from(data, 12)[0]
+    if (paxos_type & 0xFF00) != 0x7A00:
+      return paxos_type, None, None
+
+    dst = data[0:6]
+    if dst == self.mac:
+      dst_class = DST_SELF
+    elif dst == ETHER_BROADCAST_RAW:
+      dst_class = DST_BROADCAST
+    elif self.is_wan_port(port):
+      dst_class = DST_WAN
+    else:
+      dst_class = DST_OTHER
+
+    return paxos_type, dst_class, self.table.get((paxos_type, dst_class))
+
+class HostIndex(object):
+  """Keeps track of the hosts on our switch ports, as (MAC, IP, port)s,
+  updated as addresses are learned instead of being looked up for each
+  delivered value."""
+  def __init__(self):
+    self.macs = {}        # Port to set of MAC-addresses seen on it
+    self.ips = {}         # MAC-address to IP-address
+    self.excluded = set() # Ports that don't have hosts on them
+    self.hosts = {}       # Port to (MAC, IP) of its host
+    self.entries = []     # The hosts as (MAC, IP, port)s, for delivery
+
+  def learn_port(self, mac, port):
+    """Registers that mac is on port."""
+    self.macs.setdefault(port, set()).add(mac)
+    self._update(port)
+
+  def learn_ip(self, mac, ip):
+    """Registers that mac has the given IP-address."""
+    self.ips[mac] = ip
+    for port, macs in self.macs.items():
+      if mac in macs:
+        self._update(port)
+
+  def exclude(self, port):
+    """Registers that there are no hosts on port, e.g. because it leads
+    to another Paxos node."""
+    self.excluded.add(port)
+    self._update(port)
+
+  def _update(self, port):
+    # A host is the only MAC on a port, and we must know its IP
+    host = None
+    macs = self.macs.get(port, ())
+    if port not in self.excluded and port <= 65000 and len(macs) == 1:
+      mac = next(iter(macs))
+      if mac in self.ips:
+        host = (mac, self.ips[mac])
+
+    if self.hosts.get(port) == host:
+      return
+    if host is None:
+      del self.hosts[port]
+    else:
+      self.hosts[port] = host
+
+    # Readers may be in other threads, so the list is replaced, not changed
+    self.entries = [(host_mac, host_ip, host_port)
+                    for (host_port, (host_mac, host_ip)) in
+                    sorted(self.hosts.items())]
+
+  def __len__(self):
+    return len(self.hosts)
+
+def popcount(n):
+  """Returns number of bits set in n."""
+  return bin(n).count("1")
+
 class Slot(object):
   """A Paxos slot."""
-  def __init__(self, vrnd, vval, node_count):
+  # There can be many thousands of slots in flight, so they don't get an
+  # instance dict.
+  __slots__ = ("seqno", "vrnd", "vval", "learns", "hrnd", "node_count")
+
+  def __init__(self, vrnd, vval, node_count, seqno=None):
+    self.seqno = seqno
+
     # Acceptor
     self.vrnd = vrnd
     self.vval = vval
 
     # Learner
-    self.learns = set()
+    self.learns = 0 # bitmask of node bits we've got learns from
     self.hrnd = 0 # highest round we received learn on
 
     self.node_count = node_count
 
   def __str__(self):
-    return "<Slot: vrnd={} |vval|={} hrnd={} learns={} nodes={}>".format(
-      self.vrnd, len(self.vval), self.hrnd, self.learns, self.node_count)
+    return "<Slot: seqno={} vrnd={} |vval|={} hrnd={} learns={:#x} nodes={}>".format(
+      self.seqno, self.vrnd, len(self.vval), self.hrnd, self.learns,
+      self.node_count)
 
   def reset_learns(self):
-    self.learns = set()
+    self.learns = 0
 
   @property
   def votes(self):
     """Returns number of unique learns we have gotten."""
-    return len(self.learns)
+    return popcount(self.learns)
+
+  def update_learns(self, bit):
+    """Add a node's bit to the learns."""
+    self.learns |= bit
+
+  def learn(self, n, src):
+    """Registers a LEARN in round n from the node with bit src (see
+    PaxosState.node_bit).  Returns True if it was a new vote."""
+    if self.learned or n < self.hrnd:
+      return False
+
+    # Initialize slot
+    if n > self.hrnd:
+      self.hrnd = n
+      self.reset_learns()
 
-  def update_learns(self, obj):
-    """Add a (unique) object to set of learns."""
-    self.learns.update([obj])
+    # Already got one learn from this src with same round?
+    if self.learns & src:
+      return False
+
+    self.update_learns(src)
+    return True
+
+  def decide(self, n, value):
+    """Marks value as chosen, as told in round n by a node that has
+    delivered it."""
+    self.vval = value
+    self.hrnd = max(self.hrnd, n)
+    self.vrnd = self.hrnd
+    self.learns = (1 << self.node_count) - 1
+
+  @property
+  def ready(self):
+    """Checks if the slot can be delivered: it's learned, and we have the
+    value chosen.  Any vote in the learned round or a later one is for the
+    chosen value, since new leaders re-propose the values they find."""
+    return (self.learned and self.vval is not None and
+            (self.vrnd is None or self.vrnd >= self.hrnd))
 
   @property
   def required_learns(self):
@@ -73,54 +293,172 @@ class Slot(object):
 
 
 class Slots(object):
-  """Contains many Slots."""
-  def __init__(self, node_count=None):
-    self.slots = {} # NOTE: Should be a heap or pri-queue
+  """Contains the window of Slots from the next one to deliver and
+  capacity slots on, in a ring buffer indexed by seqno."""
+  def __init__(self, node_count=None, capacity=SLOT_WINDOW,
+               history=CATCHUP_HISTORY):
+    self.capacity = capacity
+    self.ring = [None]*capacity
     self._node_count = node_count
-    self._cseq = 0
-    self.processed = set() # TODO: do we need this?
+    self._cseq = 0 # Next slot to deliver; the low watermark of the window
+    self._hseq = -1 # Highest learned slot
+
+    # The last delivered (seqno, value)s, in a ring buffer indexed by
+    # seqno, so we can help lagging nodes catch up.  We never had the values
+    # of slots below _oldest.
+    self.history = [None]*history
+    self._oldest = 0
+
+    # Values arriving in ACCEPT_FRAGs are reassembled here, keyed by seqno,
+    # before they go into a slot.
+    self.fragments = {}
 
     # We're going to pump postponed messages in a thread, so we need a mutex
     # for it.
     self.queue_mutex = threading.Lock()
 
-  def queue(self, n):
+  def take_ready(self):
     """
-    Starting from the current sequence number, return tuples of (seqno,
-    slot) for processing.  Stop whenever there is a gap in sequence numbers.
+    Starting from the current sequence number, takes all slots that are
+    learned and have a value, stopping at the first gap.  The slots are
+    evicted and counted as delivered.
+
+    Returns:
+      List of (seqno, value) tuples, in order.
     """
     self.queue_mutex.acquire()
     try:
-      # Increase cseq by one and stop whenever there is a gap
-      while self._cseq in self.slots:
-        assert(not self.is_processed(n, self._cseq))
-        slot = self.slots[self._cseq]
-
-        # All slots must be learned
-        if not slot.learned:
-          return
+      ready = []
+      while True:
+        slot = self._lookup(self._cseq)
+        if not self._ready(slot):
+          return ready
 
-        yield self._cseq, self.slots[self._cseq]
+        ready.append((self._cseq, slot.vval))
+        self.history[self._cseq % len(self.history)] = (self._cseq, slot.vval)
 
-        # Advance to next
+        # Advance to next, evicting the delivered slot
+        self.ring[self._cseq % self.capacity] = None
+        self.fragments.pop(self._cseq, None)
         self._cseq += 1
     finally:
       self.queue_mutex.release()
 
-  def garbage_collect(self, n, log=None):
-    """Remove slots we don't need anymore."""
-    # Aqcuire a lock on the queue, since we will garbage collect in the
-    # background
+  def garbage_collect(self, n, log=None, chunk=GC_CHUNK):
+    """Sweeps the window for slots we don't need anymore.
+
+    Slots are evicted as they are delivered, so this is only a safety net.
+    It holds the queue mutex for at most chunk slots at a time, so it
+    doesn't stall the ACCEPTs and LEARNs coming in meanwhile.
+    """
+    evicted = 0
+    for start in xrange(0, self.capacity, chunk):
+      self.queue_mutex.acquire()
+      try:
+        for index in xrange(start, min(start + chunk, self.capacity)):
+          slot = self.ring[index]
+          if slot is not None and self.is_processed(slot.seqno):
+            self.ring[index] = None
+            evicted += 1
+      finally:
+        self.queue_mutex.release()
+
+    if evicted > 0 and log is not None:
+      log.debug("Evicted %d finished slots for n=%d" % (evicted, n))
+    return evicted
+
+  @property
+  def cseq(self):
+    """Returns the next slot to deliver."""
+    return self._cseq
+
+  @property
+  def oldest(self):
+    """Returns the oldest delivered slot we may still remember the value
+    of."""
+    return max(self._oldest, self._cseq - len(self.history))
+
+  def stalled(self):
+    """Checks if delivery could be held back by a gap, i.e. if there are
+    learned slots we haven't delivered."""
+    return self._hseq >= self._cseq
+
+  def gap(self, max_count=MAX_CATCHUP_COUNT):
+    """Returns (base, count) of the slots holding back delivery of learned
+    slots above them, or None if there is no such gap."""
+    self.queue_mutex.acquire()
+    try:
+      base = self._cseq
+      end = min(self._hseq + 1, base + max_count)
+      count = 0
+      while base + count < end and not self._ready(self._lookup(base + count)):
+        count += 1
+
+      if count == 0:
+        return None
+      return base, count
+    finally:
+      self.queue_mutex.release()
+
+  def _ready(self, slot):
+    return slot is not None and slot.ready
+
+  def mark_learned(self, seqno):
+    """Notes that slots up to seqno have been learned by others, so we
+    look for the values if we don't have them."""
+    self.queue_mutex.acquire()
+    try:
+      self._hseq = max(self._hseq, seqno)
+    finally:
+      self.queue_mutex.release()
+
+  def accepted(self, base):
+    """Returns our votes for the slots from base on that we haven't
+    delivered, as a list of (seqno, round, value), and one past the highest
+    slot we've voted for or learned."""
+    self.queue_mutex.acquire()
+    try:
+      votes = []
+      end = self._hseq + 1
+      for slot in self.ring:
+        if (slot is not None and slot.vrnd is not None and
+            slot.vval is not None and slot.seqno >= base):
+          votes.append((slot.seqno, slot.vrnd, slot.vval))
+          end = max(end, slot.seqno + 1)
+      votes.sort()
+      return votes, end
+    finally:
+      self.queue_mutex.release()
+
+  def delivered(self, base, count):
+    """Returns the (seqno, value)s we still remember of the count delivered
+    slots starting at base, stopping at the first one we don't."""
+    self.queue_mutex.acquire()
+    try:
+      entries = []
+      for seqno in xrange(base, base + count):
+        entry = self.history[seqno % len(self.history)]
+        if entry is None or entry[0] != seqno:
+          break
+        entries.append(entry)
+      return entries
+    finally:
+      self.queue_mutex.release()
+
+  def fill(self, n, entries):
+    """Fills in the chosen values for slots, as (seqno, value)s sent by a
+    node in round n.  Returns the number of slots filled in."""
     self.queue_mutex.acquire()
     try:
-      evicted = 0
-      total = len(self.slots)
-      for (seqno, slot) in self.slots.items():
-        if self.is_processed(n, seqno): # could also do n > slot.hrnd
-          del self.slots[seqno]
-          evicted += 1
-      if evicted > 0 and log is not None:
-        log.debug("Evicted %d/%d finished slots for n=%d" % (evicted, total, n))
+      filled = 0
+      for seqno, value in entries:
+        slot = self._get_slot(seqno)
+        if slot is None or self._ready(slot):
+          continue
+        slot.decide(n, value)
+        self._hseq = max(self._hseq, seqno)
+        filled += 1
+      return filled
     finally:
       self.queue_mutex.release()
 
@@ -129,71 +467,195 @@ class Slots(object):
     self.queue_mutex.acquire()
     try:
       self._node_count = node_count
-      for slot in self.slots:
-        slot.node_count = self._node_count
+      for slot in self.ring:
+        if slot is not None:
+          slot.node_count = self._node_count
     finally:
       self.queue_mutex.release()
 
+  def in_window(self, seqno):
+    """Checks if seqno is in the window of slots we keep track of."""
+    return self._cseq <= seqno < self._cseq + self.capacity
+
   def get_slot(self, seqno):
-    """Get given slot, or return a new one."""
+    """Get given slot, or return a new one.  Returns None if seqno is
+    outside the window."""
     self.queue_mutex.acquire()
     try:
-      if not seqno in self.slots:
-        self.slots[seqno] = Slot(None, None, self._node_count)
-      return self.slots[seqno]
+      return self._get_slot(seqno)
     finally:
       self.queue_mutex.release()
 
-  def set_processed(self, n, seqno):
+  def _lookup(self, seqno):
+    """Returns the slot for seqno if we have it, otherwise None."""
     assert(self.queue_mutex.locked())
-    self.processed.update([(n, seqno)])
+    slot = self.ring[seqno % self.capacity]
+    if slot is not None and slot.seqno == seqno:
+      return slot
+    return None
 
-  def is_processed(self, n, seqno):
+  def _get_slot(self, seqno):
     assert(self.queue_mutex.locked())
-    return (n, seqno) in self.processed
+    if not self.in_window(seqno):
+      return None
+
+    # Whatever else is in this entry has been delivered already
+    index = seqno % self.capacity
+    slot = self.ring[index]
+    if slot is None or slot.seqno != seqno:
+      slot = Slot(None, None, self._node_count, seqno)
+      self.ring[index] = slot
+    return slot
+
+  def set_watermark(self, cseq):
+    """Starts the window at cseq, as if all slots below it have been
+    delivered."""
+    self.queue_mutex.acquire()
+    try:
+      self._cseq = cseq
+      self._hseq = cseq - 1
+      self._oldest = cseq
+      self.ring = [None]*self.capacity
+      self.fragments = {}
+    finally:
+      self.queue_mutex.release()
+
+  def skip_to(self, seqno):
+    """Gives up on the slots below seqno, as if they had been delivered,
+    keeping the ones above.  Returns the number of slots skipped."""
+    self.queue_mutex.acquire()
+    try:
+      if seqno <= self._cseq:
+        return 0
+
+      skipped = seqno - self._cseq
+      for s in xrange(self._cseq, min(seqno, self._cseq + self.capacity)):
+        if self._lookup(s) is not None:
+          self.ring[s % self.capacity] = None
+      for s in [s for s in self.fragments if s < seqno]:
+        del self.fragments[s]
+
+      self._cseq = seqno
+      self._hseq = max(self._hseq, seqno - 1)
+      self._oldest = seqno
+      return skipped
+    finally:
+      self.queue_mutex.release()
+
+  def restore(self, n, seqno, value):
+    """Restores our vote for value in round n from the acceptor log."""
+    self.queue_mutex.acquire()
+    try:
+      slot = self._get_slot(seqno)
+      if slot is not None and (slot.vrnd is None or n >= slot.vrnd):
+        slot.vrnd = n
+        slot.vval = value
+    finally:
+      self.queue_mutex.release()
+
+  def update_learns(self, n, src, seqnos):
+    """Registers LEARNs from the node with bit src in round n for all the
+    given slots, taking the queue mutex only once.  Returns the number of
+    new votes."""
+    self.queue_mutex.acquire()
+    try:
+      votes = 0
+      for seqno in seqnos:
+        slot = self._get_slot(seqno)
+        if slot is not None and slot.learn(n, src):
+          votes += 1
+          if slot.learned:
+            self._hseq = max(self._hseq, seqno)
+      return votes
+    finally:
+      self.queue_mutex.release()
+
+  def add_fragment(self, n, seqno, index, total, chunk):
+    """Adds part of the value for a slot in round n.  Returns the whole
+    value once all fragments have arrived, otherwise None."""
+    self.queue_mutex.acquire()
+    try:
+      if not self.in_window(seqno):
+        return None
+
+      rnd, chunks = self.fragments.get(seqno, (None, None))
+      if rnd is not None and n < rnd:
+        return None
+
+      # Fragments from a newer round replace any older ones
+      if rnd != n or len(chunks) != total:
+        chunks = [None]*total
+        self.fragments[seqno] = (n, chunks)
+
+      chunks[index] = chunk.tobytes()
+      if None in chunks:
+        return None
+
+      del self.fragments[seqno]
+      return "".join(chunks)
+    finally:
+      self.queue_mutex.release()
+
+  def is_processed(self, seqno):
+    """Checks if the slot has been delivered."""
+    return seqno < self._cseq
 
 
 class PaxosState(object):
   """Contains state for a Paxos instance that inhibits all roles."""
-  def __init__(self, n_id):
+  def __init__(self, n_id, history=CATCHUP_HISTORY):
     """Initializes Paxos state.
 
     Attributes:
       n_id -- Unique node id
+      history -- Number of delivered values to remember for catch-up
       N -- Node ids of ALL Paxos nodes (including ourself)
+      capabilities -- CAP_* bits announced by each node in N
+      node_bits -- Each node in N mapped to its bit in vote bitmasks
       crnd -- Current round number
     """
     assert(isinstance(n_id, int))
 
     self.n_id = n_id      # Our unique ID
     self.N = set()        # Ethernet addresses of ALL Paxos nodes
+    self.capabilities = {}
+    self.node_bits = {}
     self.crnd = self.n_id # Current round number
 
     # Contains PaxosSlots
-    self.slots = Slots(len(self.N))
-
-  def next_round(self):
-    """Initializes a new round."""
-    self.pickNext()
-    self.slots.update_node_count(len(self.N))
+    self.slots = Slots(len(self.N), history=history)
 
   def pickNext(self):
-    """Picks and sets the next current round number (crnd)."""
+    """Returns our next round number: the lowest one above crnd that is
+    ours, i.e. equal to our n_id modulo the number of nodes."""
     assert(len(self.N) > 0)
-    self.crnd += len(self.N)
-    return self.crnd
+    n = self.crnd + 1
+    return n + (self.n_id - n) % len(self.N)
 
-  def add_node(self, node):
+  def add_node(self, node, capabilities=0):
     """Adds a node to the set of known Paxos nodes."""
     self.N.update([node])
+    self.capabilities[node] = capabilities
+    if node not in self.node_bits:
+      self.node_bits[node] = 1 << len(self.node_bits)
     self.slots.update_node_count(len(self.N))
 
-  def ordered_nodes(self, last_node):
-    """Returns a set of Paxos nodes, last_node last."""
-    v = sorted(list(self.N))
-    v.remove(last_node)
-    v.append(last_node)
-    return v
+  def node_bit(self, node):
+    """Returns the node's bit in vote bitmasks, or 0 for unknown nodes."""
+    return self.node_bits.get(node, 0)
+
+  def all_capable(self, capability):
+    """Returns True if all known nodes announced the given capability."""
+    return len(self.N) > 0 and all(self.capabilities[node] & capability
+                                   for node in self.N)
+
+  def fanout_plan(self, last_node, macports):
+    """Returns the Paxos nodes as (MAC, port)s to send messages to, sorted
+    with last_node last.  Nodes not in macports get port None."""
+    v = sorted(node for node in self.N if node != last_node)
+    if last_node in self.N:
+      v.append(last_node)
+    return [(mac, macports.get(mac)) for mac in v]
 
   @property
   def node_count(self):
@@ -207,9 +669,33 @@ class PaxosState(object):
 
 class Leader(object):
   """Contains values needed for leader."""
-  def __init__(self):
+  def __init__(self, max_batch_size=MAX_PAYLOAD, window=0, queue_limit=0,
+               n=None):
     self.seqno = None
 
+    # Our round.  Client values are held until phase 1 for it is done.
+    self.n = n
+    self.prepared = False
+
+    # At most window slots are in flight, i.e. handed out but not yet
+    # delivered by us.  Client values beyond that wait in pending, up to
+    # queue_limit of them, and the rest are shed.  A window of 0 means no
+    # limit.
+    self.window = window
+    self.queue_limit = queue_limit
+    self.pending = collections.deque()
+    self.shed = 0
+    self.paused = False # Whether we've asked the WAN to hold back clients
+
+    # The next slot to deliver when we last sent a heartbeat
+    self.heartbeat_cseq = None
+
+    # Pending (seqno, value) ACCEPTs, sent as one ACCEPT_BATCH
+    self.batch = []
+    self.batch_round = None
+    self.batch_size = PaxosMessage.accept_batch_size([])
+    self.max_batch_size = max_batch_size
+
   def next_seqno(self):
     if self.seqno is None:
       self.seqno = 0
@@ -217,6 +703,374 @@ class Leader(object):
       self.seqno += 1
     return self.seqno
 
+  def in_flight(self, cseq):
+    """Returns the number of slots handed out that are not yet delivered,
+    where cseq is the next slot to deliver."""
+    if self.seqno is None:
+      return 0
+    return max(0, self.seqno + 1 - cseq)
+
+  def window_full(self, cseq):
+    """Checks if no more slots can be handed out until cseq advances."""
+    return self.window > 0 and self.in_flight(cseq) >= self.window
+
+  def hold(self, value):
+    """Queues a client value until the window opens.  Returns False if the
+    queue is full, and the value was shed."""
+    if len(self.pending) >= self.queue_limit:
+      self.shed += 1
+      return False
+    self.pending.append(value)
+    return True
+
+  def fits_batch(self, value):
+    """Checks if value can be added to the pending batch."""
+    return (self.batch_size + PaxosMessage.accept_batch_size([value]) -
+            PaxosMessage.accept_batch_size([]) <= self.max_batch_size)
+
+  def add_to_batch(self, n, seqno, value):
+    """Adds a value to the pending batch for round n."""
+    assert(self.batch_round in (None, n))
+    self.batch_round = n
+    self.batch.append((seqno, value))
+    self.batch_size += (PaxosMessage.accept_batch_size([value]) -
+                        PaxosMessage.accept_batch_size([]))
+
+  def take_batch(self):
+    """Returns (n, entries) of the pending batch and clears it."""
+    n, entries = self.batch_round, self.batch
+    self.batch = []
+    self.batch_round = None
+    self.batch_size = PaxosMessage.accept_batch_size([])
+    return n, entries
+
+
+class Prepare(object):
+  """Collects the PROMISEs for phase 1 of round n, which a new leader runs
+  once for all slots from base on."""
+  def __init__(self, n, base, attempt, quorum):
+    self.n = n
+    self.base = base
+    self.attempt = attempt
+    self.quorum = quorum
+
+    self.counts = {}  # Node to number of PROMISE messages it sent
+    self.indexes = {} # Node to the indexes of the ones we've got
+    self.votes = {}   # (node, seqno) to (round, length, {offset: chunk})
+
+    # All slots below cseq have been delivered by someone, and nobody we
+    # heard from knows of any slot from end on.
+    self.cseq = base
+    self.cseq_node = None
+    self.end = base
+
+  def add(self, node, index, count, cseq, end, chunks):
+    """Adds the contents of PROMISE number index of count from node."""
+    self.counts[node] = count
+    self.indexes.setdefault(node, set()).add(index)
+    if cseq > self.cseq:
+      self.cseq = cseq
+      self.cseq_node = node
+    self.end = max(self.end, end)
+
+    for seqno, vrnd, length, offset, chunk in chunks:
+      vote = self.votes.setdefault((node, seqno), (vrnd, length, {}))
+      vote[2][offset] = chunk
+
+  def promised(self):
+    """Returns the nodes we've got all PROMISE messages from."""
+    return [node for node, indexes in self.indexes.items()
+            if len(indexes) == self.counts[node]]
+
+  @property
+  def done(self):
+    """Checks if a quorum of nodes has promised."""
+    return len(self.promised()) >= self.quorum
+
+  def values(self):
+    """Returns the value voted for in the highest round in each slot, by
+    the nodes that have promised, as {seqno: value}."""
+    promised = set(self.promised())
+    best = {}
+    for (node, seqno), (vrnd, length, chunks) in self.votes.items():
+      if node not in promised:
+        continue
+      if seqno in best and best[seqno][0] >= vrnd:
+        continue
+      value = "".join(chunks[offset] for offset in sorted(chunks))
+      assert(len(value) == length)
+      best[seqno] = (vrnd, value)
+    return dict((seqno, value) for seqno, (vrnd, value) in best.items())
+
+
+class ClientFragments(object):
+  """Reassembles client frames that arrive split over CLIENT_FRAGs, and
+  catch-up values split over CATCHUP_FRAGs.  At most capacity frames are
+  kept waiting for their other fragments; the oldest one is dropped to make
+  room for a new one."""
+  def __init__(self, capacity=CLIENT_FRAGMENTS):
+    self.capacity = capacity
+    self.partial = collections.OrderedDict() # Key to chunks of the frame
+    self.dropped = 0
+
+  def add(self, key, index, total, chunk):
+    """Adds fragment index of total for the frame with the given key.
+    Returns the whole frame once all fragments have arrived, otherwise
+    None."""
+    chunks = self.partial.get(key)
+    if chunks is None or len(chunks) != total:
+      chunks = [None]*total
+      self.partial[key] = chunks
+      while len(self.partial) > self.capacity:
+        self.partial.popitem(last=False)
+        self.dropped += 1
+
+    chunks[index] = as_bytes(chunk)
+    if None in chunks:
+      return None
+
+    del self.partial[key]
+    return "".join(chunks)
+
+class ClientBatcher(object):
+  """Collects client values on the leader, to be committed together in one
+  slot.  A batch is sealed when it has max_values values or max_bytes
+  bytes, or delay seconds after its first value, whichever comes first.
+  The limits can be changed at any time with tune, which
+  PaxosControllers.tune_client_batch does for a running controller."""
+  def __init__(self, max_values=16, max_bytes=MAX_BATCH_BYTES,
+               delay=0.0002):
+    self.max_values = max_values
+    self.max_bytes = max_bytes
+    self.delay = delay
+
+    self.values = []
+    self.size = 0
+    self.generation = 0 # Tells timers for sealed batches from current ones
+
+    # Fill statistics of sealed batches
+    self.batches = 0
+    self.batched_values = 0
+    self.batched_bytes = 0
+    self.sealed_by = collections.Counter()  # Reason to number of batches
+    self.fill = collections.Counter()       # Values per batch to batches
+
+  def tune(self, max_values=None, max_bytes=None, delay=None):
+    """Changes the limits for sealing batches.  Limits given as None are
+    left alone."""
+    if max_values is not None:
+      assert(max_values > 0)
+      self.max_values = max_values
+    if max_bytes is not None:
+      assert(max_bytes > 0)
+      self.max_bytes = max_bytes
+    if delay is not None:
+      assert(delay >= 0)
+      self.delay = delay
+
+  def fits(self, value):
+    """Checks if value can be added to the batch without going over
+    max_bytes.  Any value fits in an empty batch."""
+    return (not self.values or self.size +
+            PaxosMessage.batched_size(value) <= self.max_bytes)
+
+  def add(self, value):
+    """Adds a value to the batch.  Returns the reason it should be sealed
+    now, or None."""
+    self.values.append(value)
+    self.size += PaxosMessage.batched_size(value)
+    if len(self.values) >= self.max_values:
+      return "values"
+    if self.size >= self.max_bytes:
+      return "bytes"
+    return None
+
+  def clear(self):
+    """Drops the values of the batch."""
+    self.values = []
+    self.size = 0
+    self.generation += 1
+
+  def take(self, reason):
+    """Returns the values of the batch, sealed for the given reason, and
+    starts a new one."""
+    values = self.values
+    self.batches += 1
+    self.batched_values += len(values)
+    self.batched_bytes += self.size
+    self.sealed_by[reason] += 1
+    self.fill[len(values)] += 1
+
+    self.values = []
+    self.size = 0
+    self.generation += 1
+    return values
+
+  def stats(self):
+    """Returns fill statistics of the batches sealed so far."""
+    batches = max(1, self.batches)
+    return {"batches": self.batches,
+            "values": self.batched_values,
+            "bytes": self.batched_bytes,
+            "values_per_batch": float(self.batched_values) / batches,
+            "bytes_fill": (float(self.batched_bytes) / batches /
+                           self.max_bytes),
+            "sealed_by": dict(self.sealed_by),
+            "fill": dict(self.fill)}
+
+
+class Applier(object):
+  """Delivers committed values in order in its own thread, so that
+  handling of ACCEPTs and LEARNs never waits on sending to hosts."""
+  def __init__(self, apply, log, retry_delay=1.0):
+    """Starts the applier thread.
+
+    Arguments:
+      apply -- Function (n, seqno, value) delivering one value.  If it
+               returns False, the same value is tried again after
+               retry_delay seconds, or when kicked.  If it raises, the
+               error is logged to log and the value skipped.
+    """
+    self.apply = apply
+    self.log = log
+    self.retry_delay = retry_delay
+    self.pending = collections.deque()
+    self.kicked = False
+    self.cond = threading.Condition()
+
+    self.thread = threading.Thread(target=self.run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def submit(self, n, entries):
+    """Queues (seqno, value) entries from round n for delivery."""
+    self.cond.acquire()
+    try:
+      self.pending.extend((n, seqno, v) for (seqno, v) in entries)
+      self.cond.notify()
+    finally:
+      self.cond.release()
+
+  def kick(self):
+    """Retries a postponed delivery right away."""
+    self.cond.acquire()
+    try:
+      self.kicked = True
+      self.cond.notify()
+    finally:
+      self.cond.release()
+
+  @property
+  def backlog(self):
+    """Returns number of values waiting to be delivered."""
+    return len(self.pending)
+
+  def run(self):
+    while True:
+      self.cond.acquire()
+      try:
+        while len(self.pending) == 0:
+          self.cond.wait()
+        n, seqno, v = self.pending[0]
+        self.kicked = False
+      finally:
+        self.cond.release()
+
+      try:
+        delivered = self.apply(n, seqno, v)
+      except Exception:
+        # Trying again would most likely fail the same way, and hold back
+        # every value after this one
+        self.log.exception("Failed to deliver seqno={}, skipping".format(
+                           seqno))
+        delivered = True
+
+      self.cond.acquire()
+      try:
+        if delivered:
+          self.pending.popleft()
+        elif not self.kicked:
+          self.cond.wait(self.retry_delay)
+      finally:
+        self.cond.release()
+
+
+class OutboundQueue(object):
+  """Collects the OpenFlow messages for a switch connection, so that those
+  made while handling one event go out in a single write."""
+  def __init__(self, connection, coalesce=True, flush_delay=0):
+    """Sets up the queue.
+
+    Arguments:
+      connection -- The switch connection to write to.
+      coalesce -- If False, each message is written by itself.
+      flush_delay -- Messages sent outside of begin() and end() are written
+                     at most this many seconds later, along with any others
+                     sent meanwhile.  If zero, they're written right away.
+    """
+    self.connection = connection
+    self.coalesce = coalesce
+    self.flush_delay = flush_delay
+    self.mutex = threading.Lock()
+    self.pending = []
+    self.flush_scheduled = False
+    self.local = threading.local() # Nesting of begin() per thread
+
+    # Statistics
+    self.messages = 0
+    self.writes = 0
+
+  def begin(self):
+    """Holds back messages sent by this thread until the matching end()."""
+    self.local.depth = getattr(self.local, "depth", 0) + 1
+
+  def end(self):
+    """Writes all held back messages at the outermost end()."""
+    self.local.depth -= 1
+    if self.local.depth == 0:
+      self.flush()
+
+  def send(self, message):
+    """Queues an OpenFlow message, or the raw bytes of one."""
+    if not self.coalesce:
+      self.messages += 1
+      self.writes += 1
+      return self.connection.send(message)
+
+    if not isinstance(message, bytes):
+      message = message.pack()
+
+    self.mutex.acquire()
+    try:
+      self.pending.append(message)
+      self.messages += 1
+      if getattr(self.local, "depth", 0) > 0 or self.flush_scheduled:
+        return
+      if self.flush_delay > 0:
+        self.flush_scheduled = True
+        core.callDelayed(self.flush_delay, self.flush)
+        return
+    finally:
+      self.mutex.release()
+
+    self.flush()
+
+  def flush(self):
+    """Writes all queued messages at once."""
+    self.mutex.acquire()
+    try:
+      self.flush_scheduled = False
+      if len(self.pending) == 0:
+        return
+      data = "".join(self.pending)
+      self.pending = []
+      self.writes += 1
+      # Written while holding the mutex, so writes from different threads
+      # keep their order.
+      self.connection.send(data)
+    finally:
+      self.mutex.release()
+
 
 class WANController(object):
   """We want a special controller for the WAN switch, which is the one
@@ -251,6 +1105,15 @@ class WANController(object):
     self.paxos_port = None
     self.wan_macports = {} # MAC->Port for WAN-side
 
+    # When the leader's window is full, it asks us to drop client packets
+    # until it resumes us, or for at most the hold time it gives.
+    self.paused_until = 0
+    self.shed = 0
+
+    # Client frames too large for one CLIENT are sent in CLIENT_FRAGs, with
+    # an id the leader reassembles them by.
+    self.frame_id = random.randint(0, UINT32_MAX)
+
   def forward(self, packet_in, port):
      """Instructs switch to forward the packet to the given port."""
      msg = of.ofp_packet_out()
@@ -306,6 +1169,9 @@ class WANController(object):
       self.log.debug("Learned that Paxos network is on port {}".
           format(self.paxos_port))
 
+    if eth.type == PaxosMessage.FLOW_CONTROL:
+      return self.on_flow_control(event)
+
     # Learn which ports WAN nodes are on
     if self.paxos_port is not None:                # We know the Paxos port,
       if not PaxosMessage.is_paxos_type(eth.type): # it's not a Paxos msg,
@@ -396,25 +1262,44 @@ class WANController(object):
                        payload=payload,
                        output_port=of.OFPP_ALL)
 
+  def on_flow_control(self, event):
+    """Pauses or resumes forwarding of client packets, as the leader asks."""
+    pause, hold = PaxosMessage.unpack_flow_control(
+        event.data[ETHER_HEADER_SIZE:])
+    if pause:
+      self.paused_until = time.time() + hold/1000.0
+      self.log.info("Leader is overloaded, pausing clients for {} ms".format(
+        hold))
+    else:
+      self.paused_until = 0
+      self.log.info("Leader resumed clients ({} packets dropped so far)".
+          format(self.shed))
+    return EventHalt
+
   def wrap_and_send_to_paxos(self, event):
     """Wrap in PAXOS CLIENT and send to Paxos network."""
     if self.paxos_port is None:
       self.log.warning("Don't know which port Paxos is on, drop.")
       return EventHalt
 
-    # Stamp message with type PAXOS CLIENT
-    eth = event.parsed.find("ethernet")
-    eth.type = PaxosMessage.CLIENT
-    eth.payload = PaxosMessage.pack_client(eth.raw)
+    if self.paused_until > 0 and time.time() < self.paused_until:
+      self.shed += 1
+      self.log.debug("Clients are paused, drop.")
+      return EventHalt
 
-    # Forward wrapped message to Paxos network
-    m = of.ofp_packet_out(data=eth)
-    m.actions.append(of.ofp_action_output(port=self.paxos_port))
+    # Stamp message with type PAXOS CLIENT, straight on the raw frame
+    self.frame_id = (self.frame_id + 1) & UINT32_MAX
+    frames = PaxosMessage.wrap_client_frame(event.ofp.data, self.frame_id)
 
-    self.log.info("Sending WAN CLIENT packet {}.{}->{} len={} and sent to Paxos.".format(
-            eth.src, event.port, eth.dst, len(eth.raw)))
+    # Forward wrapped message to Paxos network
+    for frame in frames:
+      m = of.ofp_packet_out(data=frame)
+      m.actions.append(of.ofp_action_output(port=self.paxos_port))
+      self.connection.send(m)
 
-    self.connection.send(m)
+    self.log.info("Sending WAN CLIENT packet {}.{}->{} len={} and sent to Paxos in {} frame(s).".format(
+            event.parsed.src, event.port, event.parsed.dst,
+            len(event.ofp.data), len(frames)))
     return EventHalt
 
   def port_name(self, port):
@@ -458,19 +1343,190 @@ class PaxosController(object):
                connection,
                priority=100,
                quit_on_connection_down=False,
-               add_flows=False):
+               add_flows=False,
+               batch_accepts=False,
+               batch_delay=0.001,
+               coalesce_learns=False,
+               learn_delay=0.001,
+               compress=ENABLE_ZLIB,
+               compress_threshold=ZLIB_THRESHOLD,
+               combine_accept_learn=False,
+               gc_sweep=False,
+               wal_path=None,
+               wal_durability=DURABILITY_FSYNC,
+               snapshot_interval=10000,
+               catchup=True,
+               catchup_delay=0.01,
+               catchup_skip=False,
+               coalesce_writes=False,
+               write_delay=0,
+               fanout_actions=False,
+               window=4096,
+               client_queue=4096,
+               pause_hold=1.0,
+               client_batch=False,
+               client_batch_values=16,
+               client_batch_bytes=MAX_BATCH_BYTES,
+               client_batch_delay=0.0002,
+               heartbeat_interval=0.1,
+               leader_timeout=1.0):
 
     # Set up attributes BEFORE listening to the network, otherwise we could
     # get in concurrency trouble.
     self.joined = False
     #
+    # One node at a time is trusted as leader.  When it takes over, it runs
+    # phase 1 (PREPARE and PROMISE) once for all slots in a round of its
+    # own, and then only phase 2.  It sends a TRUST every
+    # heartbeat_interval seconds, and if we hear none for leader_timeout
+    # seconds, we trust the next node in order instead.
+    self.leader = None  # Leader state, while we lead
+    self.prepare = None # Phase 1 in progress
+    self.prepare_attempt = 0
+    self.trusted = None
+    self.trusted_round = 0
+    self.last_heartbeat = 0
+    self.heartbeat_interval = heartbeat_interval
+    self.leader_timeout = leader_timeout
+    #
+    # With batch_accepts, the leader packs ACCEPTs for several slots into
+    # one ACCEPT_BATCH, sending it when the frame is full or after
+    # batch_delay seconds.
+    self.batch_accepts = batch_accepts
+    self.batch_delay = batch_delay
+    self.batch_mutex = threading.Lock()
+    #
+    # The leader has at most window slots in flight, queueing up to
+    # client_queue more values and dropping the rest.  While values are
+    # queued, the WAN controller is asked to pause clients for pause_hold
+    # seconds at a time, and resumed once half the window has drained.
+    self.window = window
+    self.client_queue = client_queue
+    self.pause_hold = pause_hold
+    self.pause_sent = 0
+    self.admit_scheduled = False
+    #
+    # With client_batch, the leader commits client values in batches, sealed
+    # when they have client_batch_values values or client_batch_bytes
+    # bytes, or after client_batch_delay seconds.  Only done when all nodes
+    # have announced CAP_BATCH.
+    self.client_batch = client_batch
+    self.client_fragments = ClientFragments()
+    self.client_batcher = ClientBatcher(client_batch_values,
+                                        client_batch_bytes,
+                                        client_batch_delay)
+    #
+    # With coalesce_learns, acceptors collect their votes and send them as
+    # LEARN_RANGEs covering all slots voted for during the last learn_delay
+    # seconds.
+    self.coalesce_learns = coalesce_learns
+    self.learn_delay = learn_delay
+    self.learn_mutex = threading.Lock()
+    self.pending_learns = []
+    self.pending_learns_round = None
+    #
+    # With compress, we announce CAP_ZLIB in our JOINs, since we can
+    # decompress values.  The leader only compresses values of at least
+    # compress_threshold bytes, and only when all nodes have announced
+    # CAP_ZLIB.
+    self.compress = compress
+    self.compress_threshold = compress_threshold
+    self.capabilities = CAP_BATCH | (CAP_ZLIB if compress else 0)
+    #
+    # The leader is an acceptor and learner too, so with
+    # combine_accept_learn it sends its vote along with the values in
+    # ACCEPT_LEARNs, saving the other nodes from waiting for its LEARNs.
+    self.combine_accept_learn = combine_accept_learn
+    #
+    # Slots are evicted as they're delivered.  The background sweep for
+    # leftovers is optional.
+    self.gc_sweep = gc_sweep
+    #
+    # With a write-ahead log, our votes are only sent once the records of
+    # them are durable.  They're committed in groups, once per event loop
+    # iteration.
+    self.wal = None
+    self.wal_mutex = threading.Lock()
+    self.wal_commit_scheduled = False
+    self.durable_learns = []
+    #
+    # With a write-ahead log, we also snapshot how far we've delivered
+    # every snapshot_interval slots, and drop older records from the log.
+    self.snapshot_interval = snapshot_interval
+    self.snapshot_path = None
+    #
+    # If delivery has been held back by the same gap for catchup_delay
+    # seconds, a lost ACCEPT or LEARN is assumed and we ask a peer for the
+    # missing values.  Values too large for one CATCHUP are reassembled
+    # from CATCHUP_FRAGs.  While the gap stays, we ask again, waiting twice
+    # as long each time up to CATCHUP_MAX_DELAY seconds.
+    self.catchup = catchup
+    #
+    # A peer that no longer remembers the missing values answers with a
+    # CATCHUP_SKIP.  Only with catchup_skip do we skip ahead; our hosts then
+    # never get the values of the skipped slots, so their state differs
+    # from that of the other nodes' hosts.  Otherwise we keep asking, as
+    # another peer may still remember the values.
+    self.catchup_skip = catchup_skip
+    self.catchup_delay = catchup_delay
+    self.catchup_wait = catchup_delay
+    self.catchup_scheduled = False
+    self.catchup_base = None
+    self.catchup_fragments = ClientFragments()
+    #
     # Note: Connection IDs may not be monotonic, but should be unique. We
     # can therefore use it as a node ID.
     self.quit_on_connection_down = quit_on_connection_down
     self.connection = connection
+    #
+    # With coalesce_writes, OpenFlow messages made while handling a
+    # packet-in, a timer or a delivery are written to the switch together.
+    # Messages sent by other threads are held back for at most write_delay
+    # seconds.
+    self.outbound = OutboundQueue(connection, coalesce_writes, write_delay)
+    #
+    # With fanout_actions, each delivered value is sent to the switch once,
+    # in a packet-out with actions setting the destination addresses and
+    # outputting the packet for each host in turn.  Otherwise, we rewrite
+    # the value and send one packet-out per host.
+    self.fanout_actions = fanout_actions
     self.paxos_ports = {}
     self.wan_port = None
+    #
+    # ACCEPTs and LEARNs go to all Paxos nodes, ourself last, through the
+    # fan-out plan of (MAC, port)s.  It is only computed again when nodes
+    # join or the switch learns where one is.
+    self.plan = []
     self.log = core.getLogger("PaxosCtrl-{} {}".format(self.name, self.mac))
+    #
+    # Committed values are delivered by the applier thread to our hosts,
+    # which are found in the host index.
+    self.host_index = HostIndex()
+    self.applier = Applier(self.apply, self.log)
+    #
+    # Message handlers, and a classifier for incoming frames, are set up
+    # once instead of for each packet.
+    self.dispatch_map = {
+        PaxosMessage.ACCEPT:             self.on_accept,
+        PaxosMessage.ACCEPT_BATCH:       self.on_accept_batch,
+        PaxosMessage.ACCEPT_FRAG:        self.on_accept_fragment,
+        PaxosMessage.ACCEPT_LEARN:       self.on_accept_learn,
+        PaxosMessage.ACCEPT_LEARN_BATCH: self.on_accept_learn_batch,
+        PaxosMessage.CATCHUP:            self.on_catchup,
+        PaxosMessage.CATCHUP_FRAG:       self.on_catchup_fragment,
+        PaxosMessage.CATCHUP_REQUEST:    self.on_catchup_request,
+        PaxosMessage.CATCHUP_SKIP:       self.on_catchup_skip,
+        PaxosMessage.CLIENT:             self.on_client,
+        PaxosMessage.CLIENT_FRAG:        self.on_client_fragment,
+        PaxosMessage.FLOW_CONTROL:       self.on_flow_control,
+        PaxosMessage.JOIN:               self.on_join,
+        PaxosMessage.LEARN:              self.on_learn,
+        PaxosMessage.LEARN_RANGE:        self.on_learn_range,
+        PaxosMessage.PREPARE:            self.on_prepare,
+        PaxosMessage.PROMISE:            self.on_promise,
+        PaxosMessage.TRUST:              self.on_trust}
+    self.classifier = PacketClassifier(self.mac.toRaw(), self.dispatch_map,
+                                       self.is_wan_port)
 
     self.log.info("{} controlling connection id {}, DPID {}".format(
       self.__class__.__name__, connection.ID, dpid_to_str(connection.dpid)))
@@ -488,7 +1544,18 @@ class PaxosController(object):
     self.connection.addListeners(self, priority=priority)
     self.connection.addListenerByName("ConnectionDown", self.connectionDown)
 
-    self.state = PaxosState(int(self.name[-1])) # NOTE: See self.name note
+    # We remember at least the values since our last snapshot, so a peer
+    # restarting from its own snapshot can catch up from us.
+    self.state = PaxosState(int(self.name[-1]), # NOTE: See self.name note
+                            history=max(CATCHUP_HISTORY, snapshot_interval))
+
+    if wal_path is not None:
+      wal_path = wal_path.format(name=self.name)
+      self.snapshot_path = wal_path + ".snapshot"
+      self.recover(wal_path)
+      self.wal = AcceptorLog(wal_path, wal_durability)
+      self.log.info("Logging votes to {} (durability {})".format(
+        wal_path, wal_durability))
 
     self.switch = BaselineController(connection,
         priority=50, # lower pri so we process first
@@ -499,31 +1566,31 @@ class PaxosController(object):
         learn_ip_addresses=True,
         clear_flows_on_startup=True)
 
+    # Our host index is kept up to date as the switch learns addresses.
+    # Deliveries postponed for lack of host addresses are retried as soon
+    # as we learn new ones, instead of waiting for the background thread.
+    self.switch.addListenerByName("HostTableChanged",
+                                  self.host_table_changed)
+
     # Start by broadcasting PAXOS JOIN to learn about all the other Paxos
     # nodes
     self.join_network()
 
-    # If we are leader, set the next round number so that it's bigger than
-    # the other ones.  Since join_network runs asynchronously (in its own
-    # thread), we have to wait until we have joined.
-    #
-    # The target here with pickNext is a hardcoded way to send ourself a
-    # TRUST message (see the thesis).  This could be sent from Mininet, but
-    # we should onl do it when we know all the other Paxos nodes.
-    #
-    who = self.name
-    if self.isleader():
-      who = "Leader"
+    # Once we know all the other Paxos nodes, we agree on who to trust as
+    # leader.  Since join_network runs asynchronously (in its own thread),
+    # we have to wait until we have joined.
     self.async_wait_joined(timeout=10, quit_on_timeout=True,
-                           who=who,
-                           target=self.next_round)
-
-  def next_round(self):
-    """Initiates a new round."""
-    if self.isleader():
-      if not hasattr(self, "leader"):
-        self.leader = Leader()
-      self.state.pickNext()
+                           target=self.elect_leader)
+
+  def elect_leader(self):
+    """Trusts the first of the Paxos nodes, in order, as leader, and starts
+    watching it."""
+    self.trusted = min(self.state.N)
+    self.last_heartbeat = time.time()
+    self.log.info("Trusting {} as leader".format(self.trusted))
+    if self.trusted == self.mac:
+      core.callLater(self.take_over)
+    core.callDelayed(self.leader_timeout/2, self.watch_leader)
 
     # Set up a thread to pump the queue every once in a while, in case we
     # have postponed packets (e.g., we don't know their MAC+IP addresses)
@@ -534,12 +1601,18 @@ class PaxosController(object):
 
   def background_proc_queue(self, sleep=5):
     """Pump queue for postponed items once in a while (yes, it's
-    thread-safe)."""
+    thread-safe).  Deliveries are retried when we learn host addresses, so
+    this is only a fallback."""
     self.log.debug("Will process queue in background every %d secs" % sleep)
     while True:
       time.sleep(sleep)
       self.process_queue(self.state.crnd)
-      self.state.slots.garbage_collect(self.state.crnd, self.log)
+      self.applier.kick()
+      if self.gc_sweep:
+        self.state.slots.garbage_collect(self.state.crnd, self.log)
+      if self.isleader() and self.client_batcher.batches > 0:
+        self.log.info("Client batches: {}".format(
+          self.client_batcher.stats()))
 
   def async_wait_joined(self,
                        timeout=10,
@@ -580,12 +1653,8 @@ class PaxosController(object):
 
       # Run target if we did not time out
       if self.joined:
-        if self.isleader():
-          self.log.info("\n" +
-              "--------------------------------------\n" +
-              "Leader joined Paxos network of %d nodes\n" %
-                self.state.node_count  +
-              "--------------------------------------")
+        self.log.info("Joined Paxos network of %d nodes" %
+                      self.state.node_count)
         target()
 
     threading.Thread(target=wait_join,
@@ -594,7 +1663,11 @@ class PaxosController(object):
   def _handle_PacketIn(self, event):
     """Called when switch upcalls packet in-events."""
     # The baseline controller (L2 switch) gets its own upcalls
-    return self.handle_paxos(event)
+    self.outbound.begin()
+    try:
+      return self.handle_paxos(event)
+    finally:
+      self.outbound.end()
 
   def connectionDown(self, event):
     # The BaselineController will ensure that POX shuts down, so we don't
@@ -603,26 +1676,20 @@ class PaxosController(object):
 
   def handle_paxos(self, event):
     # Ignore anything but Paxos-messages
-    eth = event.parsed.find(pkt.ethernet)
-    assert(eth is not None)
-
-    if PaxosMessage.is_known_paxos_type(eth.type):
-      # React on messages form WAN, JOINs, to us or broadcasts
-      dispatch = self.is_wan_port(event.port)
-      dispatch |= eth.type == PaxosMessage.JOIN
-      dispatch |= eth.dst == self.mac
-      dispatch |= eth.dst == ETHER_BROADCAST
-
-      if dispatch:
-        return self.dispatch_paxos(eth.type, event, eth.payload)
-      else:
-        if eth.dst != self.mac:
-          self.log.warning("Got Paxos message {} but not to us, ignoring".
-              format(PaxosMessage.get_type(eth.type)))
-          if eth.type == PaxosMessage.ACCEPT or eth.type == PaxosMessage.LEARN:
-            n, seq, v = PaxosMessage.unpack_accept(eth.payload)
-            self.log.warning("  For info, it had n={} seq={} len(v)={} dst={}".format(
-              n,seq,len(v),eth.dst))
+    data = event.data
+    paxos_type, dst_class, handler = self.classifier.classify(event.port,
+                                                              data)
+    if handler is not None:
+      return self.dispatch(handler, paxos_type, event,
+                           data[ETHER_HEADER_SIZE:])
+
+    if dst_class == DST_OTHER and PaxosMessage.is_known_paxos_type(paxos_type):
+      self.log.warning("Got Paxos message {} but not to us, ignoring".
+          format(PaxosMessage.get_type(paxos_type)))
+      if paxos_type == PaxosMessage.ACCEPT or paxos_type == PaxosMessage.LEARN:
+        n, seq, v = PaxosMessage.unpack_accept(data[ETHER_HEADER_SIZE:])
+        self.log.warning("  For info, it had n={} seq={} len(v)={} dst={}".format(
+          n,seq,len(v),EthAddr(data[0:6])))
 
     # Silently ignore other messages; let the switch handle those
     pass
@@ -637,56 +1704,258 @@ class PaxosController(object):
   def dispatch_paxos(self, paxos_type, event, payload):
     """Dispatch to message handlers based on Paxos message type."""
     assert(PaxosMessage.is_paxos_type(paxos_type))
+    return self.dispatch(self.dispatch_map[paxos_type], paxos_type, event,
+                         payload)
 
-    dispatch_map = {PaxosMessage.ACCEPT:  self.on_accept,
-                    PaxosMessage.CLIENT:  self.on_client,
-                    PaxosMessage.JOIN:    self.on_join,
-                    PaxosMessage.LEARN:   self.on_learn,
-                    PaxosMessage.PREPARE: self.on_prepare,
-                    PaxosMessage.PROMISE: self.on_promise,
-                    PaxosMessage.TRUST:   self.on_trust}
-
+  def dispatch(self, handler, paxos_type, event, payload):
+    """Calls the handler for a Paxos message."""
     # We will ONLY dispatch JOIN messages until we've joined the network
     if not self.joined and paxos_type != PaxosMessage.JOIN:
       self.log.warning("Ignoring PAXOS %s message until we've joined" %
           PaxosMessage.get_type(paxos_type))
       return
 
-    handler = dispatch_map[paxos_type]
     return handler(event, payload)
 
   def on_accept(self, event, message):
     n, seqno, v = PaxosMessage.unpack_accept(message)
+    return self.on_phase2(event, PaxosMessage.ACCEPT, n, [(seqno, v)])
+
+  def on_accept_batch(self, event, message):
+    n, entries = PaxosMessage.unpack_accept_batch(message)
+    return self.on_phase2(event, PaxosMessage.ACCEPT_BATCH, n, entries)
+
+  def on_accept_learn(self, event, message):
+    n, seqno, v = PaxosMessage.unpack_accept(message)
+    return self.on_phase2(event, PaxosMessage.ACCEPT_LEARN, n, [(seqno, v)])
+
+  def on_accept_learn_batch(self, event, message):
+    n, entries = PaxosMessage.unpack_accept_batch(message)
+    return self.on_phase2(event, PaxosMessage.ACCEPT_LEARN_BATCH, n, entries)
+
+  def on_accept_fragment(self, event, message):
+    n, seqno, index, total, chunk = PaxosMessage.unpack_accept_fragment(
+                                      message)
+    src, dst = self.get_ether_addrs(event)
+
+    if dst != self.mac and dst != ETHER_BROADCAST:
+      self.log.warning("Got ACCEPT_FRAG from {} not addressed to us, drop".
+          format(src))
+      return EventHalt
+
+    self.log.debug("On ACCEPT_FRAG n={} seq={} {}/{} from {}".format(
+      n, seqno, index+1, total, src))
+
+    # Only vote once we have the whole value
+    v = self.state.slots.add_fragment(n, seqno, index, total, chunk)
+    if v is None:
+      return EventHalt
+
+    return self.on_phase2(event, PaxosMessage.ACCEPT, n, [(seqno, v)])
+
+  def on_phase2(self, event, paxos_type, n, entries):
+    """Acceptor: Handles (seqno, value) entries for round n from any of the
+    ACCEPT messages.  The ACCEPT_LEARN ones also carry the sender's vote."""
     src, dst = self.get_ether_addrs(event)
+    name = PaxosMessage.get_type(paxos_type)
 
     # TODO: Verify that it is from the leader
     # We used to only accept stuff directed explicitly to us, but now
     # try accepting broadcasts.
     if dst != self.mac and dst != ETHER_BROADCAST:
-      self.log.warning("Got ACCEPT from {} not addressed to us, drop".
-          format(src))
+      self.log.warning("Got {} from {} not addressed to us, drop".
+          format(name, src))
       return EventHalt
 
-    self.log.info("On ACCEPT n={} seq={} from {}".format(
-      n, seqno, src))
+    # Someone has taken over in a higher round
+    if self.leader is not None and n > self.leader.n:
+      self.step_down(src, n)
+
+    if len(entries) == 1:
+      self.log.info("On {} n={} seq={} from {}".format(
+        name, n, entries[0][0], src))
+    else:
+      self.log.info("On {} n={} seq={}..{} from {}".format(
+        name, n, entries[0][0], entries[-1][0], src))
+
+    accepted = [seqno for (seqno, v) in entries if self.accept(n, seqno, v)]
+
+    # The sender only combines its vote with the values it accepted itself
+    if PaxosMessage.carries_vote(paxos_type):
+      self.learn(n, src, [seqno for (seqno, v) in entries])
+
+    self.vote(n, accepted)
+
+    # If the votes came in before the value, the slots are learned already
+    # and no new vote will deliver them
+    if len(accepted) > 0 and self.state.slots.stalled():
+      self.process_queue(n)
+    return EventHalt
+
+  def vote(self, n, seqnos):
+    """Acceptor: Sends our votes for the given slots, once they're durable
+    if we have a write-ahead log."""
+    if self.wal is None:
+      return self.queue_learns(n, seqnos)
+
+    if len(seqnos) == 0:
+      return
+
+    self.wal_mutex.acquire()
+    try:
+      self.durable_learns.append((n, seqnos))
+      self.schedule_commit()
+    finally:
+      self.wal_mutex.release()
+
+  def schedule_commit(self):
+    """Makes sure a group commit of the write-ahead log is coming."""
+    assert(self.wal_mutex.locked())
+    if not self.wal_commit_scheduled:
+      self.wal_commit_scheduled = True
+      core.callLater(self.commit_log)
+
+  def commit_log(self):
+    """Acceptor: Group commit of the write-ahead log, sending the votes
+    that waited for it."""
+    self.wal_mutex.acquire()
+    try:
+      self.wal.commit()
+      learns = self.durable_learns
+      self.durable_learns = []
+      self.wal_commit_scheduled = False
+    finally:
+      self.wal_mutex.release()
+
+    for n, seqnos in learns:
+      self.queue_learns(n, seqnos)
+
+  def recover(self, path):
+    """Restores how far we've delivered from our snapshot and the
+    write-ahead log at path, and our round and votes from the log."""
+    cseq = 0
+    snapshot = read_snapshot(self.snapshot_path)
+    if snapshot is not None:
+      cseq, crnd = snapshot
+      self.state.crnd = max(self.state.crnd, crnd)
+      self.log.info("Recovered snapshot from {}, cseq={} crnd={}".format(
+        self.snapshot_path, cseq, crnd))
+
+    records = read_records(path)
+    for kind, n, seqno, value in records:
+      if kind == RECORD_DELIVERED:
+        cseq = max(cseq, seqno)
+    if cseq > 0:
+      self.state.slots.set_watermark(cseq)
+
+    for kind, n, seqno, value in records:
+      self.state.crnd = max(self.state.crnd, n)
+      if kind == RECORD_ACCEPT:
+        self.state.slots.restore(n, seqno, value)
+
+    if len(records) > 0:
+      self.log.info("Recovered {} records from {}, cseq={} crnd={}".format(
+        len(records), path, cseq, self.state.crnd))
+
+  def queue_learns(self, n, seqnos):
+    """Acceptor: Queues our votes for the given slots in round n, sending
+    them right away if we don't coalesce them."""
+    if len(seqnos) == 0:
+      return
+
+    self.learn_mutex.acquire()
+    try:
+      if self.pending_learns_round not in (None, n):
+        self.send_learns()
+
+      if self.coalesce_learns and len(self.pending_learns) == 0:
+        core.callDelayed(self.learn_delay, self.flush_learns)
+
+      self.pending_learns_round = n
+      self.pending_learns.extend(seqnos)
+
+      if not self.coalesce_learns:
+        self.send_learns()
+      elif (self.pending_learns[-1] - self.pending_learns[0] >=
+            MAX_RANGE_COUNT):
+        # Won't fit in one LEARN_RANGE anyway
+        self.send_learns()
+    finally:
+      self.learn_mutex.release()
 
+  def flush_learns(self):
+    """Acceptor: Sends any queued votes."""
+    self.outbound.begin()
+    self.learn_mutex.acquire()
+    try:
+      self.send_learns()
+    finally:
+      self.learn_mutex.release()
+      self.outbound.end()
+
+  def send_learns(self):
+    """Sends all queued votes to all learners as LEARN_RANGEs, or plain
+    LEARNs for single slots."""
+    assert(self.learn_mutex.locked())
+    n = self.pending_learns_round
+    seqnos = sorted(set(self.pending_learns))
+    self.pending_learns = []
+    self.pending_learns_round = None
+
+    plan = self.plan
+    for base, count, bitmap in learn_ranges(seqnos):
+      for mac, port in plan:
+        if count == 1:
+          self.log.debug("LEARN n={} seq={} to {}".format(n, base, mac))
+          self.send_learn(mac, n, base, port)
+        else:
+          self.log.debug("LEARN_RANGE n={} seq={}..{} to {}".format(
+            n, base, base+count-1, mac))
+          self.send_learn_range(mac, n, base, count, bitmap, port)
+
+  def accept(self, n, seqno, v):
+    """Acceptor: Votes for value v in the given slot if round n allows it.
+    Returns True if we accepted the value."""
     # Blocks queue
     slot = self.state.slots.get_slot(seqno)
 
+    if slot is None:
+      self.log.warning("On ACCEPT seq={} outside of slot window, drop".format(
+                       seqno))
+      return False
+
     if n >= self.state.crnd and n != slot.vrnd:
       self.state.crnd = n
       slot.vrnd = n
       slot.vval = v
-
-      # Send learns to all
-      for mac in self.state.ordered_nodes(self.mac):
-        self.log.debug("LEARN n={} seq={} to {}".format(n, seqno, mac))
-        self.send_learn(mac, n, seqno, self.lookup_port(mac))
+      if self.wal is not None:
+        self.wal_mutex.acquire()
+        try:
+          self.wal.append_accept(n, seqno, v)
+        finally:
+          self.wal_mutex.release()
+      return True
+    elif n >= self.state.crnd and n == slot.vrnd:
+      # A resent ACCEPT; vote again, since our vote may have been lost
+      return True
     else:
       self.log.warning("On ACCEPT not accepted n={} seq={} crnd={}".format(
                        n, seqno, self.state.crnd))
+      return False
 
-    return EventHalt
+  def update_plan(self):
+    """Computes the fan-out plan used for sending ACCEPTs and LEARNs, when
+    the Paxos nodes or the ports they are on have changed."""
+    plan = []
+    for mac, port in self.state.fanout_plan(self.mac, self.switch.macports):
+      if port is None and mac != self.mac:
+        self.log.warning("Don't know which port {} is on, will broadcast".
+                         format(mac))
+        port = of.OFPP_ALL
+      plan.append((mac, port))
+
+    # Readers may be in other threads, so the list is replaced, not changed
+    self.plan = plan
 
   def lookup_port(self, mac):
     """Returns port MAC address is on or BROADCAST if not found."""
@@ -714,50 +1983,314 @@ class PaxosController(object):
     return ports[max(ports)].name
 
   def isleader(self):
-    """Check if we are Paxos leader."""
-    # NOTE: We have hardcoded that S1 is the leader.
-    return self.name == "S1"
+    """Check if we are Paxos leader, having taken over a round."""
+    return self.leader is not None
 
   def on_client(self, event, message):
-    """On leader only: Process incoming CLIENT message."""
-    if not self.isleader():
-      self.log.warning("Got CLIENT message on non-leader, drop")
-      # TODO: Forward to leader if we're not
+    """On leader only: Process incoming CLIENT message.  Others forward
+    CLIENTs from the WAN to the node they trust as leader."""
+    if not self.take_client(event, PaxosMessage.CLIENT, message):
       return EventHalt
+    return self.on_client_value(event,
+                                PaxosMessage.unpack_client(message))
 
-    if not self.joined:
-      self.log.critical("Refusing CLIENT packet until we've joined the " +
-                        "Paxos network.")
+  def on_client_fragment(self, event, message):
+    """On leader only: Reassembles client frames from CLIENT_FRAGs.  Others
+    forward them like CLIENTs."""
+    if not self.take_client(event, PaxosMessage.CLIENT_FRAG, message):
       return EventHalt
 
+    frame_id, index, total, chunk = PaxosMessage.unpack_client_fragment(
+                                      message)
+    src, dst = self.get_ether_addrs(event)
+    value = self.client_fragments.add((src, frame_id), index, total, chunk)
+    if value is None:
+      return EventHalt
+    return self.on_client_value(event, value)
+
+  def take_client(self, event, paxos_type, message):
+    """Returns True if we're the leader and should handle the client
+    message.  Others forward messages from the WAN to the node they trust
+    as leader."""
+    name = PaxosMessage.get_type(paxos_type)
+    if not self.joined:
+      self.log.critical("Refusing {} packet until we've joined the ".format(
+                        name) + "Paxos network.")
+      return False
+
+    # Clients come in from the WAN through this port, so the WAN controller
+    # can be told to hold them back through it
+    if self.is_wan_port(event.port):
+      self.wan_port = event.port
+
+    if self.isleader():
+      return True
+
     src, dst = self.get_ether_addrs(event)
+    if (self.trusted is None or self.trusted == self.mac or
+        not self.is_wan_port(event.port)):
+      self.log.warning("Got {} message on non-leader, drop".format(name))
+      return False
+    self.log.debug("Forwarding {} to leader {}".format(name, self.trusted))
+    self.send_ethernet(src=src,
+                       dst=self.trusted,
+                       type=paxos_type,
+                       payload=as_bytes(message),
+                       output_port=self.lookup_port(self.trusted))
+    return False
+
+  def on_client_value(self, event, value):
+    """On leader only: Proposes a client frame, or adds it to the batch of
+    client values."""
+    src, dst = self.get_ether_addrs(event)
+    self.log.debug("On CLIENT {} -> {} len={}".format(src, dst, len(value)))
+
+    if (not self.client_batch or len(value) > MAX_BATCHED_VALUE or
+        not self.state.all_capable(CAP_BATCH)):
+      self.submit(PaxosMessage.encode_value(value,
+                                            self.state.all_capable(CAP_ZLIB),
+                                            self.compress_threshold))
+      return EventHalt
+
+    batcher = self.client_batcher
+    if not batcher.fits(value):
+      self.seal_clients("bytes")
+    if not batcher.values:
+      core.callDelayed(batcher.delay, self.flush_clients, batcher.generation)
+
+    reason = batcher.add(value)
+    if reason is not None:
+      self.seal_clients(reason)
+    return EventHalt
+
+  def flush_clients(self, generation):
+    """On leader only: Seals the batch of client values that was started
+    when we were scheduled, unless it already has been."""
+    batcher = self.client_batcher
+    if (self.leader is not None and batcher.generation == generation and
+        batcher.values):
+      self.outbound.begin()
+      try:
+        self.seal_clients("time")
+      finally:
+        self.outbound.end()
+
+  def seal_clients(self, reason):
+    """On leader only: Submits the pending client values as one slot
+    value."""
+    values = self.client_batcher.take(reason)
+    self.log.debug("Sealed batch of {} client values by {}".format(
+      len(values), reason))
+    self.submit(PaxosMessage.encode_values(values,
+                                           self.state.all_capable(CAP_ZLIB),
+                                           self.compress_threshold))
+
+  def submit(self, v):
+    """On leader only: Proposes value v, or queues it if the window is
+    full or phase 1 isn't done yet."""
+    # Values already waiting go first
+    if (self.leader.pending or not self.leader.prepared or
+        self.leader.window_full(self.state.slots.cseq)):
+      if self.leader.hold(v):
+        self.log.debug("Window full, queued value")
+      else:
+        self.log.debug("Window full, dropped value")
+      if self.leader.prepared:
+        self.pause_clients()
+      return
 
-    n = self.state.crnd
+    self.propose(v)
+
+  def propose(self, v):
+    """On leader only: Hands out the next slot for value v."""
+    n = self.leader.n
     seqno = self.leader.next_seqno()
-    v = PaxosMessage.unpack_client(message)
+    self.log.info("Proposing n={} seq={}".format(n, seqno))
+    self.send_value(n, seqno, v)
 
-    self.wan_port = event.port
+  def send_value(self, n, seqno, v):
+    """On leader only: Sends an ACCEPT for value v in slot seqno."""
+    if self.batch_accepts:
+      self.queue_accept(n, seqno, v)
+    else:
+      self.broadcast_value(n, seqno, v)
 
-    self.log.info("On CLIENT n={} seq={} {} -> {}".format(
-                  n, self.leader.seqno, src, dst))
+  def pause_clients(self):
+    """On leader only: Asks the WAN controller to hold back clients, again
+    every pause_hold/2 seconds for as long as we're paused."""
+    now = time.time()
+    if self.leader.paused and now - self.pause_sent < self.pause_hold/2:
+      return
 
-    # Send accepts to all
-    for mac in self.state.ordered_nodes(self.mac):
-      self.log.debug("ACCEPT n={} seq={} to {}".format(n, seqno, mac))
-      self.send_accept(mac, n, seqno, v, self.lookup_port(mac))
+    if not self.leader.paused:
+      self.log.info("Window of {} slots full, pausing clients".format(
+        self.leader.window))
+    self.leader.paused = True
+    self.pause_sent = now
+    self.send_flow_control(True)
+
+  def admit_clients(self):
+    """On leader only: Proposes queued values as the window opens, and
+    resumes clients once half of it has drained."""
+    self.admit_scheduled = False
+    if self.leader is None or not self.leader.prepared:
+      return
+    cseq = self.state.slots.cseq
+
+    self.outbound.begin()
+    try:
+      while self.leader.pending and not self.leader.window_full(cseq):
+        self.propose(self.leader.pending.popleft())
+
+      if (self.leader.paused and not self.leader.pending and
+          self.leader.in_flight(cseq) <= self.leader.window // 2):
+        self.log.info("Resuming clients ({} values dropped so far)".format(
+          self.leader.shed))
+        self.leader.paused = False
+        self.send_flow_control(False)
+    finally:
+      self.outbound.end()
+
+  def send_flow_control(self, pause):
+    """On leader only: Sends a FLOW_CONTROL to the WAN controller.  Clients
+    may reach us through another node, so the others pass it on to the WAN
+    too (see on_flow_control)."""
+    hold = min(UINT16_MAX, int(1000*self.pause_hold))
+    payload = PaxosMessage.pack_flow_control(pause, hold)
+    for mac, port in self.plan:
+      if mac != self.mac:
+        self.send_ethernet(src=self.mac,
+                           dst=mac,
+                           type=PaxosMessage.FLOW_CONTROL,
+                           payload=payload,
+                           output_port=port)
+    self.relay_flow_control(payload)
+
+  def on_flow_control(self, event, message):
+    """Passes a FLOW_CONTROL from the leader we trust on to the WAN
+    controller."""
+    src, dst = self.get_ether_addrs(event)
+    if self.isleader() or src != self.trusted:
+      self.log.warning("Got FLOW_CONTROL from {}, not our leader, drop".format(
+        src))
+      return EventHalt
 
+    self.relay_flow_control(message)
     return EventHalt
 
-  def send_accept(self, dst, n, seqno, v, port):
-    payload = PaxosMessage.pack_accept(n, seqno, v)
+  def relay_flow_control(self, payload):
+    """Sends a FLOW_CONTROL out of the port clients come in through, if
+    any."""
+    if self.wan_port is None:
+      return
+    self.send_ethernet(src=self.mac,
+                       dst=ETHER_BROADCAST,
+                       type=PaxosMessage.FLOW_CONTROL,
+                       payload=payload,
+                       output_port=self.wan_port)
+
+  def queue_accept(self, n, seqno, v):
+    """On leader only: Adds an ACCEPT to the pending batch, sending the
+    batch if it is full."""
+    with self.batch_mutex:
+      # Values that don't even fit in an empty batch are sent on their own
+      if not self.leader.batch and not self.leader.fits_batch(v):
+        self.broadcast_value(n, seqno, v)
+        return
+
+      if (self.leader.batch_round not in (None, n) or
+          not self.leader.fits_batch(v)):
+        self.send_batch()
+
+      if not self.leader.batch:
+        core.callDelayed(self.batch_delay, self.flush_accepts)
+      self.leader.add_to_batch(n, seqno, v)
+
+  def flush_accepts(self):
+    """On leader only: Sends any pending ACCEPTs."""
+    if self.leader is None:
+      return
+    self.outbound.begin()
+    try:
+      with self.batch_mutex:
+        self.send_batch()
+    finally:
+      self.outbound.end()
+
+  def send_batch(self):
+    """Sends the pending batch of ACCEPTs to all acceptors."""
+    assert(self.batch_mutex.locked())
+    n, entries = self.leader.take_batch()
+    self.broadcast_values(n, entries)
+
+  def broadcast_value(self, n, seqno, v):
+    """Sends one value to all acceptors in an ACCEPT, or split over several
+    ACCEPT_FRAGs if it doesn't fit in one frame."""
+    if len(v) <= MAX_ACCEPT_VALUE:
+      self.broadcast_values(n, [(seqno, v)])
+      return
+
+    for payload in PaxosMessage.pack_accept_fragments(n, seqno, v):
+      self.broadcast_accept(PaxosMessage.ACCEPT_FRAG, payload, self.plan)
+
+  def broadcast_values(self, n, entries):
+    """Sends (seqno, value) entries for round n to all acceptors.
+
+    When combining ACCEPT and LEARN, we accept the values ourself first,
+    and only send our vote for the slots we accepted.  With a write-ahead
+    log, nobody may count our vote before it's durable, so it goes out
+    after the next group commit like everyone else's instead.
+    """
+    if not self.combine_accept_learn or self.wal is not None:
+      self.send_values(PaxosMessage.ACCEPT, n, entries, self.plan)
+      return
 
+    accepted = []
+    rejected = []
+    for seqno, v in entries:
+      if self.accept(n, seqno, v):
+        accepted.append((seqno, v))
+      else:
+        rejected.append((seqno, v))
+
+    others = [(mac, port) for (mac, port) in self.plan if mac != self.mac]
+    self.learn(n, self.mac, [seqno for (seqno, v) in accepted])
+    self.send_values(PaxosMessage.ACCEPT_LEARN, n, accepted, others)
+    self.send_values(PaxosMessage.ACCEPT, n, rejected, others)
+
+  def send_values(self, paxos_type, n, entries, plan):
+    """Sends (seqno, value) entries for round n to the acceptors in plan,
+    in one message of paxos_type, or its BATCH type for several
+    entries."""
+    if len(entries) == 0:
+      return
+
+    if len(entries) == 1:
+      seqno, v = entries[0]
+      payload = PaxosMessage.pack_accept(n, seqno, v)
+    else:
+      paxos_type |= PaxosMessage.BATCH
+      payload = PaxosMessage.pack_accept_batch(n, entries)
+    self.broadcast_accept(paxos_type, payload, plan)
+
+  def broadcast_accept(self, paxos_type, payload, plan):
+    """Sends a packed message of one of the ACCEPT types to the acceptors
+    in plan."""
+    # The message is the same for all acceptors, so it's only packed once
+    for mac, port in plan:
+      self.log.debug("{} to {}".format(PaxosMessage.get_type(paxos_type),
+                                       mac))
+      self.send_accept(mac, paxos_type, payload, port)
+
+  def send_accept(self, dst, paxos_type, payload, port):
+    """Sends a packed message of one of the ACCEPT types to dst."""
     # Short-circuit messages to ourself
     if dst == self.mac:
-      return self.on_accept(event=None, message=payload)
+      return self.dispatch_paxos(paxos_type, event=None, payload=payload)
     else:
       return self.send_ethernet(src=self.mac,
                                 dst=dst,
-                                type=PaxosMessage.ACCEPT,
+                                type=paxos_type,
                                 payload=payload,
                                 output_port=port)
 
@@ -774,8 +2307,22 @@ class PaxosController(object):
                                 payload=payload,
                                 output_port=port)
 
+  def send_learn_range(self, dst, n, base, count, bitmap, port):
+    payload = PaxosMessage.pack_learn_range(n, base, count, bitmap)
+
+    # Short-circuit messages to ourself
+    if dst == self.mac:
+      return self.on_learn_range(event=None, message=payload)
+    else:
+      return self.send_ethernet(src=self.mac,
+                                dst=dst,
+                                type=PaxosMessage.LEARN_RANGE,
+                                payload=payload,
+                                output_port=port)
+
   def on_join(self, event, message):
     node_id, mac_addr = PaxosMessage.unpack_join(message)
+    capabilities = PaxosMessage.unpack_join_capabilities(message)
     mac = EthAddr(mac_addr)
 
     self.log.debug("JOIN <- {}".format(mac))
@@ -793,8 +2340,9 @@ class PaxosController(object):
         self.paxos_ports[mac] = event.port
         # ... as well as the actual sender
         self.paxos_ports[event.parsed.src] = event.port
+        self.host_index.exclude(event.port)
 
-      self.state.add_node(mac)
+      self.state.add_node(mac, capabilities)
       src = self.mac
 
       # Also add node to the switch, so it knows where to direct packets
@@ -802,6 +2350,7 @@ class PaxosController(object):
       # broadcasts.
       if event is not None:
         self.switch.learn_port(mac, event.port)
+      self.update_plan()
 
       # Self-generated join? (join on self)
       if event is None:
@@ -820,7 +2369,8 @@ class PaxosController(object):
     src = EthAddr(self.mac).toRaw()
     if not reannounce:
       # Normal action: put OUR address in the JOIN-message
-      payload = PaxosMessage.pack_join(self.state.n_id, src)
+      payload = PaxosMessage.pack_join(self.state.n_id, src,
+                                       self.capabilities)
     else:
       # Want to get EVERYONE to react with an answer, so set embedded
       # address to ETHER_BROADCAST
@@ -851,75 +2401,250 @@ class PaxosController(object):
       self.log.warning(msg + " not to us")
       return EventHalt
 
-    # Blocks the queue
+    if self.learn(n, src, [seqno]) == 0:
+      return EventHalt
+
     slot = self.state.slots.get_slot(seqno)
+    if slot is None:
+      self.log.info(msg + " (delivered)")
+    else:
+      self.log.info(msg + " (learns {}/{})".format(slot.votes,
+                                                   slot.required_learns))
+    return EventHalt
 
-    if slot.learned:
-      return EventHalt
+  def on_learn_range(self, event, message):
+    n, base, count, bitmap = PaxosMessage.unpack_learn_range(message)
+    src, dst = self.get_ether_addrs(event)
+    msg = "On LEARN_RANGE n={} seq={}..{} from {}".format(
+            n, base, base+count-1, src)
 
-    if n < slot.hrnd:
-      self.log.debug(msg + " n < slot.hrnd {}".format(slot.hrnd))
+    if dst != self.mac and dst != ETHER_BROADCAST:
+      self.log.warning(msg + " not to us")
       return EventHalt
 
-    # Initialize slot
-    if n > slot.hrnd:
-      slot.hrnd = n
-      slot.reset_learns()
+    # Apply all votes in bulk
+    seqnos = PaxosMessage.range_seqnos(base, bitmap)
+    votes = self.learn(n, src, seqnos)
 
-    if slot.hrnd == n:
-      if not src in slot.learns:
-        slot.update_learns(src)
-      else:
-        # Already got one learn from this src with same round
-        self.log.warning(msg + " duplicate")
-        return EventHalt
+    self.log.info(msg + " ({}/{} new learns)".format(votes, len(seqnos)))
+    return EventHalt
 
-    self.log.info(msg + " (learns {}/{})".format(slot.votes,
-                                                 slot.required_learns))
-    self.process_queue(n)
+  def learn(self, n, src, seqnos):
+    """Learner: Registers votes from src in round n, delivering any slots
+    that got a majority.  Returns the number of new votes."""
+    bit = self.state.node_bit(src)
+    if bit == 0:
+      self.log.warning("Ignoring votes from unknown node {}".format(src))
+      return 0
+
+    votes = self.state.slots.update_learns(n, bit, seqnos)
+    if votes > 0:
+      self.process_queue(n)
+      self.watch_gap()
+    return votes
+
+  def watch_gap(self):
+    """Learner: Schedules a check for a gap holding back delivery, if there
+    could be one."""
+    if (not self.catchup or self.catchup_scheduled or
+        not self.state.slots.stalled()):
+      return
+
+    self.catchup_scheduled = True
+    self.catchup_base = self.state.slots.cseq
+    core.callDelayed(self.catchup_wait, self.check_gap)
+
+  def check_gap(self):
+    """Learner: Asks for the missing values if delivery is still held back
+    at the same slot as when we scheduled the check."""
+    self.catchup_scheduled = False
+    gap = self.state.slots.gap()
+    if gap is None:
+      self.catchup_wait = self.catchup_delay
+      return
+
+    base, count = gap
+    if base == self.catchup_base:
+      self.request_catchup(base, count)
+      if self.isleader():
+        self.resend_accepts(base, count)
+      self.catchup_wait = min(2*self.catchup_wait, CATCHUP_MAX_DELAY)
+    else:
+      self.catchup_wait = self.catchup_delay
+    self.watch_gap()
+
+  def resend_accepts(self, base, count):
+    """Leader: Sends the ACCEPTs again for slots in the given range that
+    nobody may have learned, in case they or all the votes were lost."""
+    for seqno in xrange(base, base + count):
+      slot = self.state.slots.get_slot(seqno)
+      # Only our own proposals; older votes may not be for the chosen value
+      if (slot is not None and slot.vval is not None and not slot.learned and
+          slot.vrnd == self.leader.n):
+        self.log.info("Resending ACCEPT n={} seq={}".format(slot.vrnd, seqno))
+        self.broadcast_value(slot.vrnd, seqno, slot.vval)
+
+  def request_catchup(self, base, count, peer=None):
+    """Learner: Asks the given peer, or a random one, for the values of
+    count slots starting at base."""
+    peers = [mac for mac in self.state.N if mac != self.mac]
+    if len(peers) == 0:
+      return
+
+    if peer is None:
+      peer = random.choice(peers)
+    self.log.info("CATCHUP_REQUEST seq={}..{} to {}".format(
+      base, base+count-1, peer))
+    self.send_ethernet(src=self.mac,
+                       dst=peer,
+                       type=PaxosMessage.CATCHUP_REQUEST,
+                       payload=PaxosMessage.pack_catchup_request(base, count),
+                       output_port=self.lookup_port(peer))
+
+  def on_catchup_request(self, event, message):
+    """Sends the values we remember of the requested slots, in at most
+    CATCHUP_MESSAGES CATCHUPs and CATCHUP_FRAGs."""
+    base, count = PaxosMessage.unpack_catchup_request(message)
+    src, dst = self.get_ether_addrs(event)
+    msg = "On CATCHUP_REQUEST seq={}..{} from {}".format(
+            base, base+count-1, src)
+
+    if dst != self.mac:
+      self.log.warning(msg + " not to us")
+      return EventHalt
+
+    entries = self.state.slots.delivered(base, count)
+    messages = catchup_messages(self.state.crnd, entries)
+    self.log.info(msg + " ({} values in {} messages)".format(len(entries),
+                                                            len(messages)))
+    if len(entries) == 0:
+      # Tell them if they're too far behind for us to help
+      oldest = self.state.slots.oldest
+      if base < oldest:
+        self.log.info("CATCHUP_SKIP seq={} to {}".format(oldest, src))
+        self.send_ethernet(src=self.mac,
+                           dst=src,
+                           type=PaxosMessage.CATCHUP_SKIP,
+                           payload=PaxosMessage.pack_learn(self.state.crnd,
+                                                           oldest),
+                           output_port=self.lookup_port(src))
+      return EventHalt
+
+    for paxos_type, payload in messages:
+      self.send_to(src, paxos_type, payload)
     return EventHalt
 
-  def process_queue(self, n):
-    """Processes messages in sequence, without gaps."""
-    # Will be called both from ON LEARN, but also in a background-thread.
-    # The generator queue(n) has a mutex, so this is thread-safe.
-    # We also use the same mutex on the garbage collection.
-    for seqno, slot in self.state.slots.queue(n):
-      assert(not self.state.slots.is_processed(n, seqno))
+  def on_catchup(self, event, message):
+    """Learner: Delivers the chosen values a peer sent us."""
+    n, entries = PaxosMessage.unpack_accept_batch(message)
+    src, dst = self.get_ether_addrs(event)
 
-      if self.process_message(n, seqno, slot.vval):
-        self.state.slots.set_processed(n, seqno)
-      else:
-        break
+    if dst != self.mac or self.state.node_bit(src) == 0:
+      self.log.warning("Got CATCHUP from {} not for us, drop".format(src))
+      return EventHalt
 
-  def host_addresses_known(self):
-    """Returns True if we know the MAC and IP addresses of all our hosts."""
-    count = 0
-    for port in self.connection.ports:
-      # Skip links to other Paxos nodes
-      if port in self.paxos_ports.values():
-        continue
+    return self.fill(n, src, "CATCHUP", entries)
 
-      # Skip the switch interface
-      if port > 65000:
-        continue
+  def on_catchup_fragment(self, event, message):
+    """Learner: Delivers a chosen value a peer sent us in CATCHUP_FRAGs,
+    once we have all of them."""
+    n, seqno, index, total, chunk = PaxosMessage.unpack_accept_fragment(
+                                      message)
+    src, dst = self.get_ether_addrs(event)
 
-      macs = self.switch.port_to_mac(port, default=False)
+    if dst != self.mac or self.state.node_bit(src) == 0:
+      self.log.warning("Got CATCHUP_FRAG from {} not for us, drop".format(
+                       src))
+      return EventHalt
 
-      # Probably a host, but we don't know its MAC-address yet
-      if not macs:
-        continue
+    v = self.catchup_fragments.add((src, seqno), index, total, chunk)
+    if v is None:
+      return EventHalt
 
-      # Only one host per port
-      if len(macs) != 1:
-        continue
+    return self.fill(n, src, "CATCHUP_FRAG", [(seqno, v)])
 
-      mac = macs[0]
-      if not self.switch.mac_to_ip(mac, default=False):
-        continue
+  def fill(self, n, src, name, entries):
+    """Learner: Fills in the chosen values a peer sent us in round n, as
+    (seqno, value)s, delivering what we can."""
+    if len(entries) == 0:
+      return EventHalt
+
+    filled = self.state.slots.fill(n, entries)
+    self.log.info("On {} n={} seq={}..{} from {} ({} filled in)".format(
+      name, n, entries[0][0], entries[-1][0], src, filled))
+
+    if filled > 0:
+      self.process_queue(n)
+      self.watch_gap()
+    return EventHalt
+
+  def on_catchup_skip(self, event, message):
+    """Learner: With catchup_skip, skips ahead to the oldest slot a peer
+    remembers, when we're further behind than that.  This is lossy: the
+    values of the slots in between never reach our hosts."""
+    n, oldest = PaxosMessage.unpack_learn(message)
+    src, dst = self.get_ether_addrs(event)
+
+    if dst != self.mac or self.state.node_bit(src) == 0:
+      self.log.warning("Got CATCHUP_SKIP from {} not for us, drop".format(
+                       src))
+      return EventHalt
+
+    cseq = self.state.slots.cseq
+    if not self.catchup_skip:
+      if oldest > cseq:
+        self.log.error("Too far behind for {} to catch us up on slots {}..{}, "
+                       "not skipping them".format(src, cseq, oldest-1))
+      return EventHalt
+
+    skipped = self.state.slots.skip_to(oldest)
+    if skipped == 0:
+      return EventHalt
 
-      # Increase number of found hosts
-      count += 1
+    self.log.warning("Too far behind for {} to catch us up, skipped {} "
+                     "slots {}..{}".format(src, skipped, cseq, oldest-1))
+    self.catchup_wait = self.catchup_delay
+    self.process_queue(n)
+    self.watch_gap()
+    return EventHalt
+
+  def process_queue(self, n):
+    """Hands the values that are ready, in sequence and without gaps, to
+    the applier."""
+    # Will be called both from ON LEARN, but also in a background-thread.
+    # take_ready only holds the queue mutex while taking the slots out, so
+    # delivery to hosts happens outside of it.
+    ready = self.state.slots.take_ready()
+    if len(ready) > 0:
+      self.applier.submit(n, ready)
+
+      # The leader's window has moved, so it may propose queued values.
+      # This can be called with locks held, so it's done from the event
+      # loop instead.
+      leader = self.leader
+      if (leader is not None and (leader.pending or leader.paused) and
+          not self.admit_scheduled):
+        self.admit_scheduled = True
+        core.callLater(self.admit_clients)
+
+  def host_table_changed(self, event):
+    """Updates our host index when the switch learns a host's address, and
+    retries postponed deliveries."""
+    if event.port is not None:
+      self.host_index.learn_port(event.mac, event.port)
+      if event.mac in self.state.N:
+        self.update_plan()
+    if event.ip is not None:
+      self.host_index.learn_ip(event.mac, event.ip)
+
+    if self.applier.backlog > 0:
+      self.log.debug("Learned about {}, retrying postponed deliveries".format(
+        event.mac))
+      self.applier.kick()
+
+  def host_addresses_known(self):
+    """Returns True if we know the MAC and IP addresses of all our hosts."""
+    count = len(self.host_index)
 
     # Take all ports, subtract known Paxos ports, WAN-ports and one extra
     # that POX creates for the connection to the actual switch.
@@ -938,26 +2663,41 @@ class PaxosController(object):
   @property
   def hosts(self):
     """Returns list of (MAC, IP, port)-tuples of all of our KNOWN hosts."""
-    # In case we haven't been booted
-    if not hasattr(self, "switch"):
-      return []
-
-    h = []
-    for port in self.connection.ports:
-      # See know_host_addresses for explanation.
-      if port in self.paxos_ports.values() or port > 65000:
-        continue
+    return self.host_index.entries
 
-      macs = self.switch.port_to_mac(port, default=False)
-      if not macs or len(macs) != 1:
-        continue
-      else:
-        mac = macs[0]
+  def apply(self, n, seqno, v):
+    """Applier: Delivers a value, logging how far we've delivered with the
+    next group commit, and taking a snapshot every snapshot_interval
+    slots.  Returns True if the value was delivered."""
+    if not self.process_message(n, seqno, v):
+      return False
+
+    if self.wal is None:
+      return True
+
+    self.wal_mutex.acquire()
+    try:
+      self.wal.append_delivered(seqno + 1)
+      self.schedule_commit()
+    finally:
+      self.wal_mutex.release()
 
-      ip = self.switch.mac_to_ip(mac, default=False)
-      if ip:
-        h.append((mac, ip, port))
-    return h
+    if (self.snapshot_interval > 0 and
+        (seqno + 1) % self.snapshot_interval == 0):
+      self.take_snapshot(seqno + 1)
+    return True
+
+  def take_snapshot(self, cseq):
+    """Snapshots that all slots below cseq have been delivered, and drops
+    the votes for them from the write-ahead log."""
+    write_snapshot(self.snapshot_path, cseq, self.state.crnd)
+    self.wal_mutex.acquire()
+    try:
+      kept = self.wal.truncate(cseq)
+    finally:
+      self.wal_mutex.release()
+    self.log.info("Snapshot at cseq={}, kept {} log records".format(
+      cseq, kept))
 
   def process_message(self, n, seqno, v):
     """Act on a Paxos value that reached consensus.
@@ -972,66 +2712,296 @@ class PaxosController(object):
       self.log.warning("PROCESS: Don't know MAC+IP for our hosts, postponed")
       return False
 
+    # Decode (and decompress) the value once.  A slot may hold a batch of
+    # client values, delivered in order.
+    self.outbound.begin()
+    try:
+      for frame in PaxosMessage.decode_values(v):
+        self.deliver(n, seqno, frame)
+    finally:
+      self.outbound.end()
+
+    return True
+
+  def deliver(self, n, seqno, frame):
+    """Sends one client value to all of our hosts."""
+    # Find the headers to rewrite once for all hosts
+    template = FrameTemplate(frame)
+
+    if self.fanout_actions:
+      self.fanout(n, seqno, frame, template.ip_offset is not None)
+      return
+
     for (mac, dstip, port) in self.hosts:
       assert(mac not in self.paxos_ports)
       self.log.info("PROCESS n={} seq={} forw to {} @ {}.{}".
           format(n, seqno, dstip, mac, port))
 
       # Rewrite packet by setting destination MAC and IP addresses and
-      # updating the checksum.
-      eth = self.rewrite_destinations(mac, dstip, v)
-      m = of.ofp_packet_out(data=eth)
+      # updating the checksums.
+      data = template.rewrite(mac.toRaw(), dstip.toRaw())
+      m = of.ofp_packet_out(data=data)
       m.actions.append(of.ofp_action_output(port=port))
-      self.connection.send(m)
+      self.outbound.send(m)
 
-    return True
+  def fanout(self, n, seqno, frame, is_ipv4):
+    """Sends a delivered value to all of our hosts in one packet-out, having
+    the switch rewrite the destination addresses for each of them."""
+    m = of.ofp_packet_out(data=frame)
+    for (mac, dstip, port) in self.hosts:
+      assert(mac not in self.paxos_ports)
+      self.log.info("PROCESS n={} seq={} forw to {} @ {}.{}".
+          format(n, seqno, dstip, mac, port))
+
+      m.actions.append(of.ofp_action_dl_addr.set_dst(mac))
+      if is_ipv4:
+        m.actions.append(of.ofp_action_nw_addr.set_dst(dstip))
+      m.actions.append(of.ofp_action_output(port=port))
+
+    self.outbound.send(m)
+
+  def take_over(self):
+    """Becomes leader in a round of ours above any we know of, and runs
+    phase 1 for it.  Client values are held until that's done."""
+    if self.leader is not None:
+      return
+
+    self.leader = Leader(window=self.window, queue_limit=self.client_queue,
+                         n=self.state.pickNext())
+    self.trusted = self.mac
+    self.trusted_round = self.leader.n
+    self.log.info("Taking over as leader in round {}".format(self.leader.n))
+    self.heartbeat(self.leader)
+    self.start_prepare()
+
+  def step_down(self, leader, n):
+    """Trusts leader, which has taken over in round n, and stops leading
+    if we were."""
+    if self.leader is not None:
+      self.log.warning("{} took over as leader, stepping down ({} values "
+                       "dropped)".format(leader, len(self.leader.pending) +
+                                         len(self.client_batcher.values)))
+      self.leader = None
+      self.prepare = None
+      self.client_batcher.clear()
+
+    self.trusted = leader
+    self.trusted_round = n
+    self.last_heartbeat = time.time()
+
+  def heartbeat(self, leader):
+    """Leader: Tells the others to keep trusting us, every
+    heartbeat_interval seconds for as long as we lead."""
+    if self.leader is not leader:
+      return
+
+    payload = PaxosMessage.pack_trust(leader.n, self.mac.toRaw(),
+                                      self.state.slots.cseq)
+    for mac, port in self.plan:
+      if mac != self.mac:
+        self.send_ethernet(src=self.mac,
+                           dst=mac,
+                           type=PaxosMessage.TRUST,
+                           payload=payload,
+                           output_port=port)
+    self.check_progress(leader)
+    core.callDelayed(self.heartbeat_interval, self.heartbeat, leader)
+
+  def check_progress(self, leader):
+    """Leader: Sends the ACCEPTs for the next RESEND_SLOTS slots again if
+    delivery hasn't moved since the last heartbeat, in case they or all the
+    votes for them were lost.  When that happens to the last slots we
+    proposed, there is no gap behind which anyone would notice."""
+    cseq = self.state.slots.cseq
+    in_flight = leader.in_flight(cseq)
+    if cseq == leader.heartbeat_cseq and in_flight > 0:
+      self.resend_accepts(cseq, min(in_flight, RESEND_SLOTS))
+    leader.heartbeat_cseq = cseq
+
+  def watch_leader(self):
+    """Trusts the next node in order as leader if we haven't heard from the
+    one we trust for leader_timeout seconds, taking over if that's us."""
+    core.callDelayed(self.leader_timeout/2, self.watch_leader)
+    if self.leader is not None:
+      return
+    if time.time() - self.last_heartbeat < self.leader_timeout:
+      return
+
+    # Everybody picks the same node, and gives it leader_timeout seconds
+    nodes = sorted(self.state.N)
+    suspected = self.trusted
+    self.trusted = nodes[(nodes.index(suspected) + 1) % len(nodes)]
+    self.last_heartbeat = time.time()
+    self.log.warning("No word from leader {} in {} seconds, trusting {}".
+        format(suspected, self.leader_timeout, self.trusted))
+
+    if self.trusted == self.mac:
+      self.take_over()
+
+  def on_trust(self, event, message):
+    """Keeps trusting the leader that sent us a TRUST.  Slots it has
+    delivered are chosen, so we catch up on any we've missed, even when
+    we didn't hear a single vote for them."""
+    n, mac, cseq = PaxosMessage.unpack_trust(message)
+    mac = EthAddr(mac)
+
+    if cseq > 0:
+      self.state.slots.mark_learned(cseq - 1)
+      self.watch_gap()
+
+    if self.leader is not None:
+      if n > self.leader.n:
+        self.step_down(mac, n)
+      return EventHalt
+
+    if n < self.trusted_round:
+      self.log.debug("Ignoring TRUST n={} from old leader {}".format(n, mac))
+      return EventHalt
 
-  def rewrite_destinations(self, mac, dstip, raw_packet):
-    """Rewrites destination MAC and IP and updates checksums."""
-    eth = pkt.ethernet(raw=raw_packet)
-    eth.dst = mac
-
-    ip4 = eth.find(pkt.ipv4)
-    if ip4:
-      ip4.dst = mac
-      ip4.dstip = dstip
-      ip4.csum = ip4.checksum()
-      return eth
-
-    ip6 = eth.find(pkt.ipv6)
-    if ip6:
-      ip6.dst = mac
-      ip6.dstip = dstip
-      ip6.csum = ip6.checksum()
-      return eth
-
-    tcp = eth.find(pkt.tcp)
-    if tcp:
-      tcp.csum = tcp.checksum()
-      return eth
-
-    udp = eth.find(pkt.udp)
-    if udp:
-      udp.csum = udp.checksum()
-      return eth
-
-    return eth
+    if mac != self.trusted:
+      self.log.info("Trusting {} as leader in round {}".format(mac, n))
+    self.trusted = mac
+    self.trusted_round = n
+    self.last_heartbeat = time.time()
+    return EventHalt
+
+  def start_prepare(self):
+    """Leader: Sends a PREPARE for our round, covering all slots from the
+    next one we'll deliver on, and tries again later if we don't get
+    enough PROMISEs."""
+    self.prepare_attempt = (self.prepare_attempt + 1) & UINT16_MAX
+    n, base = self.leader.n, self.state.slots.cseq
+    self.prepare = Prepare(n, base, self.prepare_attempt,
+                           1 + self.state.node_count // 2)
+
+    self.log.info("PREPARE n={} seq={}..".format(n, base))
+    payload = PaxosMessage.pack_prepare(n, base, self.prepare_attempt)
+    for mac, port in self.plan:
+      self.send_to(mac, PaxosMessage.PREPARE, payload)
+
+    core.callDelayed(self.leader_timeout/2, self.check_prepare,
+                     self.prepare_attempt)
+
+  def check_prepare(self, attempt):
+    """Leader: Sends the PREPARE again if the given attempt is still
+    waiting for PROMISEs."""
+    if self.prepare is not None and self.prepare.attempt == attempt:
+      self.log.warning("Too few PROMISEs for n={}, trying again".format(
+        self.prepare.n))
+      self.start_prepare()
 
   def on_prepare(self, event, message):
-    self.log.critical("Unimplemented on_prepare, dropping")
-    self.switch.drop(event)
+    """Acceptor: Promises not to vote in rounds below that of a PREPARE,
+    and tells which values we've voted for from its base on."""
+    n, base, attempt = PaxosMessage.unpack_prepare(message)
+    src, dst = self.get_ether_addrs(event)
+    self.log.info("On PREPARE n={} seq={}.. from {}".format(n, base, src))
+
+    if n < self.state.crnd:
+      self.log.info("Already promised n={}, refusing".format(self.state.crnd))
+      self.send_to(src, PaxosMessage.PROMISE,
+                   PaxosMessage.pack_promise(self.state.crnd, attempt, 0, 0,
+                                             [], PROMISE_NACK)[0])
+      return EventHalt
+
+    # The promise must be durable before anyone hears of it
+    if n > self.state.crnd:
+      self.state.crnd = n
+      if self.wal is not None:
+        self.wal_mutex.acquire()
+        try:
+          self.wal.append_promise(n)
+          self.wal.commit()
+        finally:
+          self.wal_mutex.release()
+
+    if src != self.mac:
+      self.step_down(src, n)
+
+    votes, end = self.state.slots.accepted(base)
+    for payload in PaxosMessage.pack_promise(n, attempt,
+                                             self.state.slots.cseq, end,
+                                             votes):
+      self.send_to(src, PaxosMessage.PROMISE, payload)
     return EventHalt
 
   def on_promise(self, event, message):
-    self.log.critical("Unimplemented on_promise, dropping")
-    self.switch.drop(event)
-    return EventHalt
+    """Leader: Collects PROMISEs, finishing phase 1 once a quorum of nodes
+    has promised."""
+    header, chunks = PaxosMessage.unpack_promise(message)
+    n, attempt, index, count, flags, cseq, end = header
+    src, dst = self.get_ether_addrs(event)
 
-  def on_trust(self, event, message):
-    self.log.critical("Unimplemented on_trust, dropping")
-    self.switch.drop(event)
+    prepare = self.prepare
+    if prepare is None or attempt != prepare.attempt:
+      self.log.debug("Ignoring old PROMISE from {}".format(src))
+      return EventHalt
+
+    if flags & PROMISE_NACK:
+      # Rejecting votes below n is always safe, so we can go straight for
+      # a round above it
+      self.log.warning("{} refused n={}, having promised n={}".format(
+        src, prepare.n, n))
+      self.state.crnd = max(self.state.crnd, n)
+      self.leader.n = self.state.pickNext()
+      self.trusted_round = self.leader.n
+      self.start_prepare()
+      return EventHalt
+
+    if n != prepare.n:
+      return EventHalt
+
+    self.log.debug("On PROMISE n={} {}/{} from {}".format(n, index + 1,
+                                                         count, src))
+    prepare.add(src, index, count, cseq, end, chunks)
+    if prepare.done:
+      self.finish_prepare()
     return EventHalt
 
+  def finish_prepare(self):
+    """Leader: Proposes the values found in phase 1 again in our round, and
+    empty values for the slots nobody who promised voted for.  Slots
+    someone has delivered are chosen already, and we catch up on those."""
+    prepare = self.prepare
+    self.prepare = None
+    n = self.leader.n
+    values = prepare.values()
+
+    cseq = self.state.slots.cseq
+    if prepare.cseq > cseq:
+      self.state.slots.mark_learned(prepare.cseq - 1)
+      self.request_catchup(cseq, min(prepare.cseq - cseq, MAX_CATCHUP_COUNT),
+                           prepare.cseq_node)
+      self.watch_gap()
+
+    start = max(cseq, prepare.cseq)
+    if prepare.end > 0:
+      self.leader.seqno = prepare.end - 1
+    self.log.info("Phase 1 done for n={}, proposing seq={}..{} again".format(
+      n, start, prepare.end - 1))
+
+    self.outbound.begin()
+    try:
+      for seqno in xrange(start, prepare.end):
+        self.send_value(n, seqno,
+                        values.get(seqno, PaxosMessage.noop_value()))
+    finally:
+      self.outbound.end()
+
+    self.leader.prepared = True
+    self.admit_clients()
+
+  def send_to(self, dst, paxos_type, payload):
+    """Sends a Paxos message to one node, short-circuiting messages to
+    ourself."""
+    if dst == self.mac:
+      return self.dispatch_paxos(paxos_type, event=None, payload=payload)
+    return self.send_ethernet(src=self.mac,
+                              dst=dst,
+                              type=paxos_type,
+                              payload=payload,
+                              output_port=self.lookup_port(dst))
+
   def on_unknown(self, event, message):
     self.log.critical("Unimplemented on_unknown, dropping")
     self.switch.drop(event)
@@ -1044,7 +3014,7 @@ class PaxosController(object):
 
     m = of.ofp_packet_out(data=packet)
     m.actions.append(of.ofp_action_output(port=output_port))
-    return self.connection.send(m)
+    return self.outbound.send(m)
 
   def join_network(self):
     """Broadcast a PAXOS JOIN message to everyone.
@@ -1068,7 +3038,8 @@ class PaxosController(object):
         src = self.mac
         self.log.debug("Joining Paxos network, need {} more nodes".format(
           nodes_needed))
-        payload = PaxosMessage.pack_join(self.state.n_id, src.toRaw())
+        payload = PaxosMessage.pack_join(self.state.n_id, src.toRaw(),
+                                         self.capabilities)
         self.on_join(event=None, message=payload)
 
         # Wait for replies from all switches
@@ -1089,6 +3060,28 @@ class PaxosController(object):
     t.start()
 
 
+class PaxosControllers(object):
+  """The Paxos controllers started by launch, registered with POX as
+  core.PaxosControllers so they can be reconfigured while running, for
+  instance from the py component:
+
+    core.PaxosControllers.tune_client_batch(max_values=4)
+  """
+  def __init__(self):
+    self.controllers = {}
+
+  def add(self, controller):
+    """Adds a controller, replacing any earlier one with the same name."""
+    self.controllers[controller.name] = controller
+
+  def tune_client_batch(self, max_values=None, max_bytes=None, delay=None):
+    """Changes the limits for sealing batches of client values on all
+    controllers.  Limits given as None are left alone.  Batches started
+    before are sealed by the new limits."""
+    for controller in self.controllers.values():
+      controller.client_batcher.tune(max_values, max_bytes, delay)
+
+
 def add_flows_setting():
   """Returns add_flows setting from environment."""
   if "ADDFLOWS" in os.environ:
@@ -1096,17 +3089,162 @@ def add_flows_setting():
   else:
     return False
 
+def batch_accepts_setting():
+  """Returns batch_accepts setting from environment."""
+  if "BATCH_ACCEPTS" in os.environ:
+    return os.environ["BATCH_ACCEPTS"] == "1"
+  else:
+    return False
+
+def coalesce_learns_setting():
+  """Returns coalesce_learns setting from environment."""
+  if "COALESCE_LEARNS" in os.environ:
+    return os.environ["COALESCE_LEARNS"] == "1"
+  else:
+    return False
+
+def combine_accept_learn_setting():
+  """Returns combine_accept_learn setting from environment."""
+  if "COMBINE_ACCEPT_LEARN" in os.environ:
+    return os.environ["COMBINE_ACCEPT_LEARN"] == "1"
+  else:
+    return False
+
+def gc_sweep_setting():
+  """Returns gc_sweep setting from environment."""
+  if "GC_SWEEP" in os.environ:
+    return os.environ["GC_SWEEP"] == "1"
+  else:
+    return False
+
+def wal_setting():
+  """Returns write-ahead log path from environment, where {name} is
+  replaced by the switch name."""
+  return os.environ.get("WAL", None)
+
+def wal_durability_setting():
+  """Returns write-ahead log durability level from environment."""
+  durability = os.environ.get("WAL_DURABILITY", DURABILITY_FSYNC)
+  assert(durability in DURABILITY_LEVELS)
+  return durability
+
+def snapshot_interval_setting():
+  """Returns snapshot interval, in slots, from environment."""
+  return int(os.environ.get("SNAPSHOT_INTERVAL", 10000))
+
+def catchup_setting():
+  """Returns catchup setting from environment."""
+  if "CATCHUP" in os.environ:
+    return os.environ["CATCHUP"] == "1"
+  else:
+    return True
+
+def catchup_skip_setting():
+  """Returns catchup_skip setting from environment."""
+  if "CATCHUP_SKIP" in os.environ:
+    return os.environ["CATCHUP_SKIP"] == "1"
+  else:
+    return False
+
+def coalesce_writes_setting():
+  """Returns coalesce_writes setting from environment."""
+  if "COALESCE_WRITES" in os.environ:
+    return os.environ["COALESCE_WRITES"] == "1"
+  else:
+    return False
+
+def fanout_actions_setting():
+  """Returns fanout_actions setting from environment."""
+  if "FANOUT_ACTIONS" in os.environ:
+    return os.environ["FANOUT_ACTIONS"] == "1"
+  else:
+    return False
+
+def window_setting():
+  """Returns the leader's window of slots in flight from environment, where
+  0 means no limit."""
+  return int(os.environ.get("WINDOW", 4096))
+
+def client_queue_setting():
+  """Returns the number of client values the leader queues when its window
+  is full, from environment."""
+  return int(os.environ.get("CLIENT_QUEUE", 4096))
+
+def client_batch_setting():
+  """Returns client_batch setting from environment."""
+  if "CLIENT_BATCH" in os.environ:
+    return os.environ["CLIENT_BATCH"] == "1"
+  else:
+    return False
+
+def client_batch_values_setting():
+  """Returns the number of client values that seals a batch, from
+  environment."""
+  return int(os.environ.get("CLIENT_BATCH_VALUES", 16))
+
+def client_batch_bytes_setting():
+  """Returns the number of bytes that seals a batch of client values, from
+  environment."""
+  return int(os.environ.get("CLIENT_BATCH_BYTES", MAX_BATCH_BYTES))
+
+def client_batch_delay_setting():
+  """Returns the time in seconds after which a batch of client values is
+  sealed, given in microseconds in the environment."""
+  return int(os.environ.get("CLIENT_BATCH_USECS", 200)) / 1e6
+
+def heartbeat_interval_setting():
+  """Returns the seconds between the leader's heartbeats, from
+  environment."""
+  return float(os.environ.get("HEARTBEAT_INTERVAL", 0.1))
+
+def leader_timeout_setting():
+  """Returns the seconds without heartbeats after which the next node takes
+  over as leader, from environment."""
+  return float(os.environ.get("LEADER_TIMEOUT", 1.0))
+
+def compress_setting():
+  """Returns compress setting from environment."""
+  if "COMPRESS" in os.environ:
+    return os.environ["COMPRESS"] == "1"
+  else:
+    return ENABLE_ZLIB
+
 def launch():
   """Starts the controller."""
   log = core.getLogger()
   add_flows = add_flows_setting()
 
+  # Settings only used by the Paxos controllers
+  paxos_settings = {"batch_accepts": batch_accepts_setting(),
+                    "catchup": catchup_setting(),
+                    "catchup_skip": catchup_skip_setting(),
+                    "coalesce_learns": coalesce_learns_setting(),
+                    "coalesce_writes": coalesce_writes_setting(),
+                    "fanout_actions": fanout_actions_setting(),
+                    "combine_accept_learn": combine_accept_learn_setting(),
+                    "compress": compress_setting(),
+                    "gc_sweep": gc_sweep_setting(),
+                    "wal_path": wal_setting(),
+                    "wal_durability": wal_durability_setting(),
+                    "snapshot_interval": snapshot_interval_setting(),
+                    "window": window_setting(),
+                    "client_queue": client_queue_setting(),
+                    "client_batch": client_batch_setting(),
+                    "client_batch_values": client_batch_values_setting(),
+                    "client_batch_bytes": client_batch_bytes_setting(),
+                    "client_batch_delay": client_batch_delay_setting(),
+                    "heartbeat_interval": heartbeat_interval_setting(),
+                    "leader_timeout": leader_timeout_setting()}
+
   # Instruct nexus to send FULL packets to controllers (will slow down
   # everything!)
   core.openflow.miss_send_len = 65535
   log.debug("Setting core.openflow.miss_send_len to {}".format(
     core.openflow.miss_send_len))
 
+  controllers = PaxosControllers()
+  core.register(controllers)
+
   def start_controller(event):
     # NOTE: Here we have hardcoded the WAN switch from the topology.
     #       So this only works with the correct topology (PaxosTopology).
@@ -1118,9 +3256,16 @@ def launch():
     name = Controller.__name__
     log.info("Controller {}, add_flows={}".format(name, add_flows))
 
-    Controller(event.connection,
-               quit_on_connection_down=True,
-               add_flows=add_flows)
+    settings = {}
+    if Controller is PaxosController:
+      settings = paxos_settings
+
+    controller = Controller(event.connection,
+                            quit_on_connection_down=True,
+                            add_flows=add_flows,
+                            **settings)
+    if Controller is PaxosController:
+      controllers.add(controller)
 
   # Launch controller when we detect a connectionUp event
   core.openflow.addListenerByName("ConnectionUp", start_controller)
@@ -5,3 +5,32 @@ UINT64_MAX = (2 << 63) - 1
 UINT32_MAX = (2 << 31) - 1
 UINT16_MAX = (2 << 15) - 1
 UINT8_MAX  = (2 <<  7) - 1
+
+# Largest Ethernet payload we put on the wire (no jumbo frames)
+ETHERNET_MTU = 1500
+
+# Number of slots, from the next one to deliver, that a node keeps track of
+SLOT_WINDOW = 65536
+
+# Most slots a garbage collection sweep looks at while holding the queue lock
+GC_CHUNK = 1024
+
+# Number of recently delivered values a node keeps to answer catch-up
+# requests from lagging nodes
+CATCHUP_HISTORY = 4096
+
+# Most CATCHUP and CATCHUP_FRAG messages a node sends in answer to one
+# catch-up request
+CATCHUP_MESSAGES = 16
+
+# Most of its slots the leader sends the ACCEPTs for again when delivery
+# hasn't moved for a heartbeat
+RESEND_SLOTS = 16
+
+# Longest time in seconds a learner waits between catch-up requests for the
+# same gap
+CATCHUP_MAX_DELAY = 1.0
+
+# Number of client frames the leader keeps waiting for the rest of their
+# CLIENT_FRAGs
+CLIENT_FRAGMENTS = 64
@@ -2,13 +2,105 @@
 Contains stuff for working with Paxos messages.
 """
 
-from struct import pack, unpack
+from binascii import hexlify, unhexlify
+from struct import Struct
+import zlib
 
-from asserts import assert_u32
-from limits import UINT32_MAX
+from asserts import assert_u16, assert_u32
+from limits import ETHERNET_MTU, UINT16_MAX, UINT32_MAX
 
+# Whether nodes offer zlib-compression of values by default
 ENABLE_ZLIB = False
 
+# Values smaller than this are never compressed
+ZLIB_THRESHOLD = 128
+ZLIB_LEVEL = 6
+
+# Precompiled wire formats.  Compiling the format strings once saves
+# struct from parsing them again for every message we pack or unpack, which
+# adds up on the ACCEPT/LEARN path.
+JOIN_FORMAT = Struct("!I6s")   # (node id, raw MAC)
+CAPS_FORMAT = Struct("!B")     # optional capabilities after a JOIN
+VALUE_FORMAT = Struct("!BI")   # (flags, length) in front of each encoded
+                               # value
+LENGTH_FORMAT = Struct("!H")   # length of each client value in a batch
+HEADER_FORMAT = Struct("!II")  # (round, seqno), shared by ACCEPT, LEARN, CLIENT
+BATCH_FORMAT = Struct("!IH")   # (round, count) header of an ACCEPT_BATCH
+ENTRY_FORMAT = Struct("!IH")   # (seqno, length) of each ACCEPT_BATCH value
+ETHERTYPE_FORMAT = Struct("!H") # Ethernet type field
+RANGE_FORMAT = Struct("!IIHB") # (round, base seqno, count, flags) of a LEARN_RANGE
+FRAG_FORMAT = Struct("!IIHH")  # (round, seqno, index, total) of an ACCEPT_FRAG
+CLIENT_FRAG_FORMAT = Struct("!IHH") # (frame id, index, total) of a CLIENT_FRAG
+CATCHUP_FORMAT = Struct("!IH") # (base seqno, count) of a CATCHUP_REQUEST
+FLOW_FORMAT = Struct("!BH")    # (flags, hold time in ms) of a FLOW_CONTROL
+TRUST_FORMAT = Struct("!I6sI") # (round, raw MAC of the leader, next slot it
+                               #  will deliver)
+PREPARE_FORMAT = Struct("!IIH") # (round, base seqno, attempt)
+PROMISE_FORMAT = Struct("!IHHHBIIH") # (round, attempt, index, count, flags,
+                                     #  next to deliver, end, number of
+                                     #  votes) of a PROMISE
+VOTE_FORMAT = Struct("!IIIIH") # (seqno, round, length, offset, chunk length)
+                               # of each vote in a PROMISE
+
+# Maximum size of a Paxos message payload
+MAX_PAYLOAD = ETHERNET_MTU
+
+# LEARN_RANGE flag telling that a bitmap of the slots follows the header.
+# Without it, the range covers all count slots.
+RANGE_BITMAP = 0x01
+
+# Largest value that fits in one ACCEPT, and largest chunk of a value that
+# fits in one ACCEPT_FRAG
+MAX_ACCEPT_VALUE = MAX_PAYLOAD - HEADER_FORMAT.size
+MAX_FRAGMENT = MAX_PAYLOAD - FRAG_FORMAT.size
+
+# Largest client frame that fits in one CLIENT, and largest chunk of one
+# that fits in one CLIENT_FRAG
+MAX_CLIENT_FRAME = MAX_PAYLOAD - HEADER_FORMAT.size
+MAX_CLIENT_FRAGMENT = MAX_PAYLOAD - CLIENT_FRAG_FORMAT.size
+
+# Largest span of slots one LEARN_RANGE can cover
+MAX_RANGE_COUNT = min(0xFFFF, 8*(MAX_PAYLOAD - RANGE_FORMAT.size))
+
+# Largest span of slots one CATCHUP_REQUEST can ask for
+MAX_CATCHUP_COUNT = UINT16_MAX
+
+# Capability bits a node announces in its JOIN
+CAP_ZLIB = 0x01 # Can decompress zlib-compressed values
+CAP_BATCH = 0x02 # Can deliver batched client values
+
+# Flags in front of each encoded value
+VALUE_ZLIB = 0x01 # The value is zlib-compressed
+VALUE_BATCH = 0x02 # The value is several client values, each prefixed by
+                   # its length
+
+# Largest client value that can be put in a batch
+MAX_BATCHED_VALUE = UINT16_MAX
+
+# Most bytes of batched client values that still fit in one ACCEPT once
+# encoded
+MAX_BATCH_BYTES = MAX_ACCEPT_VALUE - VALUE_FORMAT.size
+
+# FLOW_CONTROL flag telling the WAN switch to hold back clients.  Without
+# it, clients may send again.
+FLOW_PAUSE = 0x01
+
+# PROMISE flag telling that the acceptor refused, having promised the round
+# in the message.
+PROMISE_NACK = 0x01
+
+def as_view(payload):
+  """Returns a zero-copy memoryview of payload."""
+  if isinstance(payload, memoryview):
+    return payload
+  return memoryview(payload)
+
+def as_bytes(value):
+  """Returns value as a str, copying only if it is a memoryview."""
+  if isinstance(value, memoryview):
+    return value.tobytes()
+  return value
+
 class PaxosMessage(object):
   """Interface for creating Paxos-specific messages."""
 
@@ -21,22 +113,76 @@ class PaxosMessage(object):
   # Not all values need this, so we could leave some space for even more
   # message types.
   #
+  # The BATCH bit marks messages that cover several slots at once, and the
+  # FRAG bit messages that cover only part of a slot's value or client
+  # frame.
+  #
   JOIN    = 0x7A00
   ACCEPT  = 0x7A01
   LEARN   = 0x7A02
   TRUST   = 0x7A04
   PROMISE = 0x7A08
+  BATCH   = 0x0010
   PREPARE = 0x7A20
   CLIENT  = 0x7A40
+  FRAG    = 0x0080
+
+  ACCEPT_BATCH = ACCEPT | BATCH
+  ACCEPT_FRAG  = ACCEPT | FRAG
+  CLIENT_FRAG  = CLIENT | FRAG
+
+  # The sender's vote (LEARN) for the slots it sends values for.  Same wire
+  # format as ACCEPT and ACCEPT_BATCH.
+  ACCEPT_LEARN       = ACCEPT | LEARN
+  ACCEPT_LEARN_BATCH = ACCEPT | LEARN | BATCH
+
+  # Votes for several slots at once: a RANGE_FORMAT header, then a bitmap of
+  # the slots if the RANGE_BITMAP flag is set.
+  LEARN_RANGE = LEARN | BATCH
+
+  # Every bit of the low byte is taken by the scheme above, but a message
+  # is never both a PREPARE and the PROMISE answering it.  Types with both
+  # bits set are therefore outside the bitfield scheme; the other bits just
+  # tell them apart.  They must not have the LEARN bit (see carries_vote).
+  OTHER = PREPARE | PROMISE
+
+  # A lagging learner asks a peer for the values of slots it is missing
+  # with a CATCHUP_REQUEST, and gets them back in a CATCHUP.  A CATCHUP has
+  # the same wire format as an ACCEPT_BATCH.  Values too large for one
+  # CATCHUP come in CATCHUP_FRAGs instead, with the same wire format as an
+  # ACCEPT_FRAG.
+  CATCHUP_REQUEST = OTHER
+  CATCHUP         = OTHER | BATCH
+  CATCHUP_FRAG    = OTHER | FRAG
+
+  # A peer that no longer remembers the slots asked for answers with a
+  # CATCHUP_SKIP telling the oldest slot it does remember.  Same wire format
+  # as a LEARN.
+  CATCHUP_SKIP    = OTHER | ACCEPT
+
+  # The leader tells the WAN controller to pause or resume sending CLIENT
+  # messages when its window of slots in flight fills up or drains.
+  FLOW_CONTROL    = OTHER | CLIENT
 
   typemap = {
-      ACCEPT:  "ACCEPT",
-      CLIENT:  "CLIENT",
-      JOIN:    "JOIN",
-      LEARN:   "LEARN",
-      PREPARE: "PREPARE",
-      PROMISE: "PROMISE",
-      TRUST:   "TRUST",
+      ACCEPT:       "ACCEPT",
+      ACCEPT_BATCH: "ACCEPT_BATCH",
+      ACCEPT_FRAG:  "ACCEPT_FRAG",
+      ACCEPT_LEARN: "ACCEPT_LEARN",
+      ACCEPT_LEARN_BATCH: "ACCEPT_LEARN_BATCH",
+      CATCHUP:      "CATCHUP",
+      CATCHUP_FRAG: "CATCHUP_FRAG",
+      CATCHUP_REQUEST: "CATCHUP_REQUEST",
+      CATCHUP_SKIP: "CATCHUP_SKIP",
+      CLIENT:       "CLIENT",
+      CLIENT_FRAG:  "CLIENT_FRAG",
+      FLOW_CONTROL: "FLOW_CONTROL",
+      JOIN:         "JOIN",
+      LEARN:        "LEARN",
+      LEARN_RANGE:  "LEARN_RANGE",
+      PREPARE:      "PREPARE",
+      PROMISE:      "PROMISE",
+      TRUST:        "TRUST",
   }
 
   @staticmethod
@@ -44,6 +190,12 @@ class PaxosMessage(object):
     """Checks whether Ethernet type has a PAXOS prefix."""
     return (ethernet_type & 0xFF00) == 0x7A00
 
+  @staticmethod
+  def carries_vote(ethernet_type):
+    """Checks whether a message type carries the sender's vote (LEARN).
+    The PAXOS prefix shares bits with LEARN, so it's masked off first."""
+    return (ethernet_type & 0x00FF & PaxosMessage.LEARN) != 0
+
   @staticmethod
   def is_known_paxos_type(ethernet_type):
     return ethernet_type in PaxosMessage.typemap
@@ -55,12 +207,13 @@ class PaxosMessage(object):
     return PaxosMessage.typemap[ethernet_type]
 
   @staticmethod
-  def pack_join(n_id, mac): # TODO: Don't need any payload here...
+  def pack_join(n_id, mac, capabilities=0): # TODO: Don't need any payload here...
     """Creates a PAXOS JOIN message.
 
     Arguments:
       n_id -- The instance's unique node id (unsigned 32-bit network order)
       mac -- The instance's MAC address in raw wire-format (a string).
+      capabilities -- Bitfield of CAP_* values the node supports.
 
     Note that we don't care about conforming to any particular ABI here
     (e.g. ARMs require word-alignment).  This is only a bachelor's thesis,
@@ -69,11 +222,14 @@ class PaxosMessage(object):
     Returns:
       A 10-byte message containing NODE_ID (unsigned 32-bit big-endian,
       network order, integer) and the raw MAC address (unsigned 48-bit
-      integer).
+      integer).  If there are any capabilities, they follow in an
+      eleventh byte.
     """
     assert_u32(n_id)
     assert(isinstance(mac, str) and len(mac) == 6)
-    return pack("!I", n_id) + mac
+    if capabilities == 0:
+      return JOIN_FORMAT.pack(n_id, mac)
+    return JOIN_FORMAT.pack(n_id, mac) + CAPS_FORMAT.pack(capabilities)
 
   @staticmethod
   def unpack_join(payload):
@@ -83,59 +239,452 @@ class PaxosMessage(object):
       Tuple of (mac, node_id) where the MAC-address is in raw format and
       node_id is an unsigned 32-bit integer in host endianness.
     """
-    assert(isinstance(payload, str) and len(payload) == 6+4)
-    n_id = unpack("!I", payload[0:4])[0]
-    mac = payload[4:]
-    return n_id, mac
+    assert(isinstance(payload, str) and
+           len(payload) in (JOIN_FORMAT.size, JOIN_FORMAT.size+1))
+    return JOIN_FORMAT.unpack_from(payload)
+
+  @staticmethod
+  def unpack_join_capabilities(payload):
+    """Returns the capabilities announced in a PAXOS JOIN message, which
+    is zero for the original 10-byte message."""
+    if len(payload) <= JOIN_FORMAT.size:
+      return 0
+    return CAPS_FORMAT.unpack_from(payload, JOIN_FORMAT.size)[0]
+
+  @staticmethod
+  def encode_value(value, compress=False, threshold=ZLIB_THRESHOLD):
+    """Encodes a client value for a slot, prefixed with VALUE_* flags.
+
+    If compress is set, values of at least threshold bytes are
+    zlib-compressed, unless that doesn't make them smaller.
+    """
+    return PaxosMessage._encode(0, as_bytes(value), compress, threshold)
+
+  @staticmethod
+  def encode_values(values, compress=False, threshold=ZLIB_THRESHOLD):
+    """Encodes several client values as one slot value, flagged with
+    VALUE_BATCH.  They're compressed together, as in encode_value."""
+    batch = "".join(LENGTH_FORMAT.pack(len(value)) + value
+                    for value in values)
+    return PaxosMessage._encode(VALUE_BATCH, batch, compress, threshold)
+
+  @staticmethod
+  def batched_size(value):
+    """Returns the number of bytes value takes up in a VALUE_BATCH."""
+    return LENGTH_FORMAT.size + len(value)
+
+  @staticmethod
+  def _encode(flags, value, compress, threshold):
+    if compress and len(value) >= threshold:
+      compressed = zlib.compress(value, ZLIB_LEVEL)
+      if len(compressed) < len(value):
+        return VALUE_FORMAT.pack(flags | VALUE_ZLIB,
+                                 len(compressed)) + compressed
+    return VALUE_FORMAT.pack(flags, len(value)) + value
+
+  @staticmethod
+  def noop_value():
+    """Returns a slot value delivering nothing, used by a new leader for
+    slots nobody it heard from voted for."""
+    return VALUE_FORMAT.pack(VALUE_BATCH, 0)
+
+  @staticmethod
+  def decode_value(encoded):
+    """Decodes a value made by encode_value, returning it as a str."""
+    return PaxosMessage._decode(encoded)[1]
+
+  @staticmethod
+  def decode_values(encoded):
+    """Decodes a value made by encode_value or encode_values, returning the
+    client values in it as a list of strs."""
+    flags, value = PaxosMessage._decode(encoded)
+    if not flags & VALUE_BATCH:
+      return [value]
+
+    values = []
+    offset = 0
+    while offset < len(value):
+      length = LENGTH_FORMAT.unpack_from(value, offset)[0]
+      offset += LENGTH_FORMAT.size
+      values.append(value[offset:offset+length])
+      offset += length
+    assert(offset == len(value))
+    return values
+
+  @staticmethod
+  def _decode(encoded):
+    """Returns (flags, value) of an encoded value, decompressing it.  Bytes
+    after the value, such as Ethernet padding, are ignored."""
+    view = as_view(encoded)
+    assert(len(view) >= VALUE_FORMAT.size)
+    flags, length = VALUE_FORMAT.unpack_from(view)
+    end = VALUE_FORMAT.size + length
+    assert(len(view) >= end)
+    value = view[VALUE_FORMAT.size:end].tobytes()
+    if flags & VALUE_ZLIB:
+      value = zlib.decompress(value)
+    return flags, value
 
   @staticmethod
   def pack_accept(crnd, seqno, cval):
     """Creates a PAXOS ACCEPT message."""
     assert_u32(crnd)
     assert_u32(seqno)
-    return pack("!I", crnd) + pack("!I", seqno) + cval
+    return HEADER_FORMAT.pack(crnd, seqno) + cval
 
   @staticmethod
   def unpack_accept(payload):
     """Unpacks a PAXOS ACCEPT message."""
     assert(isinstance(payload, str) and len(payload) >= 8)
-    n = unpack("!I", payload[0:4])[0]
-    s = unpack("!I", payload[4:8])[0]
+    n, s = HEADER_FORMAT.unpack_from(payload)
     v = payload[8:]
     return n, s, v
 
+  @staticmethod
+  def pack_accept_fragments(crnd, seqno, cval, chunk_size=MAX_FRAGMENT):
+    """Splits a value that is too large for one ACCEPT into PAXOS
+    ACCEPT_FRAG messages.
+
+    Returns:
+      List of packed messages, each carrying at most chunk_size bytes of
+      the value.
+    """
+    assert_u32(crnd)
+    assert_u32(seqno)
+    assert(chunk_size > 0)
+    view = as_view(cval)
+    total = max(1, (len(view) + chunk_size - 1) // chunk_size)
+    assert_u16(total)
+    return [FRAG_FORMAT.pack(crnd, seqno, index, total) +
+            view[index*chunk_size:(index+1)*chunk_size].tobytes()
+            for index in xrange(total)]
+
+  @staticmethod
+  def unpack_accept_fragment(payload):
+    """Unpacks a PAXOS ACCEPT_FRAG message without copying the chunk.
+
+    Returns:
+      Tuple of (n, seqno, index, total, chunk) where chunk is a memoryview
+      into payload.
+    """
+    view = as_view(payload)
+    assert(len(view) >= FRAG_FORMAT.size)
+    n, seqno, index, total = FRAG_FORMAT.unpack_from(view)
+    assert(index < total)
+    return n, seqno, index, total, view[FRAG_FORMAT.size:]
+
+  @staticmethod
+  def accept_batch_size(values):
+    """Returns size of an ACCEPT_BATCH message carrying the given values."""
+    return (BATCH_FORMAT.size +
+            sum(ENTRY_FORMAT.size + len(v) for v in values))
+
+  @staticmethod
+  def pack_accept_batch(crnd, entries):
+    """Creates a PAXOS ACCEPT_BATCH message.
+
+    Arguments:
+      crnd -- The round number, shared by all entries.
+      entries -- List of (seqno, value) tuples.
+
+    Each value is packed right into the message, without intermediate
+    strings.
+    """
+    assert_u32(crnd)
+    assert_u16(len(entries))
+    buf = bytearray(PaxosMessage.accept_batch_size(v for (_, v) in entries))
+    BATCH_FORMAT.pack_into(buf, 0, crnd, len(entries))
+    offset = BATCH_FORMAT.size
+    for seqno, value in entries:
+      assert_u32(seqno)
+      assert_u16(len(value))
+      ENTRY_FORMAT.pack_into(buf, offset, seqno, len(value))
+      offset += ENTRY_FORMAT.size
+      buf[offset:offset+len(value)] = value
+      offset += len(value)
+    return bytes(buf)
+
+  @staticmethod
+  def unpack_accept_batch(payload):
+    """Unpacks a PAXOS ACCEPT_BATCH message.
+
+    Returns:
+      Tuple of (n, entries) where entries is a list of (seqno, value).
+    """
+    assert(isinstance(payload, str))
+    n, count = BATCH_FORMAT.unpack_from(payload)
+    offset = BATCH_FORMAT.size
+    entries = []
+    for _ in xrange(count):
+      seqno, length = ENTRY_FORMAT.unpack_from(payload, offset)
+      offset += ENTRY_FORMAT.size
+      assert(offset + length <= len(payload))
+      entries.append((seqno, payload[offset:offset+length]))
+      offset += length
+    return n, entries
+
   @staticmethod
   def pack_learn(n, seqno):
     """Creates a PAXOS LEARN message."""
     # Almost same structure as ACCEPT
     assert_u32(n)
     assert_u32(seqno)
-    return pack("!I", n) + pack("!I", seqno)
+    return HEADER_FORMAT.pack(n, seqno)
 
   @staticmethod
   def unpack_learn(payload):
     """Unpacks a PAXOS LEARN message. """
     # Almost same structure as ACCEPT
-    assert(isinstance(payload, str) and len(payload) >= 8)
+    assert(len(payload) >= 8)
     # TODO: We should say that payload == 8, but while testing with
     # openvswitch, I didn't truncate the packet, so let it through
-    n = unpack("!I", payload[0:4])[0]
-    s = unpack("!I", payload[4:8])[0]
-    return n, s
+    return HEADER_FORMAT.unpack_from(payload)
+
+  @staticmethod
+  def pack_learn_range(n, base, count, bitmap=None):
+    """Creates a PAXOS LEARN_RANGE message, which is a LEARN for several
+    slots in round n.
+
+    Arguments:
+      n -- Round number.
+      base -- Lowest sequence number covered.
+      count -- Number of slots covered, starting at base.
+      bitmap -- Integer where bit i set means a LEARN for slot base+i.  If
+                None, the message is a LEARN for all count slots.
+    """
+    assert_u32(n)
+    assert_u32(base)
+    assert_u16(count)
+    if bitmap is None:
+      return RANGE_FORMAT.pack(n, base, count, 0)
+
+    # Send the bitmap as little-endian bytes, so bit i is slot base+i
+    assert(0 <= bitmap < (1 << count))
+    size = (count + 7) // 8
+    raw = unhexlify("%0*x" % (2*size, bitmap))[::-1] if size > 0 else ""
+    return RANGE_FORMAT.pack(n, base, count, RANGE_BITMAP) + raw
+
+  @staticmethod
+  def unpack_learn_range(payload):
+    """Unpacks a PAXOS LEARN_RANGE message.
+
+    Returns:
+      Tuple of (n, base, count, bitmap), where bit i of the integer bitmap
+      tells whether this is a LEARN for slot base+i.
+    """
+    assert(len(payload) >= RANGE_FORMAT.size)
+    n, base, count, flags = RANGE_FORMAT.unpack_from(payload)
+    if not (flags & RANGE_BITMAP):
+      return n, base, count, (1 << count) - 1
+
+    size = (count + 7) // 8
+    start = RANGE_FORMAT.size
+    assert(len(payload) >= start + size)
+    raw = payload[start:start+size][::-1]
+    bitmap = int(hexlify(raw), 16) if size > 0 else 0
+    return n, base, count, bitmap & ((1 << count) - 1)
+
+  @staticmethod
+  def range_seqnos(base, bitmap):
+    """Returns sorted list of sequence numbers set in a LEARN_RANGE
+    bitmap."""
+    bits = bin(bitmap)[:1:-1] # least significant bit first
+    return [base + i for (i, bit) in enumerate(bits) if bit == "1"]
+
+  @staticmethod
+  def pack_catchup_request(base, count):
+    """Creates a PAXOS CATCHUP_REQUEST message, asking for the delivered
+    values of count slots starting at base."""
+    assert_u32(base)
+    assert_u16(count)
+    return CATCHUP_FORMAT.pack(base, count)
+
+  @staticmethod
+  def unpack_catchup_request(payload):
+    """Unpacks a PAXOS CATCHUP_REQUEST message into (base, count)."""
+    assert(len(payload) >= CATCHUP_FORMAT.size)
+    return CATCHUP_FORMAT.unpack_from(payload)
+
+  @staticmethod
+  def pack_flow_control(pause, hold):
+    """Creates a PAXOS FLOW_CONTROL message, telling the WAN controller to
+    pause clients for at most hold milliseconds, or to resume them."""
+    assert_u16(hold)
+    return FLOW_FORMAT.pack(FLOW_PAUSE if pause else 0, hold)
+
+  @staticmethod
+  def unpack_flow_control(payload):
+    """Unpacks a PAXOS FLOW_CONTROL message into (pause, hold)."""
+    assert(len(payload) >= FLOW_FORMAT.size)
+    flags, hold = FLOW_FORMAT.unpack_from(payload)
+    return bool(flags & FLOW_PAUSE), hold
+
+  @staticmethod
+  def pack_trust(n, mac, cseq):
+    """Creates a PAXOS TRUST message, sent by the leader of round n to tell
+    the others to keep trusting it, and that it has delivered all slots
+    below cseq."""
+    assert_u32(n)
+    assert_u32(cseq)
+    return TRUST_FORMAT.pack(n, mac, cseq)
+
+  @staticmethod
+  def unpack_trust(payload):
+    """Unpacks a PAXOS TRUST message into (n, raw MAC, cseq)."""
+    assert(len(payload) >= TRUST_FORMAT.size)
+    return TRUST_FORMAT.unpack_from(payload)
+
+  @staticmethod
+  def pack_prepare(n, base, attempt):
+    """Creates a PAXOS PREPARE message for round n, covering all slots from
+    base on."""
+    assert_u32(n)
+    assert_u32(base)
+    assert_u16(attempt)
+    return PREPARE_FORMAT.pack(n, base, attempt)
+
+  @staticmethod
+  def unpack_prepare(payload):
+    """Unpacks a PAXOS PREPARE message into (n, base, attempt)."""
+    assert(len(payload) >= PREPARE_FORMAT.size)
+    return PREPARE_FORMAT.unpack_from(payload)
+
+  @staticmethod
+  def pack_promise(n, attempt, cseq, end, votes, flags=0,
+                   max_size=MAX_PAYLOAD):
+    """Creates the PAXOS PROMISE messages answering a PREPARE.
+
+    Arguments:
+      n -- The round promised, or with PROMISE_NACK, the one we already had.
+      attempt -- The attempt of the PREPARE we answer.
+      cseq -- The next slot we'll deliver.  All below it are chosen.
+      end -- One past the highest slot we know anything about.
+      votes -- List of (seqno, round, value) of our votes from the PREPARE's
+               base on.  Values are split over several messages if need be.
+
+    Returns:
+      List of packed messages, each at most max_size bytes.
+    """
+    assert_u32(n)
+    assert_u16(attempt)
+    assert_u32(cseq)
+    assert_u32(end)
+    room = max_size - PROMISE_FORMAT.size
+    assert(room > VOTE_FORMAT.size)
+
+    messages = [[]]
+    size = 0
+    for seqno, vrnd, value in votes:
+      value = as_bytes(value)
+      offset = 0
+      while True:
+        free = room - size - VOTE_FORMAT.size
+        if free <= 0:
+          messages.append([])
+          size = 0
+          continue
+        chunk = value[offset:offset+free]
+        messages[-1].append(VOTE_FORMAT.pack(seqno, vrnd, len(value), offset,
+                                             len(chunk)) + chunk)
+        size += VOTE_FORMAT.size + len(chunk)
+        offset += len(chunk)
+        if offset >= len(value):
+          break
+
+    count = len(messages)
+    assert_u16(count)
+    return [PROMISE_FORMAT.pack(n, attempt, index, count, flags, cseq, end,
+                                len(message)) +
+            "".join(message) for index, message in enumerate(messages)]
+
+  @staticmethod
+  def unpack_promise(payload):
+    """Unpacks a PAXOS PROMISE message.
+
+    Returns:
+      Tuple of ((n, attempt, index, count, flags, cseq, end), chunks) where
+      chunks is a list of (seqno, round, length, offset, chunk) of parts of
+      the votes.  Bytes after the last vote, such as Ethernet padding, are
+      ignored.
+    """
+    view = as_view(payload)
+    assert(len(view) >= PROMISE_FORMAT.size)
+    fields = PROMISE_FORMAT.unpack_from(view)
+    header, votes = fields[:-1], fields[-1]
+
+    chunks = []
+    offset = PROMISE_FORMAT.size
+    for _ in xrange(votes):
+      seqno, vrnd, length, start, size = VOTE_FORMAT.unpack_from(view, offset)
+      offset += VOTE_FORMAT.size
+      chunks.append((seqno, vrnd, length, start,
+                     view[offset:offset+size].tobytes()))
+      offset += size
+    assert(offset <= len(view))
+    return header, chunks
 
   @staticmethod
   def pack_client(payload):
     """Creates a PAXOS CLIENT message.
 
-    Here we could to stuff like zlib-compress. I've tried it, and it works,
-    but it's not part of the thesis. Just shows how easy it is to try out
-    new stuff.
+    The leader may zlib-compress the value when it turns it into a slot
+    value (see encode_value).
 
     However, to ease development, we add placeholders for two 32-bit
     unsigned integers, so we can rebroadcast the packet with parameters when
     the Paxos leader gets a PAXOS CLIENT message.
     """
-    return pack("!I", 0) + pack("!I", 0) + payload
+    return HEADER_FORMAT.pack(0, 0) + payload
+
+  @staticmethod
+  def pack_client_fragments(frame_id, payload, chunk_size=MAX_CLIENT_FRAGMENT):
+    """Splits a client frame that is too large for one CLIENT into PAXOS
+    CLIENT_FRAG messages, tagged with frame_id.
+
+    Returns:
+      List of packed messages, each carrying at most chunk_size bytes of
+      the frame.
+    """
+    assert_u32(frame_id)
+    assert(chunk_size > 0)
+    total = max(1, (len(payload) + chunk_size - 1) // chunk_size)
+    assert_u16(total)
+    return [CLIENT_FRAG_FORMAT.pack(frame_id, index, total) +
+            payload[index*chunk_size:(index+1)*chunk_size]
+            for index in xrange(total)]
+
+  @staticmethod
+  def unpack_client_fragment(payload):
+    """Unpacks a PAXOS CLIENT_FRAG message without copying the chunk.
+
+    Returns:
+      Tuple of (frame id, index, total, chunk) where chunk is a memoryview
+      into payload.
+    """
+    view = as_view(payload)
+    assert(len(view) >= CLIENT_FRAG_FORMAT.size)
+    frame_id, index, total = CLIENT_FRAG_FORMAT.unpack_from(view)
+    assert(index < total)
+    return frame_id, index, total, view[CLIENT_FRAG_FORMAT.size:]
+
+  @staticmethod
+  def wrap_client_frame(frame, frame_id=0):
+    """Wraps a raw Ethernet frame in a PAXOS CLIENT frame with the same
+    source and destination addresses, working on the bytes directly.  A
+    frame too large for one CLIENT is split over CLIENT_FRAGs tagged with
+    frame_id instead.
+
+    Returns:
+      List of wrapped frames.
+    """
+    assert(isinstance(frame, str) and len(frame) >= 14)
+    if len(frame) <= MAX_CLIENT_FRAME:
+      return [frame[0:12] + ETHERTYPE_FORMAT.pack(PaxosMessage.CLIENT) +
+              PaxosMessage.pack_client(frame)]
+
+    header = frame[0:12] + ETHERTYPE_FORMAT.pack(PaxosMessage.CLIENT_FRAG)
+    return [header + payload for payload in
+            PaxosMessage.pack_client_fragments(frame_id, frame)]
 
   @staticmethod
   def unpack_client(payload):
@@ -0,0 +1,102 @@
+"""
+Rewrites the destination of raw Ethernet frames.
+
+Learners deliver each value to all of their hosts, with the destination MAC
+and IP addresses set to each host's.  Instead of parsing the frame with the
+packet library and computing all checksums again for every host, we find
+the header offsets once, and then patch the addresses of a copy of the frame
+for each host, adjusting the checksums incrementally (RFC 1624).
+"""
+
+from struct import Struct
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_VLAN = 0x8100
+
+PROTO_TCP = 6
+PROTO_UDP = 17
+
+U16_FORMAT = Struct("!H")
+IP_FORMAT = Struct("!HH") # An IPv4 address as two 16-bit words
+
+def checksum_adjust(csum, old, new):
+  """Returns the Internet checksum csum adjusted for the 16-bit words old
+  being changed into new, as in RFC 1624, eqn. 3: HC' = ~(~HC + ~m + m')."""
+  total = ~csum & 0xFFFF
+  for word in old:
+    total += ~word & 0xFFFF
+  for word in new:
+    total += word
+  while total > 0xFFFF:
+    total = (total & 0xFFFF) + (total >> 16)
+  return ~total & 0xFFFF
+
+class FrameTemplate(object):
+  """A raw Ethernet frame, parsed once, that can be copied with new
+  destination addresses."""
+  def __init__(self, frame):
+    self.frame = bytearray(frame)
+    self.ip_offset = None     # Destination IP address, if IPv4
+    self.ip_csum_offset = None
+    self.l4_csum_offset = None # TCP or UDP checksum covering the IP address
+    self.udp = False
+    self.parse()
+
+  def parse(self):
+    frame = self.frame
+    if len(frame) < 14:
+      return
+
+    offset = 12
+    ethertype = U16_FORMAT.unpack_from(frame, offset)[0]
+    if ethertype == ETHERTYPE_VLAN and len(frame) >= 18:
+      offset += 4
+      ethertype = U16_FORMAT.unpack_from(frame, offset)[0]
+    offset += 2
+
+    if ethertype != ETHERTYPE_IPV4 or len(frame) < offset + 20:
+      return
+
+    ihl = 4*(frame[offset] & 0x0F)
+    if ihl < 20 or len(frame) < offset + ihl:
+      return
+    self.ip_offset = offset + 16
+    self.ip_csum_offset = offset + 10
+
+    # Only the first fragment has the TCP or UDP header
+    fragment = U16_FORMAT.unpack_from(frame, offset + 6)[0] & 0x1FFF
+    if fragment != 0:
+      return
+
+    protocol = frame[offset + 9]
+    l4 = offset + ihl
+    if protocol == PROTO_TCP and len(frame) >= l4 + 18:
+      self.l4_csum_offset = l4 + 16
+    elif protocol == PROTO_UDP and len(frame) >= l4 + 8:
+      # A zero UDP checksum means there is none
+      if U16_FORMAT.unpack_from(frame, l4 + 6)[0] != 0:
+        self.l4_csum_offset = l4 + 6
+        self.udp = True
+
+  def rewrite(self, mac, ip):
+    """Returns a copy of the frame sent to the given raw MAC and IPv4
+    addresses.  The IP address is left alone if the frame is not IPv4."""
+    frame = bytearray(self.frame)
+    frame[0:6] = mac
+    if self.ip_offset is None:
+      return bytes(frame)
+
+    old = IP_FORMAT.unpack_from(frame, self.ip_offset)
+    new = IP_FORMAT.unpack(ip)
+    frame[self.ip_offset:self.ip_offset+4] = ip
+
+    for offset in (self.ip_csum_offset, self.l4_csum_offset):
+      if offset is None:
+        continue
+      csum = U16_FORMAT.unpack_from(frame, offset)[0]
+      csum = checksum_adjust(csum, old, new)
+      if offset == self.l4_csum_offset and self.udp and csum == 0:
+        csum = 0xFFFF # Zero would mean no UDP checksum
+      U16_FORMAT.pack_into(frame, offset, csum)
+
+    return bytes(frame)
@@ -0,0 +1,164 @@
+"""
+Write-ahead log for the Paxos acceptor.
+
+An acceptor must remember the round it has promised and the values it has
+voted for across restarts, or it may vote differently for the same slot
+later on.  We append a record for each of those to a log, and make the
+records durable in groups (group commit) before any vote for them is sent.
+
+Learners also log how far they've delivered, committed along with the
+votes, so a restarted node resumes delivery where it left off.  Values
+delivered after the last commit are delivered again after a crash.
+
+Learners periodically write a snapshot of how far they've delivered.
+Records for slots below the snapshot are then dropped from the log, so
+recovery only has to replay the tail.
+"""
+
+from struct import Struct
+import os
+
+from asserts import assert_u32
+
+# Record kinds
+RECORD_ACCEPT = 1 # (round, seqno, value) we voted for
+RECORD_PROMISE = 2 # (round) we promised a new leader, with seqno 0
+RECORD_DELIVERED = 3 # (seqno) below which we've delivered, with round 0
+
+# (kind, round, seqno, length of value) in front of each record
+RECORD_FORMAT = Struct("!BIII")
+
+# (next seqno to deliver, current round) of a snapshot
+SNAPSHOT_FORMAT = Struct("!II")
+
+# Durability levels
+DURABILITY_NONE = "none"   # Write records, leave them in our buffers
+DURABILITY_FLUSH = "flush" # Hand records to the OS (survives a crash)
+DURABILITY_FSYNC = "fsync" # Put records on disk (survives power loss)
+
+DURABILITY_LEVELS = (DURABILITY_NONE, DURABILITY_FLUSH, DURABILITY_FSYNC)
+
+def pack_record(kind, n, seqno, value=""):
+  """Creates a log record."""
+  assert_u32(n)
+  assert_u32(seqno)
+  return RECORD_FORMAT.pack(kind, n, seqno, len(value)) + value
+
+def read_records(path):
+  """Returns all (kind, n, seqno, value) records in the log at path.  A
+  torn record at the end, from a crash while writing, is ignored."""
+  if not os.path.exists(path):
+    return []
+
+  with open(path, "rb") as f:
+    data = f.read()
+
+  records = []
+  offset = 0
+  while offset + RECORD_FORMAT.size <= len(data):
+    kind, n, seqno, length = RECORD_FORMAT.unpack_from(data, offset)
+    offset += RECORD_FORMAT.size
+    if offset + length > len(data):
+      break
+    records.append((kind, n, seqno, data[offset:offset+length]))
+    offset += length
+  return records
+
+
+def replace_file(path, data):
+  """Atomically replaces the file at path with data."""
+  tmp = path + ".tmp"
+  with open(tmp, "wb") as f:
+    f.write(data)
+    f.flush()
+    os.fsync(f.fileno())
+  os.rename(tmp, path)
+
+def write_snapshot(path, cseq, crnd):
+  """Atomically writes a snapshot saying that all slots below cseq have
+  been delivered, in round crnd."""
+  assert_u32(cseq)
+  assert_u32(crnd)
+  replace_file(path, SNAPSHOT_FORMAT.pack(cseq, crnd))
+
+def read_snapshot(path):
+  """Returns (cseq, crnd) of the snapshot at path, or None if there is
+  none."""
+  if not os.path.exists(path):
+    return None
+
+  with open(path, "rb") as f:
+    data = f.read()
+  if len(data) != SNAPSHOT_FORMAT.size:
+    return None
+  return SNAPSHOT_FORMAT.unpack(data)
+
+
+class AcceptorLog(object):
+  """An append-only log of acceptor records with group commit."""
+  def __init__(self, path, durability=DURABILITY_FSYNC):
+    assert(durability in DURABILITY_LEVELS)
+    self.path = path
+    self.durability = durability
+    self.pending = []  # Records appended since the last commit
+    self.commits = 0   # Number of group commits
+    self.records = 0   # Number of records committed
+    self.file = open(path, "ab")
+
+  def append(self, kind, n, seqno, value=""):
+    """Adds a record to the next group commit."""
+    self.pending.append(pack_record(kind, n, seqno, value))
+
+  def append_accept(self, n, seqno, value):
+    """Adds a record of our vote for value in slot seqno, round n."""
+    self.append(RECORD_ACCEPT, n, seqno, value)
+
+  def append_promise(self, n):
+    """Adds a record of our promise not to vote in rounds below n."""
+    self.append(RECORD_PROMISE, n, 0)
+
+  def append_delivered(self, cseq):
+    """Adds a record saying that all slots below cseq have been
+    delivered."""
+    self.append(RECORD_DELIVERED, 0, cseq)
+
+  @property
+  def dirty(self):
+    """Checks if there are records waiting to be committed."""
+    return len(self.pending) > 0
+
+  def commit(self):
+    """Writes all pending records in one go, making them as durable as the
+    durability level says.  Returns the number of records written."""
+    if len(self.pending) == 0:
+      return 0
+
+    count = len(self.pending)
+    self.file.write("".join(self.pending))
+    self.pending = []
+
+    if self.durability != DURABILITY_NONE:
+      self.file.flush()
+    if self.durability == DURABILITY_FSYNC:
+      os.fsync(self.file.fileno())
+
+    self.commits += 1
+    self.records += count
+    return count
+
+  def truncate(self, seqno):
+    """Drops the records of votes and deliveries for slots below seqno, by
+    atomically rewriting the log.  Returns the number of records kept."""
+    self.commit()
+    self.file.close()
+
+    kept = [record for record in read_records(self.path)
+            if record[0] == RECORD_PROMISE or record[2] >= seqno]
+    replace_file(self.path, "".join(pack_record(*record) for record in kept))
+
+    self.file = open(self.path, "ab")
+    return len(kept)
+
+  def close(self):
+    self.commit()
+    self.file.close()
@@ -0,0 +1,74 @@
+"""
+Benchmarks control channel usage for delivering a value to our hosts.
+
+Compares sending one packet-out per host, each with its own rewritten copy
+of the value, with sending one packet-out carrying the value once and, for
+each host, actions setting its destination MAC and IP addresses and
+outputting the packet.
+
+Prints the bytes sent to the switch per committed slot, and the controller
+CPU time to build and pack them, for several numbers of hosts and value
+sizes.
+"""
+
+from struct import pack
+import time
+
+from pox.lib.addresses import EthAddr, IPAddr
+import pox.openflow.libopenflow_01 as of
+
+from paxos.rewrite import FrameTemplate
+
+ROUNDS = 2000
+
+def udp_frame(size):
+  ip = pack("!BBHHHBBH4s4s", 0x45, 0, 20 + 8 + size, 0, 0, 64, 17, 0,
+            IPAddr("10.1.0.1").toRaw(), IPAddr("10.0.0.100").toRaw())
+  udp = pack("!HHHH", 1234, 4321, 8 + size, 0)
+  return ("\x00"*6 + "\x00\x00\x00\x00\xaa\x01" + "\x08\x00" + ip + udp +
+          "x"*size)
+
+def hosts(count):
+  return [(EthAddr("00:00:00:00:01:%02x" % port),
+           IPAddr("10.0.1.%d" % port), port) for port in xrange(1, count+1)]
+
+def per_host(frame, hosts):
+  """Returns the packed packet-outs of one packet-out per host."""
+  template = FrameTemplate(frame)
+  messages = []
+  for (mac, ip, port) in hosts:
+    m = of.ofp_packet_out(data=template.rewrite(mac.toRaw(), ip.toRaw()))
+    m.actions.append(of.ofp_action_output(port=port))
+    messages.append(m.pack())
+  return messages
+
+def fanout(frame, hosts):
+  """Returns the packed packet-out with actions for all hosts."""
+  m = of.ofp_packet_out(data=frame)
+  for (mac, ip, port) in hosts:
+    m.actions.append(of.ofp_action_dl_addr.set_dst(mac))
+    m.actions.append(of.ofp_action_nw_addr.set_dst(ip))
+    m.actions.append(of.ofp_action_output(port=port))
+  return [m.pack()]
+
+def measure(deliver, frame, hosts):
+  """Returns (bytes, CPU seconds) per committed slot."""
+  size = sum(len(m) for m in deliver(frame, hosts))
+  start = time.clock()
+  for _ in xrange(ROUNDS):
+    deliver(frame, hosts)
+  return size, (time.clock() - start) / ROUNDS
+
+def main():
+  print("%-6s %6s %12s %12s %10s %10s" % ("hosts", "value", "bytes/slot",
+        "fanout", "CPU us", "fanout"))
+  for count in (3, 8):
+    for size in (64, 512, 1400):
+      frame = udp_frame(size)
+      before, before_cpu = measure(per_host, frame, hosts(count))
+      after, after_cpu = measure(fanout, frame, hosts(count))
+      print("%-6d %6d %12d %12d %10.1f %10.1f" % (count, len(frame), before,
+            after, 1e6*before_cpu, 1e6*after_cpu))
+
+if __name__ == "__main__":
+  main()
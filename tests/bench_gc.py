@@ -0,0 +1,145 @@
+"""
+Benchmarks commit latency while slots are garbage collected.
+
+Compares the original Slots (a dict of slots and a set of processed slots,
+swept in full while holding the queue mutex) with the ring buffer window,
+which evicts slots as they are delivered and only sweeps in bounded chunks.
+
+One thread commits slots as fast as it can (ACCEPT, two LEARNs and
+delivery), while another collects garbage every GC_INTERVAL seconds.  The
+controller does this every 5-10 seconds; we do it more often to get many
+collections in a short run.
+
+Prints commit latency percentiles in microseconds, for the ring buffer both
+with and without the optional sweep.
+"""
+
+import threading
+import time
+
+from paxos.controller.paxosctrl import Slots
+
+SLOTS = 300000
+GC_INTERVAL = 0.25
+
+# The original slots, verbatim but without logging
+class OldSlot(object):
+  def __init__(self, vrnd, vval, node_count):
+    self.vrnd = vrnd
+    self.vval = vval
+    self.learns = set()
+    self.hrnd = 0
+    self.node_count = node_count
+
+  @property
+  def votes(self):
+    return len(self.learns)
+
+  def update_learns(self, obj):
+    self.learns.update([obj])
+
+  @property
+  def required_learns(self):
+    return 1 + self.node_count // 2
+
+  @property
+  def learned(self):
+    return self.votes >= self.required_learns
+
+class OldSlots(object):
+  def __init__(self, node_count=None):
+    self.slots = {}
+    self._node_count = node_count
+    self._cseq = 0
+    self.processed = set()
+    self.queue_mutex = threading.Lock()
+
+  def queue(self, n):
+    self.queue_mutex.acquire()
+    try:
+      while self._cseq in self.slots:
+        assert(not self.is_processed(n, self._cseq))
+        slot = self.slots[self._cseq]
+        if not slot.learned:
+          return
+        yield self._cseq, self.slots[self._cseq]
+        self._cseq += 1
+    finally:
+      self.queue_mutex.release()
+
+  def garbage_collect(self, n, log=None):
+    self.queue_mutex.acquire()
+    try:
+      for (seqno, slot) in self.slots.items():
+        if self.is_processed(n, seqno):
+          del self.slots[seqno]
+    finally:
+      self.queue_mutex.release()
+
+  def get_slot(self, seqno):
+    self.queue_mutex.acquire()
+    try:
+      if not seqno in self.slots:
+        self.slots[seqno] = OldSlot(None, None, self._node_count)
+      return self.slots[seqno]
+    finally:
+      self.queue_mutex.release()
+
+  def set_processed(self, n, seqno):
+    self.processed.update([(n, seqno)])
+
+  def is_processed(self, n, seqno):
+    return (n, seqno) in self.processed
+
+def old_commit(slots, n, seqno):
+  slot = slots.get_slot(seqno)
+  slot.vrnd, slot.vval = n, "x"
+  for src in ("a", "b"):
+    slots.get_slot(seqno).update_learns(src)
+  for seqno, slot in slots.queue(n):
+    slots.set_processed(n, seqno)
+
+def new_commit(slots, n, seqno):
+  slot = slots.get_slot(seqno)
+  slot.vrnd, slot.vval = n, "x"
+  for src in (1, 2):
+    slots.update_learns(n, src, [seqno])
+  slots.take_ready()
+
+def run(slots, commit, sweep=True):
+  """Returns sorted commit latencies in seconds."""
+  done = []
+  def collect():
+    while not done:
+      time.sleep(GC_INTERVAL)
+      if sweep:
+        slots.garbage_collect(1)
+
+  gc = threading.Thread(target=collect)
+  gc.start()
+  latencies = []
+  for seqno in xrange(SLOTS):
+    start = time.time()
+    commit(slots, 1, seqno)
+    latencies.append(time.time() - start)
+  done.append(True)
+  gc.join()
+  return sorted(latencies)
+
+def percentile(values, p):
+  return values[min(len(values)-1, int(len(values)*p))]
+
+def main():
+  print("%-15s %10s %10s %10s %10s" % ("gc", "p50 us", "p99 us",
+                                       "p99.9 us", "max us"))
+  for name, slots, commit, sweep in [
+      ("before", OldSlots(3), old_commit, True),
+      ("after, sweep", Slots(3), new_commit, True),
+      ("after", Slots(3), new_commit, False)]:
+    v = run(slots, commit, sweep)
+    print("%-15s %10.1f %10.1f %10.1f %10.1f" % (name,
+      1e6*percentile(v, 0.50), 1e6*percentile(v, 0.99),
+      1e6*percentile(v, 0.999), 1e6*v[-1]))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,136 @@
+"""
+Benchmarks finding our hosts for each delivered value in PaxosController.
+
+Compares the original lookup (host_addresses_known and the hosts property,
+both going through all switch ports and scanning the switch's MAC table
+for each of them) with the HostIndex kept up to date as addresses are
+learned.
+
+Prints lookups per second for a switch with three hosts, as in our
+topology, and for one with more hosts and a fuller MAC table.
+"""
+
+import time
+
+from pox.lib.addresses import EthAddr, IPAddr
+
+from paxos.controller.baseline import BaselineController
+from paxos.controller.paxosctrl import HostIndex
+
+class Switch(object):
+  """The address tables and lookups of BaselineController."""
+  def __init__(self):
+    self.macports = {}
+    self.macip = {}
+
+  port_to_mac = BaselineController.__dict__["port_to_mac"]
+  mac_to_ip = BaselineController.__dict__["mac_to_ip"]
+
+class Topology(object):
+  def __init__(self, hosts, paxos_nodes=2, remote_macs=0):
+    self.ports = range(1, hosts + paxos_nodes + 1) + [65534]
+    self.paxos_ports = {}
+    self.wan_port = None
+    self.switch = Switch()
+    self.index = HostIndex()
+
+    for port in xrange(1, hosts + 1):
+      mac = EthAddr("00:00:00:00:%02x:%02x" % (port >> 8, port & 0xFF))
+      ip = IPAddr("10.0.%d.%d" % (port >> 8, port & 0xFF))
+      self.learn(mac, port, ip)
+
+    # Other Paxos nodes, and hosts behind them
+    for index in xrange(paxos_nodes):
+      port = hosts + 1 + index
+      mac = EthAddr("00:00:00:01:00:%02x" % index)
+      self.paxos_ports[mac] = port
+      self.index.exclude(port)
+      self.learn(mac, port)
+      for remote in xrange(remote_macs):
+        self.learn(EthAddr("00:00:00:02:%02x:%02x" % (index, remote)), port)
+
+  def learn(self, mac, port, ip=None):
+    self.switch.macports[mac] = port
+    self.index.learn_port(mac, port)
+    if ip is not None:
+      self.switch.macip[mac] = ip
+      self.index.learn_ip(mac, ip)
+
+# The original lookups, without logging
+def old_hosts_known(self):
+  count = 0
+  for port in self.ports:
+    if port in self.paxos_ports.values():
+      continue
+    if port > 65000:
+      continue
+    macs = self.switch.port_to_mac(port, default=False)
+    if not macs:
+      continue
+    if len(macs) != 1:
+      continue
+    mac = macs[0]
+    if not self.switch.mac_to_ip(mac, default=False):
+      continue
+    count += 1
+
+  paxos_ports = len(set(self.paxos_ports.values()))
+  wan_ports = 1 if self.wan_port is not None else 0
+  return count == len(self.ports) - paxos_ports - wan_ports - 1
+
+def old_hosts(self):
+  h = []
+  for port in self.ports:
+    if port in self.paxos_ports.values() or port > 65000:
+      continue
+    macs = self.switch.port_to_mac(port, default=False)
+    if not macs or len(macs) != 1:
+      continue
+    else:
+      mac = macs[0]
+    ip = self.switch.mac_to_ip(mac, default=False)
+    if ip:
+      h.append((mac, ip, port))
+  return h
+
+def old_lookup(self):
+  assert(old_hosts_known(self))
+  return old_hosts(self)
+
+def new_hosts_known(self):
+  paxos_ports = len(set(self.paxos_ports.values()))
+  wan_ports = 1 if self.wan_port is not None else 0
+  return len(self.index) == len(self.ports) - paxos_ports - wan_ports - 1
+
+def new_lookup(self):
+  assert(new_hosts_known(self))
+  return self.index.entries
+
+def rate(lookup, topology, seconds=1.0):
+  """Returns number of lookups per second."""
+  count = 0
+  start = time.time()
+  stop = start + seconds
+  while True:
+    for _ in xrange(100):
+      lookup(topology)
+    count += 100
+    now = time.time()
+    if now >= stop:
+      return count / (now - start)
+
+def main():
+  print("%-28s %14s %14s %8s" % ("switch", "before/s", "after/s",
+                                 "speedup"))
+  for name, topology in [
+      ("3 hosts", Topology(3)),
+      ("3 hosts, 100 remote MACs", Topology(3, remote_macs=50)),
+      ("24 hosts, 100 remote MACs", Topology(24, remote_macs=50))]:
+    assert(old_lookup(topology) == new_lookup(topology))
+    before = rate(old_lookup, topology)
+    after = rate(new_lookup, topology)
+    print("%-28s %14.0f %14.0f %7.2fx" % (name, before, after,
+                                          after/before))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,93 @@
+"""
+Benchmarks writing OpenFlow messages to the switch with and without the
+OutboundQueue of PaxosController.
+
+Each committed slot makes a learner send a LEARN_RANGE to the two other
+nodes and deliver the value to its three hosts, all as packet-outs on the
+same connection.  Without coalescing, each of those is written to the socket
+by itself.  With it, the votes from one timer and the deliveries of one
+slot are written together.
+
+Prints socket writes and controller CPU time per committed slot.  The
+other end of the socket is read by a child process, so its CPU time is not
+counted.
+"""
+
+import os
+import socket
+import time
+
+import pox.openflow.libopenflow_01 as of
+
+from paxos.controller.paxosctrl import OutboundQueue
+
+SLOTS = 50000
+HOSTS = 3
+PEERS = 2
+FRAME = "x"*128
+LEARN = "y"*64
+
+class SocketConnection(object):
+  """Writes each message to a socket, as a switch connection does."""
+  def __init__(self, sock):
+    self.sock = sock
+    self.writes = 0
+
+  def send(self, data):
+    if not isinstance(data, bytes):
+      data = data.pack()
+    self.sock.sendall(data)
+    self.writes += 1
+
+def drain(sock):
+  while sock.recv(65536):
+    pass
+  os._exit(0)
+
+def packet_out(data, port):
+  m = of.ofp_packet_out(data=data)
+  m.actions.append(of.ofp_action_output(port=port))
+  return m
+
+def commit(queue):
+  """The packet-outs for one committed slot."""
+  queue.begin()
+  try:
+    for port in xrange(PEERS):
+      queue.send(packet_out(LEARN, 4 + port))
+  finally:
+    queue.end()
+
+  queue.begin()
+  try:
+    for port in xrange(HOSTS):
+      queue.send(packet_out(FRAME, 1 + port))
+  finally:
+    queue.end()
+
+def run(coalesce):
+  """Returns (writes, CPU seconds) per committed slot."""
+  ours, theirs = socket.socketpair()
+  if os.fork() == 0:
+    ours.close()
+    drain(theirs)
+  theirs.close()
+
+  connection = SocketConnection(ours)
+  queue = OutboundQueue(connection, coalesce)
+  start = time.clock()
+  for _ in xrange(SLOTS):
+    commit(queue)
+  cpu = time.clock() - start
+  ours.close()
+  os.wait()
+  return float(connection.writes) / SLOTS, cpu / SLOTS
+
+def main():
+  print("%-12s %14s %14s" % ("writes", "writes/slot", "CPU us/slot"))
+  for name, coalesce in [("before", False), ("coalesced", True)]:
+    writes, cpu = run(coalesce)
+    print("%-12s %14.2f %14.1f" % (name, writes, 1e6*cpu))
+
+if __name__ == "__main__":
+  main()
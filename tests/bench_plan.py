@@ -0,0 +1,68 @@
+"""
+Benchmarks finding the destinations of ACCEPTs and LEARNs in
+PaxosController.
+
+Compares the original per-message ordered_nodes, sorting the Paxos nodes
+and putting ourself last, followed by a switch MAC table lookup for each
+node, with the fan-out plan computed once when nodes join.
+
+Prints lookups per second for three Paxos nodes, as in our topology, and
+for more of them.
+"""
+
+import time
+
+from pox.lib.addresses import EthAddr
+
+from paxos.controller.paxosctrl import PaxosState
+
+def topology(nodes):
+  """Returns our state, our MAC and the switch's MAC table."""
+  state = PaxosState(1)
+  macports = {}
+  for index in xrange(nodes):
+    mac = EthAddr("00:00:00:01:00:%02x" % index)
+    state.add_node(mac)
+    if index > 0:
+      macports[mac] = index
+  return state, EthAddr("00:00:00:01:00:00"), macports
+
+def ordered_nodes(state, last_node):
+  """The original PaxosState.ordered_nodes."""
+  v = sorted(list(state.N))
+  v.remove(last_node)
+  v.append(last_node)
+  return v
+
+def old_lookup(state, me, macports, plan):
+  return [(mac, macports.get(mac)) for mac in ordered_nodes(state, me)]
+
+def new_lookup(state, me, macports, plan):
+  return plan
+
+def rate(lookup, args, seconds=1.0):
+  """Returns number of lookups per second."""
+  count = 0
+  start = time.time()
+  stop = start + seconds
+  while True:
+    for _ in xrange(100):
+      lookup(*args)
+    count += 100
+    now = time.time()
+    if now >= stop:
+      return count / (now - start)
+
+def main():
+  print("%-16s %14s %14s %8s" % ("nodes", "before/s", "after/s", "speedup"))
+  for nodes in (3, 5, 9):
+    state, me, macports = topology(nodes)
+    args = (state, me, macports, state.fanout_plan(me, macports))
+    assert(old_lookup(*args) == new_lookup(*args))
+    before = rate(old_lookup, args)
+    after = rate(new_lookup, args)
+    print("%-16d %14.0f %14.0f %7.2fx" % (nodes, before, after,
+                                          after/before))
+
+if __name__ == "__main__":
+  main()
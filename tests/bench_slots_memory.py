@@ -0,0 +1,67 @@
+"""
+Benchmarks memory used per in-flight slot.
+
+Compares the original slots (a Slot object with an instance dict and a set
+of votes, kept in a dict by seqno) with the ring buffer of Slots using
+__slots__ and vote bitmasks.  Each slot has been accepted and has one vote,
+as on a learner waiting for the rest of the quorum.
+
+Sizes are counted with sys.getsizeof for the slot containers, slot objects
+and their vote sets.  Values, round numbers and the EthAddr objects of the
+voters are shared between slots and not counted.
+
+Prints bytes per in-flight slot.
+"""
+
+import sys
+
+from pox.lib.addresses import EthAddr
+
+from paxos.controller.paxosctrl import Slots
+
+VOTER = EthAddr("00:00:00:00:01:ff")
+VALUE = "x"*64
+
+# The original slot, verbatim without its methods
+class OldSlot(object):
+  def __init__(self, vrnd, vval, node_count):
+    self.vrnd = vrnd
+    self.vval = vval
+    self.learns = set()
+    self.hrnd = 0
+    self.node_count = node_count
+
+def old_size(count):
+  slots = {}
+  for seqno in xrange(count):
+    slot = OldSlot(None, None, 3)
+    slot.vrnd, slot.vval, slot.hrnd = 1, VALUE, 1
+    slot.learns.update([VOTER])
+    slots[seqno] = slot
+
+  size = sys.getsizeof(slots)
+  for slot in slots.itervalues():
+    size += (sys.getsizeof(slot) + sys.getsizeof(slot.__dict__) +
+             sys.getsizeof(slot.learns))
+  return size
+
+def new_size(count):
+  slots = Slots(3, capacity=count)
+  for seqno in xrange(count):
+    slot = slots.get_slot(seqno)
+    slot.vrnd, slot.vval = 1, VALUE
+  slots.update_learns(1, 1, xrange(count))
+
+  size = sys.getsizeof(slots.ring)
+  for slot in slots.ring:
+    size += sys.getsizeof(slot)
+  return size
+
+def main():
+  print("%-10s %14s %14s" % ("slots", "before B/slot", "after B/slot"))
+  for count in [10*1000, 1000*1000]:
+    print("%-10d %14.1f %14.1f" % (count, float(old_size(count))/count,
+                                   float(new_size(count))/count))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,56 @@
+"""
+Benchmarks group commit in the acceptor's write-ahead log.
+
+Appends ACCEPT records in groups of increasing size and commits each group
+with one fsync.  Commit latency is the time from a group's first append
+until its commit returns, which is how long the first vote in the group
+waits before it's sent.
+
+Prints commit latency and records per second for each group size.
+"""
+
+import os
+import shutil
+import tempfile
+import time
+
+from paxos.wal import DURABILITY_FSYNC, AcceptorLog
+
+RECORDS = 2048
+VALUE = "x"*1024
+
+def run(path, group_size):
+  """Returns (sorted commit latencies in seconds, records per second)."""
+  wal = AcceptorLog(path, DURABILITY_FSYNC)
+  latencies = []
+  start = time.time()
+  for first in xrange(0, RECORDS, group_size):
+    group_start = time.time()
+    for seqno in xrange(first, first + group_size):
+      wal.append_accept(1, seqno, VALUE)
+    wal.commit()
+    latencies.append(time.time() - group_start)
+  elapsed = time.time() - start
+  wal.close()
+  os.remove(path)
+  return sorted(latencies), RECORDS / elapsed
+
+def percentile(values, p):
+  return values[min(len(values)-1, int(len(values)*p))]
+
+def main():
+  directory = tempfile.mkdtemp()
+  path = os.path.join(directory, "acceptor.log")
+  try:
+    print("%-6s %10s %10s %12s" % ("group", "p50 us", "p99 us",
+                                   "records/s"))
+    for group_size in [1, 2, 4, 8, 16, 32, 64, 128, 256]:
+      latencies, rate = run(path, group_size)
+      print("%-6d %10.1f %10.1f %12.0f" % (group_size,
+        1e6*percentile(latencies, 0.50), 1e6*percentile(latencies, 0.99),
+        rate))
+  finally:
+    shutil.rmtree(directory)
+
+if __name__ == "__main__":
+  main()
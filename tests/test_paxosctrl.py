@@ -1,9 +1,23 @@
+import logging
+import os
 import random
+import shutil
+import tempfile
+import threading
 import unittest
 
 from pox.lib.addresses import EthAddr
+import pox.lib.packet as pkt
 
-from paxos.controller.paxosctrl import PaxosMessage
+from paxos.controller.paxosctrl import (SLOT_WINDOW, Applier, ClientBatcher,
+                                       ClientFragments, HostIndex, Leader,
+                                       PaxosController, PaxosControllers,
+                                       PaxosMessage, PaxosState, Prepare,
+                                       Slot, Slots, catchup_messages,
+                                       learn_ranges)
+from paxos.message import (MAX_CLIENT_FRAME, MAX_PAYLOAD, PROMISE_NACK,
+                           VALUE_FORMAT)
+from paxos.wal import AcceptorLog, write_snapshot
 
 def random_u32():
   return random.randint(0, 0xFFFFFFFF)
@@ -23,6 +37,61 @@ def random_mac():
                        random_u8(),
                        random_u8()]))
 
+class PhaseTwoNode(PaxosController):
+  """Just enough of a PaxosController to run phase 2 and catch-up without a
+  switch.  It records the messages it sends and the votes it would send,
+  instead of sending them."""
+  def __init__(self, mac, nodes, combine_accept_learn=True):
+    self._mac = EthAddr(mac)
+    self.log = logging.getLogger("PhaseTwoNode")
+    self.state = PaxosState(1)
+    for node in nodes:
+      self.state.add_node(EthAddr(node))
+    self.plan = [(EthAddr(node), port) for (port, node) in enumerate(nodes)]
+    self.combine_accept_learn = combine_accept_learn
+    self.leader = None
+    self.wal = None
+    self.catchup_fragments = ClientFragments()
+    self.sent = []
+    self.frames = []
+    self.votes = []
+    self.delivered = []
+
+  @property
+  def mac(self):
+    return self._mac
+
+  @property
+  def name(self):
+    return str(self._mac)
+
+  def send_accept(self, dst, paxos_type, payload, port):
+    self.sent.append((dst, paxos_type, payload))
+
+  def send_to(self, dst, paxos_type, payload):
+    self.sent.append((dst, paxos_type, payload))
+
+  def send_ethernet(self, src, dst, type, payload, output_port):
+    self.frames.append((dst, type, payload, output_port))
+
+  def lookup_port(self, mac):
+    return dict(self.plan)[mac]
+
+  def vote(self, n, seqnos):
+    self.votes.extend(seqnos)
+
+  def process_queue(self, n):
+    self.delivered.extend(self.state.slots.take_ready())
+
+  def watch_gap(self):
+    pass
+
+class PacketIn(object):
+  """The parts of a packet-in event that phase 2 looks at."""
+  def __init__(self, src, dst, port=None):
+    self.parsed = pkt.ethernet(src=EthAddr(src), dst=EthAddr(dst))
+    self.port = port
+
 class TestPaxosController(unittest.TestCase):
   def test_create_join(self):
     """Fuzzy-testing PaxosMessage.pack_join and unpack_join"""
@@ -60,6 +129,147 @@ class TestPaxosController(unittest.TestCase):
 
     print("%d tests " % (ids*macs)),
 
+  def test_join_capabilities(self):
+    """Tests the optional capabilities byte in JOIN messages"""
+    for _ in xrange(1000):
+      n, mac = random_u32(), EthAddr(random_mac()).toRaw()
+      caps = random_u8()
+      packed = PaxosMessage.pack_join(n, mac, caps)
+      self.assertEqual(len(packed), 6+4+(1 if caps else 0))
+      self.assertEqual((n, mac), PaxosMessage.unpack_join(packed))
+      self.assertEqual(caps, PaxosMessage.unpack_join_capabilities(packed))
+
+    # Old-style JOINs have no capabilities
+    packed = PaxosMessage.pack_join(1, "\0"*6)
+    self.assertEqual(0, PaxosMessage.unpack_join_capabilities(packed))
+
+  def test_encode_value(self):
+    """Fuzzy-testing PaxosMessage.encode_value and decode_value"""
+    for _ in xrange(1000):
+      v = random_str(random.randint(0, 2000))
+      for compress in (False, True):
+        e = PaxosMessage.encode_value(v, compress)
+        self.assertLessEqual(len(e), len(v)+VALUE_FORMAT.size)
+        self.assertEqual(v, PaxosMessage.decode_value(e))
+        self.assertEqual(v, PaxosMessage.decode_value(memoryview(e)))
+
+    # Compressible values are only compressed above the threshold
+    v = "x"*1000
+    self.assertEqual(len(PaxosMessage.encode_value(v, False)),
+                     len(v)+VALUE_FORMAT.size)
+    self.assertLess(len(PaxosMessage.encode_value(v, True)), len(v))
+    self.assertEqual(len(PaxosMessage.encode_value(v, True, len(v)+1)),
+                     len(v)+VALUE_FORMAT.size)
+    self.assertEqual(v, PaxosMessage.decode_value(
+                          PaxosMessage.encode_value(v, True)))
+
+  def test_encode_values(self):
+    """Fuzzy-testing PaxosMessage.encode_values and decode_values"""
+    for _ in xrange(200):
+      values = [random_str(random.randint(0, 300))
+                for _ in xrange(random.randint(0, 20))]
+      for compress in (False, True):
+        e = PaxosMessage.encode_values(values, compress)
+        self.assertEqual(values, PaxosMessage.decode_values(e))
+        self.assertEqual(values, PaxosMessage.decode_values(memoryview(e)))
+
+    # Single values decode as a batch of one
+    v = random_str(100)
+    self.assertEqual([v], PaxosMessage.decode_values(
+                            PaxosMessage.encode_value(v, True)))
+
+  def test_padded_values(self):
+    """Tests that Ethernet padding after an ACCEPT's value is ignored"""
+    def padded(payload):
+      return payload + "\0"*max(0, 46 - len(payload))
+
+    m = padded(PaxosMessage.pack_accept(1, 2, PaxosMessage.noop_value()))
+    self.assertEquals(46, len(m))
+    n, seqno, v = PaxosMessage.unpack_accept(m)
+    self.assertEquals((1, 2), (n, seqno))
+    self.assertEquals([], PaxosMessage.decode_values(v))
+
+    for compress in (False, True):
+      e = PaxosMessage.encode_values(["ab", "c"], compress)
+      n, seqno, v = PaxosMessage.unpack_accept(
+                      padded(PaxosMessage.pack_accept(1, 2, e)))
+      self.assertEquals(["ab", "c"], PaxosMessage.decode_values(v))
+      e = PaxosMessage.encode_value("abc", compress)
+      n, seqno, v = PaxosMessage.unpack_accept(
+                      padded(PaxosMessage.pack_accept(1, 2, e)))
+      self.assertEquals("abc", PaxosMessage.decode_value(v))
+
+  def test_client_batcher(self):
+    """Tests that ClientBatcher seals batches by values and bytes"""
+    batcher = ClientBatcher(max_values=3, max_bytes=100)
+    self.assertEquals(None, batcher.add("a"*10))
+    self.assertEquals(None, batcher.add("b"*10))
+    self.assertEquals("values", batcher.add("c"*10))
+    self.assertEquals(["a"*10, "b"*10, "c"*10], batcher.take("values"))
+
+    self.assertTrue(batcher.fits("x"*200)) # Empty batches fit anything
+    self.assertEquals(None, batcher.add("d"*50))
+    self.assertFalse(batcher.fits("e"*47))
+    self.assertTrue(batcher.fits("e"*46))
+    self.assertEquals("bytes", batcher.add("e"*46))
+    self.assertEquals(2, len(batcher.take("bytes")))
+
+    batcher.tune(max_values=1)
+    self.assertEquals("values", batcher.add("f"))
+    batcher.take("values")
+
+    stats = batcher.stats()
+    self.assertEquals(3, stats["batches"])
+    self.assertEquals(6, stats["values"])
+    self.assertEquals(2.0, stats["values_per_batch"])
+    self.assertEquals({"values": 2, "bytes": 1}, stats["sealed_by"])
+    self.assertEquals({3: 1, 2: 1, 1: 1}, stats["fill"])
+
+  def test_tune_client_batch(self):
+    """Tests that PaxosControllers retunes the batches of running
+    controllers"""
+    nodes = ["00:00:00:00:00:01", "00:00:00:00:00:02"]
+    controllers = PaxosControllers()
+    for mac in nodes:
+      node = PhaseTwoNode(mac, nodes)
+      node.client_batcher = ClientBatcher(max_values=3, max_bytes=100,
+                                          delay=0.5)
+      controllers.add(node)
+    self.assertEquals(sorted(nodes), sorted(controllers.controllers))
+
+    batcher = controllers.controllers[nodes[0]].client_batcher
+    self.assertEquals(None, batcher.add("a"))
+    controllers.tune_client_batch(max_values=2)
+    self.assertEquals("values", batcher.add("b"))
+    self.assertEquals(["a", "b"], batcher.take("values"))
+
+    controllers.tune_client_batch(max_bytes=10, delay=0.1)
+    for node in controllers.controllers.values():
+      batcher = node.client_batcher
+      self.assertEquals((2, 10, 0.1),
+                        (batcher.max_values, batcher.max_bytes, batcher.delay))
+
+  def test_message_types(self):
+    """Tests that combined message types are made of their parts"""
+    self.assertEquals(PaxosMessage.ACCEPT_LEARN,
+                      PaxosMessage.ACCEPT | PaxosMessage.LEARN)
+    self.assertEquals(PaxosMessage.ACCEPT_LEARN_BATCH,
+                      PaxosMessage.ACCEPT_LEARN | PaxosMessage.BATCH)
+    types = PaxosMessage.typemap.keys()
+    self.assertEquals(len(types), len(set(types)))
+    other = (PaxosMessage.CATCHUP_REQUEST, PaxosMessage.CATCHUP,
+             PaxosMessage.CATCHUP_FRAG, PaxosMessage.CATCHUP_SKIP,
+             PaxosMessage.FLOW_CONTROL)
+    for t in types:
+      self.assertTrue(PaxosMessage.is_paxos_type(t))
+      self.assertEquals(PaxosMessage.typemap[t], PaxosMessage.get_type(t))
+      self.assertEquals(t in other,
+                        t & PaxosMessage.OTHER == PaxosMessage.OTHER)
+      self.assertEquals(t in (PaxosMessage.LEARN, PaxosMessage.LEARN_RANGE,
+                              PaxosMessage.ACCEPT_LEARN,
+                              PaxosMessage.ACCEPT_LEARN_BATCH),
+                        PaxosMessage.carries_vote(t))
+
   def test_accept(self):
     """Fuzzy-testing PaxosMessage.pack_accept and unpack_accept"""
     def test(n, seqno, v):
@@ -83,6 +293,691 @@ class TestPaxosController(unittest.TestCase):
           test(n, seqno, v)
     print("%d tests " % N**3),
 
+  def test_accept_batch(self):
+    """Fuzzy-testing PaxosMessage.pack_accept_batch and unpack_accept_batch"""
+    def test(n, entries):
+      p = PaxosMessage.pack_accept_batch(n, entries)
+      self.assertEquals(len(p),
+          PaxosMessage.accept_batch_size([v for (_, v) in entries]))
+      u_n, u_entries = PaxosMessage.unpack_accept_batch(p)
+      self.assertEquals(n, u_n)
+      self.assertEquals(len(entries), len(u_entries))
+      for (seqno, v), (u_seqno, u_v) in zip(entries, u_entries):
+        self.assertEquals(seqno, u_seqno)
+        self.assertEquals(v, u_v)
+
+    N = 200
+    for _ in xrange(0, N):
+      base = random.randint(0, 0xFFFFFF00)
+      entries = [(base+i, random_str(random.randint(0, 200)))
+                 for i in xrange(random.randint(0, 20))]
+      test(random_u32(), entries)
+    print("%d tests " % N),
+
+  def test_accept_fragments(self):
+    """Fuzzy-testing ACCEPT_FRAG packing and reassembly in Slots"""
+    def test(n, seqno, v, chunk_size):
+      frags = PaxosMessage.pack_accept_fragments(n, seqno, v, chunk_size)
+      self.assertEquals(len(frags), max(1, -(-len(v) // chunk_size)))
+
+      # Reassemble out of order, with a duplicate
+      slots = Slots(3)
+      order = range(len(frags))
+      random.shuffle(order)
+      if len(order) > 1:
+        order.insert(1, order[0])
+      for i, index in enumerate(order):
+        u_n, u_seqno, u_index, u_total, chunk = \
+            PaxosMessage.unpack_accept_fragment(frags[index])
+        self.assertEquals((n, seqno, index, len(frags)),
+                          (u_n, u_seqno, u_index, u_total))
+        self.assertLessEqual(len(chunk), chunk_size)
+        value = slots.add_fragment(u_n, u_seqno, u_index, u_total, chunk)
+        if i < len(order)-1:
+          self.assertIsNone(value)
+        else:
+          self.assertEquals(v, value)
+      self.assertEquals({}, slots.fragments)
+
+    N = 200
+    for _ in xrange(0, N):
+      v = random_str(random.randint(0, 5000))
+      test(random.randint(1, 0xFFFFFFFE), random.randint(0, 1000), v,
+           random.randint(1, 1500))
+    print("%d tests " % N),
+
+    # Fragments from older rounds are ignored, newer ones start over
+    slots = Slots(3)
+    old = PaxosMessage.pack_accept_fragments(1, 0, "a"*10, 4)
+    new = PaxosMessage.pack_accept_fragments(2, 0, "b"*10, 4)
+    self.assertIsNone(slots.add_fragment(
+      *PaxosMessage.unpack_accept_fragment(new[0])))
+    for frag in old:
+      self.assertIsNone(slots.add_fragment(
+        *PaxosMessage.unpack_accept_fragment(frag)))
+    for frag in new[1:-1]:
+      slots.add_fragment(*PaxosMessage.unpack_accept_fragment(frag))
+    self.assertEquals("b"*10, slots.add_fragment(
+      *PaxosMessage.unpack_accept_fragment(new[-1])))
+
+  def test_slots_window(self):
+    """Tests delivery through the ring buffer of Slots"""
+    A, B, C = 1, 2, 4 # Node bits
+    slots = Slots(3, capacity=8)
+    delivered = []
+    for seqno in xrange(100):
+      # Outside of the window
+      self.assertIsNone(slots.get_slot(seqno+8))
+      self.assertIsNotNone(slots.get_slot(seqno+7))
+
+      slot = slots.get_slot(seqno)
+      self.assertEquals(seqno, slot.seqno)
+      slot.vval = str(seqno)
+      self.assertEquals(1, slots.update_learns(1, A, [seqno]))
+      self.assertEquals([], slots.take_ready())
+      self.assertEquals(1, slots.update_learns(1, B, [seqno]))
+      delivered.extend(v for (_, v) in slots.take_ready())
+
+      # Delivered slots are gone
+      self.assertTrue(slots.is_processed(seqno))
+      self.assertIsNone(slots.get_slot(seqno))
+      self.assertEquals(0, slots.update_learns(1, C, [seqno]))
+    self.assertEquals(map(str, xrange(100)), delivered)
+    self.assertEquals(8, len(slots.ring))
+
+    # Votes out of order are delivered once the gap is filled
+    self.assertEquals(2, slots.update_learns(1, A, [101, 102]))
+    self.assertEquals(2, slots.update_learns(1, B, [101, 102]))
+    self.assertEquals([], slots.take_ready())
+    slots.update_learns(1, A, [100])
+    slots.update_learns(1, B, [100])
+    self.assertEquals([], slots.take_ready()) # No values yet
+    for seqno in (100, 101, 102):
+      slots.get_slot(seqno).vval = str(seqno)
+    self.assertEquals([(100, "100"), (101, "101"), (102, "102")],
+                      slots.take_ready())
+
+  def test_slots_catchup(self):
+    """Tests gap detection and filling in of Slots"""
+    A, B = 1, 2 # Node bits
+    slots = Slots(3, capacity=16, history=4)
+    self.assertFalse(slots.stalled())
+    self.assertIsNone(slots.gap())
+
+    # Slots 0..3 are learned everywhere, but we lost the ACCEPT for 1 and 2
+    for seqno in xrange(4):
+      if seqno not in (1, 2):
+        slots.get_slot(seqno).vval = str(seqno)
+      slots.update_learns(1, A|B, [seqno])
+    self.assertEquals([(0, "0")], slots.take_ready())
+    self.assertTrue(slots.stalled())
+    self.assertEquals((1, 2), slots.gap())
+    self.assertEquals((1, 1), slots.gap(max_count=1))
+
+    # Only unfilled slots are filled in
+    self.assertEquals(2, slots.fill(1, [(1, "1"), (2, "2"), (3, "x")]))
+    self.assertIsNone(slots.gap())
+    self.assertEquals([(1, "1"), (2, "2"), (3, "3")], slots.take_ready())
+    self.assertFalse(slots.stalled())
+    self.assertEquals(0, slots.fill(1, [(2, "2")])) # Delivered
+
+    # We only remember the last few delivered values
+    self.assertEquals([(1, "1"), (2, "2"), (3, "3")], slots.delivered(1, 5))
+    slots.fill(1, [(4, "4"), (5, "5")])
+    slots.take_ready()
+    self.assertEquals([], slots.delivered(1, 5))
+    self.assertEquals([(2, "2"), (3, "3"), (4, "4"), (5, "5")],
+                      slots.delivered(2, 4))
+    self.assertEquals(2, slots.oldest)
+
+    # A learner too far behind skips ahead, keeping what it has above
+    slots = Slots(3, capacity=16, history=4)
+    slots.get_slot(2).vval = "2"
+    slots.get_slot(5).vval = "5"
+    slots.update_learns(1, A|B, [2, 5])
+    slots.add_fragment(1, 3, 0, 2, memoryview("x"))
+    self.assertEquals((0, 2), slots.gap())
+    self.assertEquals(4, slots.skip_to(4))
+    self.assertEquals(0, slots.skip_to(3))
+    self.assertEquals((4, 4), (slots.cseq, slots.oldest))
+    self.assertIsNone(slots.get_slot(2))
+    self.assertEquals({}, slots.fragments)
+    self.assertEquals((4, 1), slots.gap())
+    slots.fill(1, [(4, "4")])
+    self.assertEquals([(4, "4"), (5, "5")], slots.take_ready())
+
+    # Nothing below a new watermark was ever delivered here
+    slots.set_watermark(100)
+    self.assertEquals(100, slots.oldest)
+
+  def test_catchup_messages(self):
+    """Tests packing of delivered values into CATCHUPs and CATCHUP_FRAGs"""
+    entries = [(seqno, random_str(100)) for seqno in xrange(100)]
+    messages = catchup_messages(1, entries, max_messages=3)
+    self.assertEquals([PaxosMessage.CATCHUP]*3, [t for (t, p) in messages])
+    sent = []
+    for t, p in messages:
+      self.assertLessEqual(len(p), MAX_PAYLOAD)
+      n, batch = PaxosMessage.unpack_accept_batch(p)
+      self.assertEquals(1, n)
+      sent.extend(batch)
+    self.assertEquals(entries[:len(sent)], sent)
+
+    # Values too large for a CATCHUP are split, but never over the limit
+    # unless they come first
+    big = random_str(2*MAX_PAYLOAD)
+    messages = catchup_messages(1, [(0, big), (1, "a"), (2, big)],
+                                max_messages=4)
+    self.assertEquals([PaxosMessage.CATCHUP_FRAG]*3 + [PaxosMessage.CATCHUP],
+                      [t for (t, p) in messages])
+    self.assertEquals(3, len(catchup_messages(1, [(0, big)], max_messages=1)))
+    self.assertEquals([], catchup_messages(1, []))
+
+  def test_catchup_fragments(self):
+    """Tests catching up on a value larger than MAX_PAYLOAD"""
+    nodes = ["00:00:00:00:00:01", "00:00:00:00:00:02", "00:00:00:00:00:03"]
+    peer = PhaseTwoNode(nodes[1], nodes)
+    n = peer.state.crnd
+
+    # A full-sized client frame is more than MAX_PAYLOAD once encoded
+    big = PaxosMessage.encode_value(random_str(1514))
+    self.assertGreater(len(big), MAX_PAYLOAD)
+    values = [(0, big), (1, "a"), (2, "b")]
+    peer.state.slots.fill(n, values)
+    self.assertEquals(values, peer.state.slots.take_ready())
+
+    peer.on_catchup_request(PacketIn(nodes[2], nodes[1]),
+                            PaxosMessage.pack_catchup_request(0, 1))
+    self.assertEquals([(EthAddr(nodes[2]), PaxosMessage.CATCHUP_FRAG)]*2,
+                      [(dst, t) for (dst, t, p) in peer.sent])
+
+    learner = PhaseTwoNode(nodes[2], nodes)
+    for dst, t, p in reversed(peer.sent):
+      learner.on_catchup_fragment(PacketIn(nodes[1], nodes[2]), p)
+    self.assertEquals([(0, big)], learner.delivered)
+
+    # The values after it come along if asked for
+    peer.sent = []
+    peer.on_catchup_request(PacketIn(nodes[2], nodes[1]),
+                            PaxosMessage.pack_catchup_request(1, 2))
+    self.assertEquals([PaxosMessage.CATCHUP], [t for (dst, t, p) in peer.sent])
+    learner.on_catchup(PacketIn(nodes[1], nodes[2]), peer.sent[0][2])
+    self.assertEquals([(0, big), (1, "a"), (2, "b")], learner.delivered)
+
+  def test_catchup_skip(self):
+    """Tests that a learner only skips slots nobody remembers when told to,
+    and that their values are then lost to it"""
+    nodes = ["00:00:00:00:00:01", "00:00:00:00:00:02", "00:00:00:00:00:03"]
+    learner = PhaseTwoNode(nodes[2], nodes)
+    learner.catchup_delay = 0.01
+    learner.state.slots.fill(1, [(4, "4"), (5, "5")])
+    skip = PaxosMessage.pack_learn(1, 4)
+
+    learner.catchup_skip = False
+    learner.log.disabled = True
+    learner.on_catchup_skip(PacketIn(nodes[0], nodes[2]), skip)
+    learner.log.disabled = False
+    self.assertEquals(0, learner.state.slots.cseq)
+    self.assertEquals([], learner.delivered)
+
+    learner.catchup_skip = True
+    learner.on_catchup_skip(PacketIn(nodes[0], nodes[2]), skip)
+    self.assertEquals(6, learner.state.slots.cseq)
+    self.assertEquals([(4, "4"), (5, "5")], learner.delivered)
+
+  def test_catchup_request(self):
+    for _ in xrange(1000):
+      base = random.randint(0, 0xffffffff)
+      count = random.randint(0, 0xffff)
+      p = PaxosMessage.pack_catchup_request(base, count)
+      self.assertEquals((base, count), PaxosMessage.unpack_catchup_request(p))
+
+  def test_flow_control(self):
+    for pause in (False, True):
+      for hold in (0, 1000, 0xffff):
+        p = PaxosMessage.pack_flow_control(pause, hold)
+        self.assertEquals((pause, hold), PaxosMessage.unpack_flow_control(p))
+
+  def test_flow_control_relay(self):
+    """Tests that a leader without clients of its own has FLOW_CONTROL
+    passed on to the WAN by the node that forwards clients to it"""
+    nodes = ["00:00:00:00:00:01", "00:00:00:00:00:02", "00:00:00:00:00:03"]
+    leader = PhaseTwoNode(nodes[1], nodes)
+    leader.leader = Leader()
+    leader.pause_hold = 1.0
+    leader.wan_port = None
+
+    followers = [PhaseTwoNode(nodes[0], nodes), PhaseTwoNode(nodes[2], nodes)]
+    for node in followers:
+      node.joined = True
+      node.trusted = EthAddr(nodes[1])
+      node.paxos_ports = dict((EthAddr(mac), port)
+                              for (port, mac) in enumerate(nodes))
+      node.wan_port = None
+
+    # Clients only come in through the first node, on port 5
+    s1 = followers[0]
+    self.assertFalse(s1.take_client(PacketIn("00:00:00:00:01:00", nodes[0],
+                                             port=5),
+                                    PaxosMessage.CLIENT, "x"*20))
+    self.assertEquals([(EthAddr(nodes[1]), PaxosMessage.CLIENT, "x"*20, 1)],
+                      s1.frames)
+    self.assertEquals(5, s1.wan_port)
+    del s1.frames[:]
+
+    leader.send_flow_control(True)
+    self.assertEquals([(EthAddr(nodes[0]), PaxosMessage.FLOW_CONTROL, 0),
+                       (EthAddr(nodes[2]), PaxosMessage.FLOW_CONTROL, 2)],
+                      [(dst, t, port) for (dst, t, p, port) in leader.frames])
+    payload = leader.frames[0][2]
+
+    for node in followers:
+      node.on_flow_control(PacketIn(nodes[1], node.mac, port=1), payload)
+    self.assertEquals([(EthAddr("ff:ff:ff:ff:ff:ff"),
+                        PaxosMessage.FLOW_CONTROL, payload, 5)], s1.frames)
+    self.assertEquals([], followers[1].frames)
+
+    # Only the leader we trust is obeyed
+    s1.on_flow_control(PacketIn(nodes[2], nodes[0], port=2), payload)
+    self.assertEquals(1, len(s1.frames))
+
+  def test_leader_window(self):
+    """Tests that Leader only has window slots in flight, and queues or
+    sheds values beyond that"""
+    leader = Leader(window=4, queue_limit=2)
+    self.assertFalse(leader.window_full(0))
+    for _ in xrange(4):
+      leader.next_seqno()
+    self.assertEquals(4, leader.in_flight(0))
+    self.assertTrue(leader.window_full(0))
+    self.assertFalse(leader.window_full(1))
+
+    self.assertTrue(leader.hold("a"))
+    self.assertTrue(leader.hold("b"))
+    self.assertFalse(leader.hold("c"))
+    self.assertEquals(["a", "b"], list(leader.pending))
+    self.assertEquals(1, leader.shed)
+
+    # No limit
+    leader = Leader()
+    for _ in xrange(100000):
+      leader.next_seqno()
+    self.assertFalse(leader.window_full(0))
+
+  def test_trust(self):
+    for _ in xrange(100):
+      n, mac, cseq = random_u32(), random_str(6), random_u32()
+      p = PaxosMessage.pack_trust(n, mac, cseq)
+      self.assertEquals((n, mac, cseq), PaxosMessage.unpack_trust(p))
+
+  def test_trust_catchup(self):
+    """Tests that a follower looks for the slots its leader has delivered"""
+    nodes = ["00:00:00:00:00:01", "00:00:00:00:00:02", "00:00:00:00:00:03"]
+    node = PhaseTwoNode(nodes[1], nodes)
+    node.trusted, node.trusted_round = EthAddr(nodes[0]), 0
+    self.assertIsNone(node.state.slots.gap())
+
+    # We never heard of slots 0..2, but the leader has delivered them
+    trust = PaxosMessage.pack_trust(1, EthAddr(nodes[0]).toRaw(), 3)
+    node.on_trust(None, trust)
+    self.assertEquals((0, 3), node.state.slots.gap())
+
+  def test_check_progress(self):
+    """Tests that the leader resends ACCEPTs when delivery doesn't move"""
+    nodes = ["00:00:00:00:00:01", "00:00:00:00:00:02", "00:00:00:00:00:03"]
+    node = PhaseTwoNode(nodes[0], nodes)
+    n = node.state.crnd
+    leader = node.leader = Leader(n=n)
+    self.assertEquals(0, leader.next_seqno())
+    self.assertTrue(node.accept(n, 0, "a"))
+
+    node.check_progress(leader)
+    self.assertEquals([], node.sent)
+
+    # The last slot we proposed is stuck, with no slot behind it
+    node.check_progress(leader)
+    self.assertEquals([(EthAddr(mac), PaxosMessage.ACCEPT_LEARN)
+                       for mac in nodes[1:]],
+                      [(dst, t) for (dst, t, p) in node.sent])
+
+    # Once it's delivered, there's nothing to resend
+    node.sent = []
+    node.state.slots.fill(n, [(0, "a")])
+    node.process_queue(n)
+    node.check_progress(leader)
+    node.check_progress(leader)
+    self.assertEquals([], node.sent)
+
+  def test_prepare_promise(self):
+    """Fuzzy-testing PREPARE, and PROMISEs reassembled by Prepare"""
+    for _ in xrange(100):
+      n, base, attempt = random_u32(), random_u32(), random.randint(0, 0xFFFF)
+      p = PaxosMessage.pack_prepare(n, base, attempt)
+      self.assertEquals((n, base, attempt), PaxosMessage.unpack_prepare(p))
+
+    for _ in xrange(100):
+      votes = [(seqno, random.randint(1, 10),
+                random_str(random.randint(0, 3000)))
+               for seqno in xrange(20, 20 + random.randint(0, 10))]
+      end = 20 + len(votes)
+      max_size = random.choice([100, 1500, 9000])
+      messages = PaxosMessage.pack_promise(7, 3, 20, end, votes,
+                                           max_size=max_size)
+      self.assertTrue(all(len(m) <= max_size for m in messages))
+
+      prepare = Prepare(7, 20, 3, 1)
+      random.shuffle(messages)
+      for i, m in enumerate(messages):
+        self.assertFalse(prepare.done)
+        (n, attempt, index, count, flags, cseq, end_), chunks = \
+          PaxosMessage.unpack_promise(m)
+        self.assertEquals((7, 3, len(messages), 0, 20, end),
+                          (n, attempt, count, flags, cseq, end_))
+        prepare.add("A", index, count, cseq, end_, chunks)
+      self.assertTrue(prepare.done)
+      self.assertEquals(end, prepare.end)
+      self.assertEquals(dict((seqno, v) for (seqno, vrnd, v) in votes),
+                        prepare.values())
+
+    m, = PaxosMessage.pack_promise(9, 3, 0, 0, [], PROMISE_NACK)
+    header, chunks = PaxosMessage.unpack_promise(m)
+    self.assertEquals((9, 3, 0, 1, PROMISE_NACK, 0, 0), header)
+    self.assertEquals([], chunks)
+
+    # Ethernet pads short frames to 46 bytes of payload
+    self.assertLess(len(m), 46)
+    header, chunks = PaxosMessage.unpack_promise(m + "\0"*(46 - len(m)))
+    self.assertEquals((9, 3, 0, 1, PROMISE_NACK, 0, 0), header)
+    self.assertEquals([], chunks)
+    m, = PaxosMessage.pack_promise(9, 3, 0, 1, [(0, 2, "a")])
+    self.assertLess(len(m), 46)
+    header, chunks = PaxosMessage.unpack_promise(m + "\0"*(46 - len(m)))
+    self.assertEquals([(0, 2, 1, 0, "a")], chunks)
+
+  def test_prepare(self):
+    """Tests that Prepare waits for a quorum, and picks the values voted for
+    in the highest rounds"""
+    prepare = Prepare(10, 5, 1, 2)
+    prepare.add("A", 0, 1, 5, 8, [(5, 4, 1, 0, "a"), (7, 4, 1, 0, "a")])
+    prepare.add("B", 0, 2, 6, 7, [(6, 7, 1, 0, "b")])
+    self.assertEquals(["A"], prepare.promised())
+    self.assertFalse(prepare.done)
+
+    # Only nodes that have sent all their PROMISEs count
+    prepare.add("C", 1, 2, 5, 9, [(5, 5, 1, 0, "c"), (8, 1, 1, 0, "c")])
+    self.assertEquals({5: "a", 7: "a"}, prepare.values())
+    prepare.add("C", 0, 2, 5, 9, [])
+    self.assertTrue(prepare.done)
+    self.assertEquals({5: "c", 7: "a", 8: "c"}, prepare.values())
+
+    # B delivered slot 5, and slot 8 is the last anyone knows of
+    self.assertEquals((6, "B", 9), (prepare.cseq, prepare.cseq_node,
+                                    prepare.end))
+
+  def test_pick_next(self):
+    """Tests that rounds are unique to each node and increasing"""
+    rounds = set()
+    for n_id in xrange(3):
+      state = PaxosState(n_id)
+      for i in xrange(3):
+        state.add_node(i)
+      for _ in xrange(10):
+        n = state.pickNext()
+        self.assertTrue(n > state.crnd)
+        self.assertEquals(n_id, n % 3)
+        self.assertFalse(n in rounds)
+        rounds.add(n)
+        state.crnd = n + random.randint(0, 3)
+
+  def test_host_index(self):
+    """Tests that HostIndex only has ports with one known host"""
+    index = HostIndex()
+    macs = [EthAddr("00:00:00:00:01:%02x" % port) for port in xrange(6)]
+    index.learn_port(macs[1], 1)
+    index.learn_port(macs[2], 2)
+    self.assertEquals([], index.entries) # No IPs yet
+
+    index.learn_ip(macs[1], "10.0.0.1")
+    index.learn_ip(macs[2], "10.0.0.2")
+    index.learn_ip(macs[3], "10.0.0.3")
+    self.assertEquals([(macs[1], "10.0.0.1", 1), (macs[2], "10.0.0.2", 2)],
+                      index.entries)
+
+    # Ports with several MACs, or to other Paxos nodes, have no host
+    index.learn_port(macs[4], 2)
+    index.learn_port(macs[3], 3)
+    index.learn_port(macs[5], 4)
+    index.learn_ip(macs[5], "10.0.0.5")
+    index.exclude(4)
+    index.learn_port(macs[0], 65534)
+    index.learn_ip(macs[0], "10.0.0.254")
+    self.assertEquals([(macs[1], "10.0.0.1", 1), (macs[3], "10.0.0.3", 3)],
+                      index.entries)
+    self.assertEquals(2, len(index))
+
+  def test_applier(self):
+    """Tests that the Applier keeps delivering after apply raises"""
+    delivered = []
+    done = threading.Event()
+    def apply(n, seqno, v):
+      if seqno == 1:
+        raise ValueError("Bad value")
+      delivered.append((seqno, v))
+      if seqno == 3:
+        done.set()
+      return True
+
+    log = logging.getLogger("test_applier")
+    log.disabled = True
+    applier = Applier(apply, log)
+    applier.submit(1, [(0, "a"), (1, "b")])
+    applier.submit(1, [(2, "c"), (3, "d")])
+    self.assertTrue(done.wait(5))
+    self.assertEquals([(0, "a"), (2, "c"), (3, "d")], delivered)
+
+  def test_fanout_plan(self):
+    """Fuzzy-testing PaxosState.fanout_plan"""
+    for _ in xrange(100):
+      state = PaxosState(random_u8())
+      macs = [EthAddr(random_mac()) for _ in xrange(random.randint(1, 8))]
+      for mac in macs:
+        state.add_node(mac)
+      macports = dict((mac, random_u8()) for mac in macs[1:])
+      last = random.choice(macs)
+
+      plan = state.fanout_plan(last, macports)
+      self.assertEquals((last, macports.get(last)), plan[-1])
+      self.assertEquals(sorted(set(macs) - set([last])),
+                        [mac for mac, port in plan[:-1]])
+      self.assertEquals([macports.get(mac) for mac, port in plan],
+                        [port for mac, port in plan])
+
+  def test_accept_votes(self):
+    """Tests that only the combined ACCEPT types count the sender's vote"""
+    nodes = ["00:00:00:00:00:01", "00:00:00:00:00:02", "00:00:00:00:00:03"]
+    for paxos_type in (PaxosMessage.ACCEPT, PaxosMessage.ACCEPT_BATCH,
+                       PaxosMessage.ACCEPT_LEARN,
+                       PaxosMessage.ACCEPT_LEARN_BATCH):
+      acceptor = PhaseTwoNode(nodes[1], nodes)
+      n = acceptor.state.crnd
+      acceptor.on_phase2(PacketIn(nodes[0], nodes[1]), paxos_type, n,
+                         [(0, "a"), (1, "b")])
+
+      # We vote for the values either way
+      self.assertEquals([0, 1], acceptor.votes)
+
+      # ... but only count the leader's vote if the message carried it
+      bit = acceptor.state.node_bit(EthAddr(nodes[0]))
+      learns = bit if PaxosMessage.carries_vote(paxos_type) else 0
+      for seqno in (0, 1):
+        self.assertEquals(learns, acceptor.state.slots.get_slot(seqno).learns)
+
+  def test_late_value(self):
+    """Tests that a slot is delivered when its value comes after the votes"""
+    nodes = ["00:00:00:00:00:01", "00:00:00:00:00:02", "00:00:00:00:00:03"]
+    acceptor = PhaseTwoNode(nodes[1], nodes)
+    n = acceptor.state.crnd
+    for node in (nodes[0], nodes[2]):
+      acceptor.learn(n, EthAddr(node), [0])
+    self.assertEquals([], acceptor.delivered)
+
+    acceptor.on_phase2(PacketIn(nodes[0], nodes[1]), PaxosMessage.ACCEPT, n,
+                       [(0, "a")])
+    self.assertEquals([(0, "a")], acceptor.delivered)
+
+  def test_combined_accept(self):
+    """Tests that the leader only sends its vote for slots it accepted"""
+    nodes = ["00:00:00:00:00:01", "00:00:00:00:00:02", "00:00:00:00:00:03"]
+    leader = PhaseTwoNode(nodes[0], nodes)
+    n = leader.state.crnd
+    entries = [(0, "a"), (1, "b"), (SLOT_WINDOW, "c")]
+    leader.broadcast_values(n, entries)
+
+    # Only the peers get messages, and the slot outside our window goes out
+    # without our vote
+    self.assertEquals(4, len(leader.sent))
+    self.assertEquals([], [dst for (dst, t, p) in leader.sent
+                           if dst == leader.mac])
+    sent = dict((t, p) for (dst, t, p) in leader.sent)
+    self.assertEquals((n, [(0, "a"), (1, "b")]),
+                      PaxosMessage.unpack_accept_batch(
+                        sent[PaxosMessage.ACCEPT_LEARN_BATCH]))
+    self.assertEquals((n, SLOT_WINDOW, "c"),
+                      PaxosMessage.unpack_accept(sent[PaxosMessage.ACCEPT]))
+
+    # We counted our own vote for the accepted slots only
+    bit = leader.state.node_bit(leader.mac)
+    for seqno in (0, 1):
+      self.assertEquals(bit, leader.state.slots.get_slot(seqno).learns)
+
+    # In a round we can't accept in, nothing carries our vote
+    leader = PhaseTwoNode(nodes[0], nodes)
+    leader.state.crnd = n + 1
+    leader.broadcast_values(n, [(0, "a")])
+    self.assertEquals([PaxosMessage.ACCEPT]*2,
+                      [t for (dst, t, p) in leader.sent])
+    self.assertEquals(0, leader.state.slots.get_slot(0).learns)
+
+    # Without combining, everyone gets the plain ACCEPT, and we vote like
+    # any acceptor
+    leader = PhaseTwoNode(nodes[0], nodes, combine_accept_learn=False)
+    leader.broadcast_values(n, [(0, "a")])
+    self.assertEquals([(EthAddr(node), PaxosMessage.ACCEPT) for node in nodes],
+                      [(dst, t) for (dst, t, p) in leader.sent])
+
+  def test_recover(self):
+    """Tests that a restarted node resumes delivery where it left off"""
+    nodes = ["00:00:00:00:00:01", "00:00:00:00:00:02", "00:00:00:00:00:03"]
+    tmp = tempfile.mkdtemp()
+    try:
+      path = os.path.join(tmp, "acceptor.log")
+      wal = AcceptorLog(path)
+      for seqno in xrange(5):
+        wal.append_accept(7, seqno, str(seqno))
+      wal.append_delivered(3)
+      wal.close()
+
+      # Without a snapshot, the log tells how far we've delivered
+      node = PhaseTwoNode(nodes[0], nodes)
+      node.snapshot_path = path + ".snapshot"
+      node.recover(path)
+      self.assertEquals((3, 7), (node.state.slots.cseq, node.state.crnd))
+      self.assertIsNone(node.state.slots.get_slot(2))
+      for seqno in (3, 4):
+        slot = node.state.slots.get_slot(seqno)
+        self.assertEquals((7, str(seqno)), (slot.vrnd, slot.vval))
+
+      # ... and the snapshot when it is newer
+      write_snapshot(node.snapshot_path, 4, 8)
+      node = PhaseTwoNode(nodes[0], nodes)
+      node.snapshot_path = path + ".snapshot"
+      node.recover(path)
+      self.assertEquals((4, 8), (node.state.slots.cseq, node.state.crnd))
+    finally:
+      shutil.rmtree(tmp)
+
+  def test_slot_votes(self):
+    """Tests vote bitmasks in Slot"""
+    slot = Slot(None, None, 5)
+    self.assertEquals(3, slot.required_learns)
+    self.assertTrue(slot.learn(1, 1 << 0))
+    self.assertFalse(slot.learn(1, 1 << 0))
+    self.assertTrue(slot.learn(1, 1 << 4))
+    self.assertEquals(2, slot.votes)
+    self.assertFalse(slot.learned)
+
+    # A newer round starts over, older ones are ignored
+    self.assertTrue(slot.learn(2, 1 << 0))
+    self.assertEquals(1, slot.votes)
+    self.assertFalse(slot.learn(1, 1 << 1))
+    self.assertTrue(slot.learn(2, 1 << 1))
+    self.assertTrue(slot.learn(2, 1 << 2))
+    self.assertTrue(slot.learned)
+    self.assertFalse(slot.learn(2, 1 << 3))
+    self.assertEquals(3, slot.votes)
+
+  def test_slot_ready(self):
+    """Tests that a Slot is only delivered with a vote from the learned
+    round or a later one"""
+    slot = Slot(1, "old", 3)
+    slot.learn(2, 1 << 0)
+    slot.learn(2, 1 << 1)
+    self.assertTrue(slot.learned)
+    self.assertFalse(slot.ready)
+    slot.vrnd, slot.vval = 2, "new"
+    self.assertTrue(slot.ready)
+
+    slot = Slot(1, "old", 3)
+    slot.decide(2, "new")
+    self.assertTrue(slot.ready)
+    self.assertEquals((2, "new"), (slot.vrnd, slot.vval))
+
+  def test_learn_range(self):
+    """Fuzzy-testing PaxosMessage.pack_learn_range and unpack_learn_range"""
+    def test(n, base, count, bitmap):
+      p = PaxosMessage.pack_learn_range(n, base, count, bitmap)
+      if bitmap is None:
+        bitmap = (1 << count) - 1
+      self.assertEquals((n, base, count, bitmap),
+                        PaxosMessage.unpack_learn_range(p))
+
+      # Should ignore Ethernet padding
+      p += "\x00" * max(0, 46 - len(p))
+      self.assertEquals((n, base, count, bitmap),
+                        PaxosMessage.unpack_learn_range(p))
+
+      seqnos = PaxosMessage.range_seqnos(base, bitmap)
+      self.assertEquals(len(seqnos), bin(bitmap).count("1"))
+      for seqno in seqnos:
+        self.assertTrue(bitmap & (1 << (seqno - base)))
+
+    N = 90
+    for _ in xrange(0, N):
+      n, base, count = random_u32(), random_u32(), random.randint(0, 0xFFFF)
+      test(n, base, count, None)
+      count = random.randint(0, 2000)
+      test(n, base, count, random.getrandbits(count) if count > 0 else 0)
+    print("%d tests " % (2*N)),
+
+  def test_learn_ranges(self):
+    """Fuzzy-testing splitting of votes into LEARN_RANGEs"""
+    N = 200
+    for _ in xrange(0, N):
+      seqnos = sorted(random.sample(xrange(5000), random.randint(0, 500)))
+      max_count = random.randint(1, 1000)
+      ranges = learn_ranges(seqnos, max_count)
+
+      found = []
+      for base, count, bitmap in ranges:
+        self.assertLessEqual(count, max_count)
+        if bitmap is None:
+          found.extend(xrange(base, base+count))
+        else:
+          found.extend(PaxosMessage.range_seqnos(base, bitmap))
+          self.assertEquals(base + count - 1, found[-1])
+      self.assertEquals(seqnos, found)
+    print("%d tests " % N),
+
   def test_learn(self):
     """Fuzzy-testing PaxosMessage.pack_learn and unpack_learn"""
     def test(n, seqno):
@@ -121,5 +1016,60 @@ class TestPaxosController(unittest.TestCase):
 
     print("%d tests " % N),
 
+  def test_wrap_client_frame(self):
+    """Fuzzy-testing PaxosMessage.wrap_client_frame"""
+    N = 20
+    for _ in xrange(0, N):
+      frame = random_str(random.randint(14, MAX_CLIENT_FRAME))
+      wrapped = PaxosMessage.wrap_client_frame(frame)
+      self.assertEqual(1, len(wrapped))
+      eth = pkt.ethernet(raw=wrapped[0])
+      self.assertEqual(eth.dst.toRaw(), frame[0:6])
+      self.assertEqual(eth.src.toRaw(), frame[6:12])
+      self.assertEqual(eth.type, PaxosMessage.CLIENT)
+      self.assertEqual(frame, PaxosMessage.unpack_client(wrapped[0][14:]))
+    print("%d tests " % N),
+
+  def test_client_fragments(self):
+    """Fuzzy-testing CLIENT_FRAGs of large client frames"""
+    def test(frame, frame_id):
+      wrapped = PaxosMessage.wrap_client_frame(frame, frame_id)
+      self.assertGreater(len(wrapped), 1)
+
+      reassembly = ClientFragments()
+      random.shuffle(wrapped)
+      for i, w in enumerate(wrapped):
+        self.assertLessEqual(len(w) - 14, MAX_PAYLOAD)
+        eth = pkt.ethernet(raw=w)
+        self.assertEqual(eth.dst.toRaw(), frame[0:6])
+        self.assertEqual(eth.src.toRaw(), frame[6:12])
+        self.assertEqual(eth.type, PaxosMessage.CLIENT_FRAG)
+
+        fid, index, total, chunk = PaxosMessage.unpack_client_fragment(w[14:])
+        self.assertEquals((frame_id, len(wrapped)), (fid, total))
+        value = reassembly.add((eth.src, fid), index, total, chunk)
+        if i < len(wrapped) - 1:
+          self.assertIsNone(value)
+      self.assertEquals(frame, value)
+      self.assertEquals(0, len(reassembly.partial))
+
+    # A full-sized frame from a client with a 1500 byte MTU
+    test(random_str(1514), random_u32())
+    test(random_str(MAX_CLIENT_FRAME + 1), random_u32())
+
+    N = 20
+    for _ in xrange(0, N):
+      test(random_str(random.randint(MAX_CLIENT_FRAME + 1, 9000)),
+           random_u32())
+
+    # Frames that never get all their fragments are dropped, oldest first
+    reassembly = ClientFragments(capacity=2)
+    for frame_id in xrange(3):
+      self.assertIsNone(reassembly.add(("src", frame_id), 0, 2, "a"))
+    self.assertEquals(1, reassembly.dropped)
+    self.assertIsNone(reassembly.add(("src", 0), 1, 2, "b"))
+    self.assertEquals("ab", reassembly.add(("src", 2), 1, 2, "b"))
+    print("%d tests " % (N+2)),
+
 if __name__ == "__main__":
   unittest.main(verbosity=2)
@@ -0,0 +1,125 @@
+import random
+import unittest
+from struct import pack, unpack_from
+
+from paxos.rewrite import FrameTemplate, checksum_adjust
+
+def random_str(length):
+  return "".join(chr(random.randint(0,255)) for n in xrange(length))
+
+def checksum(data):
+  """The Internet checksum of data, computed in full."""
+  if len(data) % 2:
+    data += "\x00"
+  total = sum(unpack_from("!H", data, i)[0] for i in xrange(0, len(data), 2))
+  while total > 0xFFFF:
+    total = (total & 0xFFFF) + (total >> 16)
+  return ~total & 0xFFFF
+
+def ip_frame(protocol, payload, options="", fragment=0, vlan=False,
+             transport_checksum=True):
+  """Returns an Ethernet frame with an IPv4 packet and correct checksums.
+  The payload starts with the TCP or UDP header."""
+  src, dst = random_str(4), random_str(4)
+  ihl = 5 + len(options)//4
+  header = pack("!BBHHHBBH4s4s", 0x40 | ihl, 0, 4*ihl + len(payload),
+                random.randint(0, 0xFFFF), fragment, 64, protocol, 0, src,
+                dst) + options
+  header = header[:10] + pack("!H", checksum(header)) + header[12:]
+
+  offset = {6: 16, 17: 6}[protocol]
+  payload = payload[:offset] + "\x00\x00" + payload[offset+2:]
+  if transport_checksum:
+    pseudo = src + dst + pack("!BBH", 0, protocol, len(payload))
+    csum = checksum(pseudo + payload) or 0xFFFF
+    payload = payload[:offset] + pack("!H", csum) + payload[offset+2:]
+
+  ethertype = "\x08\x00"
+  if vlan:
+    ethertype = "\x81\x00" + random_str(2) + ethertype
+  return random_str(12) + ethertype + header + payload
+
+class TestRewrite(unittest.TestCase):
+  def assertValid(self, frame, protocol, ip_offset=14):
+    """Checks that the IPv4 header and TCP/UDP checksums are correct."""
+    ihl = 4*(ord(frame[ip_offset]) & 0x0F)
+    self.assertEquals(0, checksum(frame[ip_offset:ip_offset+ihl]))
+
+    payload = frame[ip_offset+ihl:]
+    src = frame[ip_offset+12:ip_offset+16]
+    dst = frame[ip_offset+16:ip_offset+20]
+    pseudo = src + dst + pack("!BBH", 0, protocol, len(payload))
+    self.assertEquals(0, checksum(pseudo + payload))
+
+  def test_checksum_adjust(self):
+    """Fuzzy-testing checksum_adjust against full checksums"""
+    for _ in xrange(1000):
+      data = random_str(2*random.randint(2, 30))
+      index = 2*random.randint(0, len(data)//2 - 2)
+      new = random_str(4)
+      changed = data[:index] + new + data[index+4:]
+      old_words = unpack_from("!HH", data, index)
+      new_words = unpack_from("!HH", new)
+      self.assertEquals(checksum(changed) or 0xFFFF,
+                        checksum_adjust(checksum(data), old_words,
+                                        new_words) or 0xFFFF)
+
+  def test_rewrite(self):
+    """Fuzzy-testing FrameTemplate.rewrite for TCP and UDP over IPv4"""
+    for _ in xrange(200):
+      protocol = random.choice([6, 17])
+      size = {6: 20, 17: 8}[protocol] + random.randint(0, 200)
+      options = random_str(4*random.randint(0, 10))
+      vlan = random.choice([False, True])
+      frame = ip_frame(protocol, random_str(size), options, vlan=vlan)
+      ip_offset = 18 if vlan else 14
+      template = FrameTemplate(frame)
+
+      for _ in xrange(3):
+        mac, ip = random_str(6), random_str(4)
+        rewritten = template.rewrite(mac, ip)
+        self.assertEquals(len(frame), len(rewritten))
+        self.assertEquals(mac, rewritten[0:6])
+        self.assertEquals(ip, rewritten[ip_offset+16:ip_offset+20])
+        self.assertValid(rewritten, protocol, ip_offset)
+
+  def test_rewrite_zero_checksum(self):
+    """Tests that only a UDP checksum adjusted to zero is sent as 0xFFFF"""
+    for protocol, csum in ((6, 0), (17, 0xFFFF)):
+      frame = ip_frame(protocol, random_str(40))
+      csum_offset = 34 + {6: 16, 17: 6}[protocol]
+
+      # Pick the new IP address so the adjusted checksum comes out as zero
+      csum_words = unpack_from("!H", frame, csum_offset)
+      ip_words = unpack_from("!HH", frame, 30)
+      total = sum(~word & 0xFFFF for word in csum_words + ip_words)
+      total += 0x0A00
+      while total > 0xFFFF:
+        total = (total & 0xFFFF) + (total >> 16)
+      ip = pack("!HH", 0x0A00, 0xFFFF - total)
+
+      rewritten = FrameTemplate(frame).rewrite("\x01"*6, ip)
+      self.assertEquals(csum, unpack_from("!H", rewritten, csum_offset)[0])
+      self.assertValid(rewritten, protocol)
+
+  def test_rewrite_udp_without_checksum(self):
+    frame = ip_frame(17, random_str(24), transport_checksum=False)
+    rewritten = FrameTemplate(frame).rewrite("\x01"*6, "\x0a\x00\x00\x01")
+    self.assertEquals(0, checksum(rewritten[14:34]))
+    self.assertEquals(frame[34:], rewritten[34:]) # Still no UDP checksum
+
+  def test_rewrite_fragment(self):
+    """Tests that later IPv4 fragments only get their IP header changed"""
+    frame = ip_frame(17, random_str(64), fragment=8)
+    rewritten = FrameTemplate(frame).rewrite("\x01"*6, "\x0a\x00\x00\x01")
+    self.assertEquals(0, checksum(rewritten[14:34]))
+    self.assertEquals(frame[34:], rewritten[34:])
+
+  def test_rewrite_other(self):
+    """Tests that non-IP frames only get their destination MAC changed"""
+    frame = random_str(12) + "\x08\x06" + random_str(28)
+    rewritten = FrameTemplate(frame).rewrite("\x01"*6, "\x0a\x00\x00\x01")
+    self.assertEquals("\x01"*6 + frame[6:], rewritten)
+
+if __name__ == "__main__":
+  unittest.main(verbosity=2)
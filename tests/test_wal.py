@@ -0,0 +1,107 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from paxos.wal import (DURABILITY_LEVELS, RECORD_ACCEPT, RECORD_DELIVERED,
+                       RECORD_PROMISE, AcceptorLog, read_records,
+                       read_snapshot, write_snapshot)
+
+def random_str(length):
+  return "".join(chr(random.randint(0,255)) for n in xrange(length))
+
+class TestAcceptorLog(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.path = os.path.join(self.dir, "acceptor.log")
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def test_group_commit(self):
+    """Tests that records are only written on commit"""
+    for durability in DURABILITY_LEVELS:
+      if os.path.exists(self.path):
+        os.remove(self.path)
+      wal = AcceptorLog(self.path, durability)
+      records = [(RECORD_ACCEPT, 1, seqno, random_str(random.randint(0, 300)))
+                 for seqno in xrange(100)]
+      for (kind, n, seqno, value) in records[:50]:
+        wal.append(kind, n, seqno, value)
+      self.assertTrue(wal.dirty)
+      self.assertEquals(50, wal.commit())
+      self.assertFalse(wal.dirty)
+      self.assertEquals(0, wal.commit())
+
+      for (kind, n, seqno, value) in records[50:]:
+        wal.append_accept(n, seqno, value)
+      wal.close()
+      self.assertEquals(2, wal.commits)
+      self.assertEquals(records, read_records(self.path))
+
+  def test_torn_record(self):
+    """Tests that a partly written record at the end is ignored"""
+    wal = AcceptorLog(self.path)
+    wal.append_accept(1, 0, "a"*100)
+    wal.append_accept(1, 1, "b"*100)
+    wal.close()
+    with open(self.path, "r+b") as f:
+      f.truncate(os.path.getsize(self.path) - 1)
+    self.assertEquals([(RECORD_ACCEPT, 1, 0, "a"*100)],
+                      read_records(self.path))
+
+  def test_missing_log(self):
+    self.assertEquals([], read_records(self.path))
+
+  def test_truncate(self):
+    """Tests that truncation only keeps votes for the tail"""
+    wal = AcceptorLog(self.path)
+    records = [(RECORD_ACCEPT, 1, seqno, random_str(random.randint(0, 300)))
+               for seqno in xrange(100)]
+    for (kind, n, seqno, value) in records:
+      wal.append(kind, n, seqno, value)
+    self.assertEquals(30, wal.truncate(70))
+    self.assertEquals(records[70:], read_records(self.path))
+
+    # The log can still be appended to after truncation
+    wal.append_accept(2, 100, "c")
+    wal.close()
+    self.assertEquals(records[70:] + [(RECORD_ACCEPT, 2, 100, "c")],
+                      read_records(self.path))
+    self.assertFalse(os.path.exists(self.path + ".tmp"))
+
+  def test_promise(self):
+    """Tests that promises are logged, and kept by truncation"""
+    wal = AcceptorLog(self.path)
+    wal.append_accept(1, 0, "a")
+    wal.append_promise(4)
+    wal.append_accept(4, 1, "b")
+    self.assertEquals(2, wal.truncate(1))
+    wal.close()
+    self.assertEquals([(RECORD_PROMISE, 4, 0, ""), (RECORD_ACCEPT, 4, 1, "b")],
+                      read_records(self.path))
+
+  def test_delivered(self):
+    """Tests that deliveries are logged, and truncated like votes"""
+    wal = AcceptorLog(self.path)
+    wal.append_accept(1, 0, "a")
+    wal.append_delivered(1)
+    wal.append_accept(1, 1, "b")
+    wal.append_accept(1, 2, "c")
+    wal.append_delivered(2)
+    self.assertEquals(2, wal.truncate(2))
+    wal.close()
+    self.assertEquals([(RECORD_ACCEPT, 1, 2, "c"), (RECORD_DELIVERED, 0, 2, "")],
+                      read_records(self.path))
+
+  def test_snapshot(self):
+    path = os.path.join(self.dir, "acceptor.snapshot")
+    self.assertEquals(None, read_snapshot(path))
+    write_snapshot(path, 10000, 3)
+    self.assertEquals((10000, 3), read_snapshot(path))
+    write_snapshot(path, 20000, 4)
+    self.assertEquals((20000, 4), read_snapshot(path))
+
+if __name__ == "__main__":
+  unittest.main(verbosity=2)